@@ -0,0 +1,82 @@
+import signal
+
+# asyncio is imported by the functions that use it rather than here. It
+# is one of the slowest modules to import on a Pi Zero, and the threads
+# runtime, the default, never needs it.
+
+# How the soundbox program runs, chosen in the [runtime] section of
+# soundbox.ini:
+#   threads: the led compositor, gesture timer, volume control, command
+#            switch and main loop each block on a thread of their own
+#   asyncio: all of them are callbacks and coroutines on one event loop
+#            in the main thread
+RUNTIME_THREADS = 'threads'
+RUNTIME_ASYNCIO = 'asyncio'
+RUNTIME_MODES = (RUNTIME_THREADS, RUNTIME_ASYNCIO)
+RUNTIME_DEFAULT = RUNTIME_THREADS
+
+# Signals that end the soundbox in the asyncio runtime
+RUNTIME_STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+# Drive something that would otherwise sleep on a thread of its own, such
+# as the led compositor or the gesture recognizer, from the event loop.
+# stepper.step() does what is due and returns when (by clock()) it next
+# needs calling, or None if not until it is woken. The waker it is given
+# may be called from any thread, e.g. when a GPIO edge arrives or a layer
+# is added, and makes the coroutine call step() again at once.
+async def drive_steps(stepper, clock, loop):
+    import asyncio
+    woken = asyncio.Event()
+    stepper.set_waker(lambda: loop.call_soon_threadsafe(woken.set))
+    try:
+        while True:
+            woken.clear()
+            due = stepper.step()
+            # the time it is due wakes it the same way, with a timer
+            # rather than a timeout, so a cancel is never lost to a wake
+            # that comes with it
+            timer = None
+            if due is not None:
+                timer = loop.call_later(max(0.0, due - clock()), woken.set)
+            try:
+                await woken.wait()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+    finally:
+        stepper.set_waker(None)
+
+
+# Class definition for the asyncio runtime. It owns the event loop and
+# runs one main coroutine on it until the coroutine ends or the process
+# is told to stop by one of stop_signals. Stopping cancels the coroutine,
+# which gets to clean up before the loop is closed, so nothing is left
+# running on the pins when they are reset. Signals can only be taken by a
+# loop in the main thread; a loop on another thread is given none.
+class AsyncRuntime(object):
+
+    def __init__(self, stop_signals=RUNTIME_STOP_SIGNALS):
+        import asyncio
+        self.__stop_signals = stop_signals
+        self.__loop = asyncio.new_event_loop()
+
+    def loop(self):
+        return self.__loop
+
+    # Run coroutine until it ends or a stop signal arrives
+    def run(self, coroutine):
+        import asyncio
+        loop = self.__loop
+        asyncio.set_event_loop(loop)
+        main = loop.create_task(coroutine)
+        for signum in self.__stop_signals:
+            loop.add_signal_handler(signum, main.cancel)
+        try:
+            loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            print('Event loop stopped by signal')
+        finally:
+            for signum in self.__stop_signals:
+                loop.remove_signal_handler(signum)
+            loop.close()
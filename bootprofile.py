@@ -0,0 +1,95 @@
+import os
+import time
+import socket
+
+# Environment variable that turns on the startup profile, which prints
+# each phase of the start as it ends, e.g. SOUNDBOX_PROFILE_STARTUP=1
+STARTUP_PROFILE_ENV = 'SOUNDBOX_PROFILE_STARTUP'
+
+
+# Seconds since this process was started by the kernel, so the time the
+# interpreter took to start and import the modules counts too. From the
+# start time of the process and the uptime of the system in /proc.
+def process_age():
+    try:
+        with open('/proc/self/stat') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return 0.0
+    # starttime is field 22 of stat, the 20th after the command name
+    return max(0.0, uptime - int(fields[19]) / float(os.sysconf('SC_CLK_TCK')))
+
+
+# Tell systemd, when it started the soundbox as a Type=notify service,
+# how it is doing, e.g. 'READY=1'. Returns False when not run by systemd.
+def systemd_notify(state):
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # an abstract socket
+        address = '\0' + address[1:]
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        notify_socket.connect(address)
+        notify_socket.sendall(state.encode('ascii'))
+        return True
+    except OSError as ex:
+        print('cannot notify systemd: ', ex)
+        return False
+    finally:
+        notify_socket.close()
+
+
+# Class definition for the profile of the start of the soundbox. The start
+# is cut into phases, each ended by a call to mark(name), timed from the
+# start of the process. ready() ends the start: the time from the process
+# starting to then is the boot to ready time. Phases marked after ready()
+# are the work put off until the soundbox was ready, and are reported as
+# deferred.
+class StartupProfile(object):
+
+    def __init__(self, verbose=None):
+        if verbose is None:
+            verbose = bool(os.environ.get(STARTUP_PROFILE_ENV))
+        self.__verbose = verbose
+        self.__started = time.monotonic() - process_age()
+        self.__last = self.__started
+        self.__phases = []
+        self.__deferred = []
+        self.__ready_at = None
+
+    # The phase that has been running since the last mark is done
+    def mark(self, name):
+        now = time.monotonic()
+        phases = self.__phases if self.__ready_at is None else self.__deferred
+        phases.append((name, round(1000.0 * (now - self.__last), 1)))
+        self.__last = now
+        if self.__verbose:
+            print('startup: ', name, ' ', phases[-1][1], ' ms')
+
+    # The soundbox serves presses from now on. Returns the boot to ready
+    # time in milliseconds.
+    def ready(self):
+        self.mark('ready')
+        self.__ready_at = self.__last
+        boot_to_ready = self.boot_to_ready_ms()
+        print('soundbox ready ', boot_to_ready, ' ms after start: ',
+              ', '.join('%s=%s' % phase for phase in self.__phases))
+        return boot_to_ready
+
+    # Time put off work starts being done, after ready()
+    def start_deferred(self):
+        self.__last = time.monotonic()
+
+    def boot_to_ready_ms(self):
+        if self.__ready_at is None:
+            return None
+        return round(1000.0 * (self.__ready_at - self.__started), 1)
+
+    def report(self):
+        return {'boot_to_ready_ms': self.boot_to_ready_ms(),
+                'phases_ms': list(self.__phases),
+                'deferred_ms': list(self.__deferred)}
@@ -0,0 +1,91 @@
+from gpiobackend import GPIO
+import queue
+
+from globaldefs import *
+from platformdefs import *
+from gestures import *
+
+# Level of the pin of a pressed button
+BUTTON_PRESSED_LEVEL = GPIO.HIGH if BUTTON_EDGE == GPIO.RISING else GPIO.LOW
+
+# Kinds of events handed to the main thread by the ButtonDispatcher
+BUTTON_PRESSED = 'button pressed'
+PLAYER_FINISHED = 'player finished'
+DISPATCH_INTERRUPTED = 'dispatch interrupted'
+
+
+# Class definition for the edge-triggered button dispatcher. Instead of the
+# main thread polling the buttons, the gesture recognizer calls back here
+# as soon as a button goes down and the press is put on a queue. The main thread
+# blocks on that queue, so it sleeps while the box is idle and wakes as soon
+# as something happens. Completion of a sound player is reported through the
+# same queue so the main thread only ever waits in one place.
+#
+# In the asyncio runtime there is no main thread blocking on the queue;
+# an event handler set with set_event_handler() is handed the events
+# instead, and passes them on to the event loop.
+class ButtonDispatcher(object):
+
+    def __init__(self, gesture_recognizer, button_ids=buttons):
+        self.__gesture_recognizer = gesture_recognizer
+        self.__button_ids = button_ids
+        self.__events = queue.Queue()
+        self.__event_handler = self.__events.put
+        self.__dispatching = False
+
+    # Hand events to handler(event) rather than queueing them for
+    # next_event(), or queue them again if handler is None. The handler is
+    # called on GPIO and player threads, so it must return quickly.
+    def set_event_handler(self, handler):
+        if handler is None:
+            handler = self.__events.put
+        self.__event_handler = handler
+
+    # Start detecting button edges. Each press arrives as a
+    # (BUTTON_PRESSED, button_id, None) event.
+    def start(self):
+        if not self.__dispatching:
+            for button in self.__button_ids:
+                self.__gesture_recognizer.watch(button, BUTTON_PRESSED_LEVEL,
+                                                self.__button_gesture)
+            self.__dispatching = True
+
+    # Stop detecting button edges, e.g. so another part of the program
+    # can watch the buttons for itself.
+    def stop(self):
+        if self.__dispatching:
+            self.__dispatching = False
+            for button in self.__button_ids:
+                self.__gesture_recognizer.unwatch(button)
+
+    def is_dispatching(self):
+        return self.__dispatching
+
+    # Called by the gesture recognizer. A sound starts the moment its
+    # button goes down; the other gestures of the buttons are not used.
+    def __button_gesture(self, gesture):
+        if gesture.kind == GESTURE_PRESS:
+            self.__event_handler((BUTTON_PRESSED, gesture.channel, None))
+
+    # Report the end of a player as a (PLAYER_FINISHED, player,
+    # return_code) event. The player's handle calls back when the sound
+    # ends, so no thread waits for it.
+    def watch_player(self, player):
+        if player is not None:
+            player.add_done_callback(self.__player_finished)
+
+    def __player_finished(self, player):
+        self.__event_handler((PLAYER_FINISHED, player, player.returncode))
+
+    # Wake whoever waits for the next event with a
+    # (DISPATCH_INTERRUPTED, None, None) event, e.g. to end the main loop
+    def interrupt(self):
+        self.__event_handler((DISPATCH_INTERRUPTED, None, None))
+
+    # Block until the next event is available and return it. Returns None
+    # if a timeout is given and nothing happened in that time.
+    def next_event(self, timeout=None):
+        try:
+            return self.__events.get(timeout=timeout)
+        except queue.Empty:
+            return None
@@ -1,20 +1,31 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 import time
+from threading import Condition
 
 from globaldefs import *
 from platformdefs import *
+from ledcompositor import *
 
 class ButtonMonitor(object):
 
-    def __init__ (self, num_to_get):
+    def __init__ (self, num_to_get, prompt_player=None):
         self.__num_to_get = num_to_get
         self.__count = 0
         self.__button_presses = []
+        self.__cancelled = False
+        self.__pressed = Condition()
+        # a prompt asking for the presses is cut off by the first press
+        self.__prompt_player = prompt_player
+        # leds of the pressed buttons, drawn over any other led pattern
+        self.__pressed_layer = SolidLayer({}, PRESSED_PRIORITY)
 
     def button_event(self, button_id):
 
         print("button ", button_id, " pressed")
 
+        if self.__prompt_player is not None:
+            self.__prompt_player.stop()
+
         if button_id==BUTTON_WHITE:
             led_id = LED_WHITE
         if button_id==BUTTON_BLUE:
@@ -26,26 +37,43 @@ class ButtonMonitor(object):
         if button_id==BUTTON_RED:
             led_id = LED_RED
 
-        GPIO.output(led_id, GPIO.HIGH)
+        self.__pressed_layer.set_level(led_id, 100)
         time.sleep(1.0)
 
-        self.__count = self.__count + 1
-        self.__button_presses.append(button_id)
+        with self.__pressed:
+            self.__count = self.__count + 1
+            self.__button_presses.append(button_id)
+            self.__pressed.notify()
+
+    # Stop waiting for presses, e.g. when the time to enter them is up.
+    # get_button_presses() returns the presses there were by then.
+    def cancel(self):
+        with self.__pressed:
+            self.__cancelled = True
+            self.__pressed.notify()
 
-    def get_button_presses(self):
+    # Wait for the buttons to be pressed and return them in the order they
+    # were pressed. Given a timeout (seconds), stops waiting after that long
+    # and returns the presses there were by then.
+    def get_button_presses(self, timeout=None):
+        get_led_compositor().add_layer(self.__pressed_layer)
         for button in buttons:
             GPIO.add_event_detect (button, GPIO.FALLING,
                                    self.button_event, 300)
 
-        while self.__count < self.__num_to_get:
-            continue
+        # sleep until the GPIO callback thread has seen enough presses
+        with self.__pressed:
+            self.__pressed.wait_for(lambda: self.__count >= self.__num_to_get or
+                                            self.__cancelled,
+                                    timeout)
 
         time.sleep(1.0)
 
         for button in buttons:
             GPIO.remove_event_detect (button)
 
-        turnoff_all_leds()
+        get_led_compositor().remove_layer(self.__pressed_layer)
 
-        return self.__button_presses
+        with self.__pressed:
+            return list(self.__button_presses)
 
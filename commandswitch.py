@@ -1,4 +1,4 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 
 import os
 
@@ -8,113 +8,231 @@ from platformdefs import *
 from ledscanner import *
 from ledcontroller import *
 from buttonmonitor import *
+from promptplayer import *
+from gestures import *
+from configmenu import *
 
 import time
-import subprocess
-from threading import Thread
+import queue
+import threading
 
+# Class definition for the command switch, the push button of the volume
+# knob. What a gesture on it does depends on what the soundbox is doing:
+#
+#   sound playing: a press pauses the sound
+#   sound paused: a click resumes it, a long press stops it
+#   no sound: holding the switch for the menu hold time opens the
+#             shutdown menu
+#
+# The shutdown menu powers down, or opens the configuration menu, or goes
+# back to playing sounds. The configuration menu runs in this process and
+# a collection chosen there is handed to select_collection(name), so
+# neither the menu nor a change of collection restarts the soundbox.
+#
+# Gestures come from the gesture recognizer, so the switch is acted on the
+# moment a gesture is recognized and nothing sleeps to time a press. Each
+# press is acted on at most once: the click that ends the press that paused
+# a sound does not resume it again.
+#
+# process_switch_events() handles the gestures on a thread of its own. The
+# asyncio runtime instead watches the switch with watch_switch(), calls
+# handle_gesture() on its event loop and runs the menu, which waits for
+# buttons, off the loop with set_menu_runner().
 class CommandSwitch(object):
 
     terminate = False
 
-    def __init__(self, prompts_dir, termination_event, sound_player, led_scanner):
+    # How often (seconds) the waiting loop checks for termination
+    TERMINATE_CHECK_INTERVAL = 1.0
+
+    def __init__(self, prompts_dir, termination_event, sound_player,
+                 led_scanner, button_dispatcher=None,
+                 output_factory=AlsaOutput, gesture_recognizer=None,
+                 select_collection=None):
         self.__command_underway = False
         self.__prompts_dir = prompts_dir
         self.__termination_event = termination_event
         self.__sound_player = sound_player
         self.__led_scanner = led_scanner
-
+        self.__button_dispatcher = button_dispatcher
+        if gesture_recognizer is None:
+            gesture_recognizer = GestureRecognizer()
+        self.__gesture_recognizer = gesture_recognizer
+        self.__gestures = queue.Queue()
+        self.__menu_runner = self.__run_menu
+        # when the press last acted on went down
+        self.__acted_on = None
+        # the prompts are only needed by the menus, so the prompt player
+        # is made by prepare() once the soundbox is ready, or else when
+        # the menu first opens
+        self.__output_factory = output_factory
+        self.__select_collection = select_collection
+        self.__prompts_lock = threading.Lock()
+        self.__prompt_player = None
+        self.__config_menu = None
+
+    # Make the prompt player, which opens a sound device and decodes the
+    # prompts in the background so they play instantly when needed
+    def prepare(self):
+        with self.__prompts_lock:
+            if self.__prompt_player is None:
+                self.__prompt_player = PromptPlayer(self.__prompts_dir,
+                                                    self.__output_factory)
+                self.__config_menu = ConfigMenu(self.__prompt_player,
+                                                self.__select_collection)
+
+    # Called by the gesture recognizer, hands the gesture to the command
+    # switch thread
+    def __switch_gesture(self, gesture):
+        self.__gestures.put(gesture)
+
+    # Start watching the switch. Gestures are handed to handler(gesture),
+    # by default the queue of the command switch thread.
+    def watch_switch(self, handler=None):
+        if handler is None:
+            handler = self.__switch_gesture
+        # the switch pulls its pin low when pressed
+        self.__gesture_recognizer.watch(ROTARY_SWITCH_PIN, GPIO.LOW, handler)
+
+    def unwatch_switch(self):
+        self.__gesture_recognizer.unwatch(ROTARY_SWITCH_PIN)
+
+    # Have runner(menu) run the shutdown menu, a function that blocks until
+    # a button is pressed, rather than running it in handle_gesture()
+    def set_menu_runner(self, runner):
+        self.__menu_runner = runner
+
+    def __run_menu(self, menu):
+        menu()
 
     def process_switch_events(self):
         try:
+            self.watch_switch()
             while not CommandSwitch.terminate:
-                GPIO.wait_for_edge(ROTARY_SWITCH_PIN, GPIO.FALLING)
-                print('control button pressed')
-
-                if self.__sound_player.is_active():
-                    # sound player is active, meaning a sound is playing
-
-                    if self.__sound_player.is_paused():
-                        # if paused and the button remains pressed...
-                        time.sleep(1.0)
-                        if GPIO.input(ROTARY_SWITCH_PIN) == GPIO.LOW:
-                            # button was held down while playing/paused,
-                            # stop this sound file and resume scanning
-                            # awaiting a new sound choice
-                            # sound player is paused, quit playing
-                            self.__sound_player.quit_playing()
-                        else:
-                            p = self.__sound_player.toggle_playback()
-                    else:
-                        # sound playing, not paused
-                        p = self.__sound_player.toggle_playback()
-                else:
-                    # Player is not active (leds are scanning)...
-                    # Wait 2 seconds to see if command button remains pressed
-                    time.sleep(2.0)
-                    if GPIO.input(ROTARY_SWITCH_PIN) == GPIO.LOW:
-                        # we are ending one way or another.
-                        # prevent the main thread from starting a sound
-                        self.__termination_event.clear()
-
-                        # command button held down for 2 sec
-                        # see if we shut down or go to configuration restart
-                        turnoff_all_leds()
-                        self.__led_scanner.stop_scanning()
-                        turnoff_all_leds()
-
-                        # shutdown-admin-resume.wav
-                        #
-                        # Soundbox is shutting down.
-                        # Choose one of the three following options
-                        # Press the red button to power down.
-                        # or
-                        # Press the green button to configure Soundbox and
-                        # restart it
-                        # or
-                        # Press any other button to restart Soundbox
-                        subprocess.Popen(['omxplayer',
-                                        '-o','alsa:'+ALSA_DEVICE_NAME,
-                                        self.__prompts_dir+'shutdown-admin-resume.wav'],
-                                        stdin=subprocess.PIPE,
-                                        stdout=None,stderr=None)
-
-                        led_controller = LEDController(1000, (LED_GREEN, LED_RED))
-                        led_thread = Thread(target=led_controller.run)
-                        led_thread.start()
-
-
-                        button_monitor = ButtonMonitor(1)
-                        button_pattern = button_monitor.get_button_presses()
-
-                        led_controller.go_dark()
-
-                        if button_pattern[0] == BUTTON_GREEN:
-
-                            led_controller.light_up(BUTTON_GREEN)
-                            time.sleep(1.0)
-                            print('restarting in config mode')
-                            self.__sound_player.close()
-                            os.system('sudo /etc/init.d/soundbox restart')
-
-                        else:
-                            if button_pattern[0] == BUTTON_RED:
-
-                                print('shutting down now')
-                                led_controller.light_up(BUTTON_RED)
-                                time.sleep(1.0)
-                                os.system('sudo shutdown now')
-
-                            else:
-                                os.system('sudo /etc/init.d/soundbox restart2')
-
-
-
-#
-
-                # sleep just a bit in case of switch bounce. this is because
-                # we are using edge detection here, and if the switch bounces,
-                # one press could cause two or more detectable edges.
-                time.sleep(0.2)
+                try:
+                    gesture = self.__gestures.get(
+                        timeout=self.TERMINATE_CHECK_INTERVAL)
+                except queue.Empty:
+                    continue
+                self.handle_gesture(gesture)
         except Exception as ex:
             print('CommandSwitch: exception: ', ex)
+
+    # Act on a gesture of the switch, unless it belongs to a press that was
+    # already acted on or the menu is open
+    def handle_gesture(self, gesture):
+        if self.__command_underway:
+            return
+        if gesture.started == self.__acted_on:
+            # the rest of a press that was already acted on
+            return
+        if self.__process_gesture(gesture):
+            self.__acted_on = gesture.started
+
+    # Act on a gesture. Returns True if it was acted on.
+    def __process_gesture(self, gesture):
+        if self.__sound_player.is_active():
+            # sound player is active, meaning a sound is playing
+
+            if self.__sound_player.is_paused():
+                if gesture.kind == GESTURE_LONG_PRESS:
+                    # button was held down while paused,
+                    # stop this sound file and resume scanning
+                    # awaiting a new sound choice
+                    print('control button held')
+                    self.__sound_player.quit_playing()
+                    return True
+                if gesture.kind == GESTURE_CLICK:
+                    print('control button clicked')
+                    self.__sound_player.toggle_playback()
+                    return True
+            elif gesture.kind == GESTURE_PRESS:
+                # sound playing, not paused
+                print('control button pressed')
+                self.__sound_player.toggle_playback()
+                return True
+            return False
+
+        # Player is not active (leds are scanning)...
+        # See if command button is held down long enough for the menu
+        if gesture.kind == GESTURE_MENU_HOLD:
+            self.__command_underway = True
+            self.__menu_runner(self.__shutdown_menu)
+            return True
+        return False
+
+    def __shutdown_menu(self):
+        try:
+            self.__menu()
+        finally:
+            self.__command_underway = False
+
+    def __menu(self):
+        self.prepare()
+
+        # we are ending one way or another.
+        # prevent the main thread from starting a sound
+        self.__termination_event.clear()
+
+        # the buttons are about to be used to answer the
+        # shutdown prompt, so stop dispatching presses to
+        # the main thread. this also frees the buttons'
+        # edge detection for the ButtonMonitor.
+        if self.__button_dispatcher is not None:
+            self.__button_dispatcher.stop()
+
+        # command button held down for the menu hold time
+        # see if we shut down or go to configuration restart
+        self.__led_scanner.stop_scanning()
+
+        # shutdown-admin-resume.wav
+        #
+        # Soundbox is shutting down.
+        # Choose one of the three following options
+        # Press the red button to power down.
+        # or
+        # Press the green button to configure Soundbox and
+        # restart it
+        # or
+        # Press any other button to restart Soundbox
+        self.__prompt_player.play('shutdown-admin-resume.wav')
+
+        led_controller = LEDController(1000, (LED_GREEN, LED_RED))
+        led_controller.start()
+
+
+        button_monitor = ButtonMonitor(1, self.__prompt_player)
+        button_pattern = button_monitor.get_button_presses()
+
+        led_controller.go_dark()
+
+        if button_pattern[0] == BUTTON_RED:
+
+            print('shutting down now')
+            led_controller.light_up(BUTTON_RED)
+            time.sleep(1.0)
+            os.system('sudo shutdown now')
+            return
+
+        if button_pattern[0] == BUTTON_GREEN:
+
+            led_controller.light_up(BUTTON_GREEN)
+            time.sleep(1.0)
+            led_controller.close()
+            print('entering config mode')
+            try:
+                self.__config_menu.run()
+            except Exception as ex:
+                # back to playing sounds whatever went wrong
+                print('CommandSwitch: config menu failed: ', ex)
+
+        led_controller.close()
+        self.__resume()
+
+    # Go back to playing sounds after the menu, as a restart used to
+    def __resume(self):
+        print('resuming soundbox')
+        self.__led_scanner.start_scanning()
+        if self.__button_dispatcher is not None:
+            self.__button_dispatcher.start()
+        self.__termination_event.set()
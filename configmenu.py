@@ -0,0 +1,163 @@
+import os
+import time
+import configparser
+
+from globaldefs import *
+from platformdefs import *
+from ledcontroller import *
+from buttonmonitor import *
+from promptplayer import *
+
+# Passcodes of the configuration menu, the buttons to press in order. The
+# first lets a teacher choose the sound collection, the second also lets
+# the connectivity be configured.
+CONFIG_PASSCODE = [BUTTON_RED, BUTTON_WHITE, BUTTON_BLUE]
+CONFIG_PASSCODE_SUPERUSER = [BUTTON_RED, BUTTON_GREEN, BUTTON_BLUE]
+
+# Dimming cycles of the leds, a countdown of the time left to enter the
+# passcode
+CONFIG_PASSCODE_CYCLES = 5
+
+# The sound collection directory chosen by each button
+COLLECTION_FOR_BUTTON = {BUTTON_WHITE: 'white',
+                         BUTTON_BLUE: 'blue',
+                         BUTTON_GREEN: 'green',
+                         BUTTON_YELLOW: 'yellow',
+                         BUTTON_RED: 'red'}
+
+# Gain for the closing prompts, which omxplayer used to play at --vol 300
+CONFIG_PROMPT_GAIN = millibels_to_gain(300)
+
+# Where the scripts that switch the wifi access point are
+CONFIG_SCRIPT_DIR = '/home/pi/soundbox'
+
+
+# Write the choice of sound collection to the ini file, for the next time
+# the soundbox starts. The file is replaced in one step, so a power cut
+# while it is written does not leave the soundbox without one.
+def save_selected_sound_dir(ini_path, selected_dir):
+    config = configparser.ConfigParser()
+    config.read(ini_path)
+    config.set('file_locations', 'selected_sound_dir', selected_dir)
+    new_path = ini_path + '.new'
+    with open(new_path, 'w') as cfgfile:
+        config.write(cfgfile)
+    os.replace(new_path, ini_path)
+
+
+# Class definition for the configuration menu, the menus of the
+# soundbox-config program run inside the soundbox. It asks for a passcode
+# and then either lets the sound collection be chosen or the connectivity
+# be configured, by prompts and button presses as before.
+#
+# A collection chosen here is handed to select_collection(name), which
+# makes it the active one at once and returns False if it cannot, and is
+# then saved to the ini file. The soundbox goes back to playing sounds
+# without restarting. The menu waits for buttons, so it is run on the
+# thread of the shutdown menu.
+class ConfigMenu(object):
+
+    def __init__(self, prompt_player, select_collection=None,
+                 ini_path=SOUNDBOX_INI_FILE_PATH_NAME):
+        self.__prompt_player = prompt_player
+        self.__select_collection = select_collection
+        self.__ini_path = ini_path
+
+    def run(self):
+        # enter-passcode-pattern.wav
+        #
+        # Soundbox configuration has begun
+        # enter a passcode by pressing three buttons
+        self.__prompt_player.play('enter-passcode-pattern.wav')
+
+        # Run the LEDs through their paces. They provide a countdown for
+        # the user so s/he knows how long they have to enter a button
+        # pattern that lets them do some configuration. If this is not
+        # entered in time, the soundbox goes back to user mode.
+        button_monitor = ButtonMonitor(3, self.__prompt_player)
+        led_controller = LEDController(CONFIG_PASSCODE_CYCLES, leds,
+                                       button_monitor.cancel)
+        led_controller.start()
+        button_pattern = button_monitor.get_button_presses()
+        led_controller.close()
+
+        self.__prompt_player.stop()
+
+        if len(button_pattern) < 3:
+            print('soundbox config timed out')
+        elif button_pattern == CONFIG_PASSCODE:
+            self.__choose_collection()
+        elif button_pattern == CONFIG_PASSCODE_SUPERUSER:
+            self.__configure_connectivity()
+        else:
+            # invalid-passcode.wav
+            #
+            # the buttons you pressed do not match a valid passcode.
+            # Soundbox configuration is ending.
+            print('soundbox config is ending')
+            self.__prompt_player.play_and_wait('invalid-passcode.wav',
+                                               CONFIG_PROMPT_GAIN)
+
+    def __choose_collection(self):
+        # choose-sound-group.wav
+        #
+        # Your passcode authorizes you to choose a collection
+        # of sounds to play on Soundbox.
+        # choose a collection by pressing one of the five colored buttons.
+        self.__prompt_player.play('choose-sound-group.wav')
+
+        buttons_pressed = ButtonMonitor(1, self.__prompt_player).get_button_presses()
+        self.__prompt_player.stop()
+        selected_dir = COLLECTION_FOR_BUTTON[buttons_pressed[0]]
+
+        if self.__select_collection is not None:
+            started = time.monotonic()
+            if not self.__select_collection(selected_dir):
+                # there is no such collection, keep the one there is
+                return
+            print('collection ', selected_dir, ' selected in ',
+                  round(1000.0 * (time.monotonic() - started), 1), ' ms')
+        save_selected_sound_dir(self.__ini_path, selected_dir)
+
+        # soundbox-resume-your-choice.wav
+        #
+        # your choice of sounds has been saved.
+        self.__prompt_player.play_and_wait('soundbox-resume-your-choice.wav',
+                                           CONFIG_PROMPT_GAIN)
+
+    def __configure_connectivity(self):
+        # wifi-or-access-pt.wav
+        #
+        # your passcode authorizes you to configure Soundbox
+        # connectivity. Your options are to:
+        # press the red button if a configured wifi access point
+        # is available.
+        # or
+        # press the green button to configure Soundbox to be a
+        # standalone access point.
+        # or
+        # press any other button to leave connectivity unchanged.
+        self.__prompt_player.play('wifi-or-access-pt.wav')
+
+        buttons_pressed = ButtonMonitor(1, self.__prompt_player).get_button_presses()
+        self.__prompt_player.stop()
+
+        if buttons_pressed[0] == BUTTON_GREEN:
+            # access-point-enabled.wav
+            print('soundbox start access point')
+            os.system('cd ' + CONFIG_SCRIPT_DIR + ' && sudo ./start_ap.sh')
+            self.__prompt_player.play_and_wait('access-point-enabled.wav',
+                                               CONFIG_PROMPT_GAIN)
+        elif buttons_pressed[0] == BUTTON_RED:
+            # wifi-enabled.wav
+            print('soundbox stop access point')
+            os.system('cd ' + CONFIG_SCRIPT_DIR + ' && sudo ./stop_ap.sh')
+            self.__prompt_player.play_and_wait('wifi-enabled.wav',
+                                               CONFIG_PROMPT_GAIN)
+        else:
+            # connection-mode-unchanged.wav
+            #
+            # You chose to leave Soundbox connectivity unchanged.
+            print('soundbox config is unchanged')
+            self.__prompt_player.play_and_wait('connection-mode-unchanged.wav',
+                                               CONFIG_PROMPT_GAIN)
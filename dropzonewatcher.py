@@ -0,0 +1,187 @@
+import os
+import time
+import errno
+import select
+import struct
+import threading
+
+from globaldefs import *
+
+# Default time (milliseconds) the drop zone must be quiet before a change
+# is acted on. soundbox.ini can change it in its [index] section.
+DROP_ZONE_DEBOUNCE_MS = 1000
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Changes to the files of a watched directory. Writes are watched too, so
+# a sound that is still being copied keeps the change from being acted on.
+DROP_ZONE_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+                   IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+                   IN_MOVE_SELF
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+# Raised when the kernel's inotify cannot be used
+class InotifyError(Exception):
+    pass
+
+
+# The inotify calls of the C library, looked up once. ctypes is imported
+# only then, as the watchers are started after the soundbox is ready, and
+# the C library is taken from the symbols this process has loaded already
+# rather than searched for.
+_libc = None
+
+def inotify_libc():
+    global _libc, ctypes
+    if _libc is None:
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError) as ex:
+            raise InotifyError('no inotify in the C library: ' + str(ex))
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+# Class definition for the drop zone watcher. It watches the base dir of
+# the drop zone and every collection directory in it with inotify, on a
+# thread that sleeps in select() until the kernel reports a change. The
+# paths that changed are collected until the drop zone has been quiet for
+# the debounce time, and then handed to on_change(paths) in one call, so
+# copying a batch of sounds, or a file written in many pieces, makes a
+# single rebuild. on_change is called on the watcher thread.
+#
+# With subdirs=False only the files of base_dir itself are watched, as for
+# the directory of soundbox.ini.
+class DropZoneWatcher(object):
+
+    def __init__(self, base_dir, on_change, debounce_ms=DROP_ZONE_DEBOUNCE_MS,
+                 subdirs=True):
+        self.__base_dir = base_dir
+        self.__subdirs = subdirs
+        self.__on_change = on_change
+        self.__debounce = debounce_ms / 1000.0
+        self.__fd = None
+        self.__watches = {}
+        self.__changed = set()
+        self.__due = None
+        self.__thread = None
+        self.__stopping = False
+        self.__wake_read, self.__wake_write = os.pipe()
+
+    # Start watching. Raises InotifyError if inotify is not available.
+    def start(self):
+        libc = inotify_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise InotifyError(os.strerror(ctypes.get_errno()))
+        self.__fd = fd
+        self.__watch(self.__base_dir)
+        for name in sorted(os.listdir(self.__base_dir)) if self.__subdirs else ():
+            path = os.path.join(self.__base_dir, name)
+            if not name.startswith('.') and os.path.isdir(path):
+                self.__watch(path)
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='drop-zone-watcher')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopping = True
+        os.write(self.__wake_write, b'x')
+        if self.__thread is not None:
+            self.__thread.join(1.0)
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __watch(self, path):
+        wd = inotify_libc().inotify_add_watch(self.__fd, os.fsencode(path),
+                                              DROP_ZONE_EVENTS)
+        if wd < 0:
+            print('DropZoneWatcher: cannot watch ', path, ': ',
+                  os.strerror(ctypes.get_errno()))
+            return
+        self.__watches[wd] = path
+
+    def __run(self):
+        while not self.__stopping:
+            timeout = None
+            if self.__due is not None:
+                timeout = max(0.0, self.__due - time.monotonic())
+            ready, _, _ = select.select([self.__fd, self.__wake_read], [], [],
+                                        timeout)
+            if self.__wake_read in ready:
+                os.read(self.__wake_read, 64)
+            if self.__fd in ready:
+                self.__read_events()
+            if self.__due is not None and time.monotonic() >= self.__due:
+                changed = sorted(self.__changed)
+                self.__changed = set()
+                self.__due = None
+                try:
+                    self.__on_change(changed)
+                except Exception as ex:
+                    print('DropZoneWatcher: update failed: ', ex)
+
+    def __read_events(self):
+        try:
+            data = os.read(self.__fd, INOTIFY_READ_SIZE)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            self.__event(wd, mask, name)
+        # any change puts off acting on them all
+        self.__due = time.monotonic() + self.__debounce
+
+    def __event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, the whole drop zone may have changed
+            self.__changed.add(self.__base_dir)
+            return
+        dir_path = self.__watches.get(wd)
+        if dir_path is None:
+            return
+        if mask & IN_IGNORED:
+            # the directory is gone
+            del self.__watches[wd]
+            self.__changed.add(dir_path)
+            return
+        if not name or name.startswith('.'):
+            return
+        path = os.path.join(dir_path, name)
+        self.__changed.add(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and \
+           dir_path == self.__base_dir and self.__subdirs:
+            # a new collection
+            self.__watch(path)
@@ -0,0 +1,391 @@
+import math
+import time
+
+import numpy
+
+from globaldefs import *
+
+# Kinds of DSP stage. The biquads are the EQ stages: lowcut (a high pass
+# filter), highcut (a low pass filter), peak, lowshelf and highshelf.
+DSP_BIQUAD_KINDS = ('lowcut', 'highcut', 'peak', 'lowshelf', 'highshelf')
+DSP_LIMITER = 'limiter'
+DSP_STAGE_KINDS = DSP_BIQUAD_KINDS + (DSP_LIMITER,)
+
+# Defaults of the stage settings soundbox.ini leaves out
+DSP_FREQUENCY_DEFAULTS = {'lowcut': 80.0, 'highcut': 16000.0, 'peak': 1000.0,
+                          'lowshelf': 200.0, 'highshelf': 5000.0}
+DSP_Q_DEFAULT = 0.707
+DSP_GAIN_DB_DEFAULT = 0.0
+LIMITER_THRESHOLD_DB_DEFAULT = -1.0
+LIMITER_LOOKAHEAD_MS_DEFAULT = 5.0
+LIMITER_RELEASE_MS_DEFAULT = 200.0
+
+# The limiter's release time is the time its gain takes to come back up
+# by this many dB
+LIMITER_RELEASE_DB = 20.0
+
+# A biquad works through a period in sub-blocks of this many frames, each
+# one a matrix product, so it needs no loop over the frames
+BIQUAD_SUB_BLOCK_FRAMES = 32
+
+
+# Coefficients (b, a) of a biquad of the given kind, normalized so that
+# a[0] is 1, from the Audio EQ Cookbook
+def biquad_coefficients(kind, frequency, q=DSP_Q_DEFAULT,
+                        gain_db=DSP_GAIN_DB_DEFAULT, rate=ALSA_PCM_RATE):
+    w0 = 2.0 * math.pi * frequency / rate
+    cos_w0 = math.cos(w0)
+    alpha = math.sin(w0) / (2.0 * q)
+    amp = 10.0 ** (gain_db / 40.0)
+    if kind == 'lowcut':
+        b = [(1.0 + cos_w0) / 2.0, -(1.0 + cos_w0), (1.0 + cos_w0) / 2.0]
+        a = [1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha]
+    elif kind == 'highcut':
+        b = [(1.0 - cos_w0) / 2.0, 1.0 - cos_w0, (1.0 - cos_w0) / 2.0]
+        a = [1.0 + alpha, -2.0 * cos_w0, 1.0 - alpha]
+    elif kind == 'peak':
+        b = [1.0 + alpha * amp, -2.0 * cos_w0, 1.0 - alpha * amp]
+        a = [1.0 + alpha / amp, -2.0 * cos_w0, 1.0 - alpha / amp]
+    elif kind in ('lowshelf', 'highshelf'):
+        root = 2.0 * math.sqrt(amp) * alpha
+        sign = 1.0 if kind == 'lowshelf' else -1.0
+        b = [amp * ((amp + 1) - sign * (amp - 1) * cos_w0 + root),
+             sign * 2 * amp * ((amp - 1) - sign * (amp + 1) * cos_w0),
+             amp * ((amp + 1) - sign * (amp - 1) * cos_w0 - root)]
+        a = [(amp + 1) + sign * (amp - 1) * cos_w0 + root,
+             -sign * 2 * ((amp - 1) + sign * (amp + 1) * cos_w0),
+             (amp + 1) + sign * (amp - 1) * cos_w0 - root]
+    else:
+        raise ValueError('no biquad of kind ' + kind)
+    return ([coefficient / a[0] for coefficient in b],
+            [1.0, a[1] / a[0], a[2] / a[0]])
+
+
+# Class definition for a biquad EQ stage. The filter is run as a state
+# space system, with the state (z1, z2) of its transposed direct form II.
+# Rather than looping over the frames, a period is cut into sub-blocks of
+# M frames and the filter's response to all of them is worked out with a
+# few matrix products:
+#
+#   the response of each sub-block to its own frames, from a zero state,
+#   by the M x M matrix of the impulse response,
+#   the state each sub-block leaves behind it from its own frames,
+#   the state each sub-block starts from, by a matrix of the powers of the
+#   system matrix that sums the states left by the sub-blocks before it,
+#   and the response of each sub-block to the state it starts from.
+#
+# All the matrices are worked out when the stage is made and every product
+# is written into buffers the stage keeps, so a period allocates nothing.
+class BiquadStage(object):
+
+    def __init__(self, name, b, a, channels=ALSA_PCM_CHANNELS,
+                 block_frames=ALSA_PERIOD_FRAMES,
+                 sub_frames=BIQUAD_SUB_BLOCK_FRAMES):
+        self.name = name
+        self.latency = 0
+        m = sub_frames
+        self.__sub_frames = m
+        system = numpy.array([[-a[1], 1.0], [-a[2], 0.0]])
+        state_input = numpy.array([b[1] - a[1] * b[0], b[2] - a[2] * b[0]])
+        powers = [numpy.eye(2)]
+        for n in range(m):
+            powers.append(powers[-1].dot(system))
+        self.__powers = numpy.array(powers)
+
+        # response to the frames of a sub-block, from a zero state
+        impulse = [b[0]] + [powers[n][0].dot(state_input) for n in range(m - 1)]
+        self.__zero_state = numpy.zeros((m, m))
+        for n in range(m):
+            self.__zero_state[n, :n + 1] = impulse[n::-1]
+        # state left by the frames of a sub-block, and response to the
+        # state a sub-block starts from
+        self.__state_in = numpy.array([powers[m - 1 - n].dot(state_input)
+                                       for n in range(m)]).T.copy()
+        self.__state_out = numpy.array([powers[n][0] for n in range(m)])
+
+        # the state each sub-block starts from, and the one after the
+        # last, from the states the sub-blocks leave and the first state
+        blocks = -(-block_frames // m)
+        system_m = powers[m]
+        system_powers = [numpy.eye(2)]
+        for n in range(blocks):
+            system_powers.append(system_powers[-1].dot(system_m))
+        self.__carry = numpy.zeros((2 * blocks + 2, 2 * blocks))
+        self.__start = numpy.zeros((2 * blocks + 2, 2))
+        for j in range(blocks + 1):
+            self.__start[2 * j:2 * j + 2] = system_powers[j]
+            for i in range(j):
+                self.__carry[2 * j:2 * j + 2, 2 * i:2 * i + 2] = \
+                    system_powers[j - 1 - i]
+
+        self.__blocks = blocks
+        self.__state = numpy.zeros((2, channels))
+        self.__left = numpy.empty((blocks, 2, channels))
+        self.__states = numpy.empty((2 * blocks + 2, channels))
+        self.__started = numpy.empty((2 * blocks + 2, channels))
+        self.__from_state = numpy.empty((blocks, m, channels))
+        self.__out = numpy.empty((blocks * m, channels))
+        self.__rest_state = numpy.empty((2, channels))
+        self.__rest_input = numpy.empty((2, channels))
+
+    def reset(self):
+        self.__state[...] = 0.0
+
+    # Filter float64 samples, shape (frames, channels) with frames no more
+    # than block_frames. Returns a buffer of the stage that is only valid
+    # until the next call.
+    def process(self, samples):
+        m = self.__sub_frames
+        frames = len(samples)
+        blocks = frames // m
+        whole = blocks * m
+        out = self.__out[:frames]
+        state = self.__state
+        if blocks:
+            channels = samples.shape[1]
+            x = samples[:whole].reshape(blocks, m, channels)
+            y = out[:whole].reshape(blocks, m, channels)
+            numpy.matmul(self.__zero_state, x, out=y)
+            left = self.__left[:blocks]
+            numpy.matmul(self.__state_in, x, out=left)
+            if blocks == self.__blocks:
+                carry = self.__carry
+                start = self.__start
+            else:
+                # only ever the last period of a sound
+                carry = numpy.ascontiguousarray(self.__carry[:2 * blocks + 2,
+                                                             :2 * blocks])
+                start = self.__start[:2 * blocks + 2]
+            states = self.__states[:2 * blocks + 2]
+            started = self.__started[:2 * blocks + 2]
+            numpy.matmul(carry, left.reshape(2 * blocks, channels), out=states)
+            numpy.matmul(start, state, out=started)
+            states += started
+            from_state = self.__from_state[:blocks]
+            numpy.matmul(self.__state_out,
+                         states[:2 * blocks].reshape(blocks, 2, channels),
+                         out=from_state)
+            y += from_state
+            state[...] = states[2 * blocks:]
+
+        rest = frames - whole
+        if rest:
+            # the frames after the last whole sub-block, at the end of a
+            # sound
+            x = samples[whole:]
+            y = out[whole:]
+            numpy.matmul(self.__zero_state[:rest, :rest], x, out=y)
+            y += self.__state_out[:rest].dot(state)
+            numpy.matmul(self.__powers[rest], state, out=self.__rest_state)
+            numpy.matmul(self.__state_in[:, m - rest:], x, out=self.__rest_input)
+            numpy.add(self.__rest_state, self.__rest_input, out=state)
+        return out
+
+
+# Class definition for the look-ahead peak limiter stage. It holds the
+# samples back for the look-ahead time, so the gain can already be coming
+# down when a peak arrives, and no sample leaves above the threshold:
+#
+#   the gain each frame needs is the threshold over its peak (the larger
+#   of its channels, so the stereo image does not shift), or 1,
+#   each frame takes the least of the gains needed over the look-ahead
+#   time from it,
+#   which is averaged over the look-ahead time before it, so the gain
+#   glides down to each peak rather than jumping, and still reaches the
+#   gain the peak needs when it gets there,
+#   and the gain comes back up no faster than the release time allows, in
+#   equal steps of dB.
+#
+# Each step is done on a whole period with numpy: the least over a window
+# by doubling windows, the average by a running sum and the release by a
+# running least. Every step writes into buffers the stage keeps.
+class LimiterStage(object):
+
+    def __init__(self, threshold_db=LIMITER_THRESHOLD_DB_DEFAULT,
+                 lookahead_ms=LIMITER_LOOKAHEAD_MS_DEFAULT,
+                 release_ms=LIMITER_RELEASE_MS_DEFAULT,
+                 channels=ALSA_PCM_CHANNELS, block_frames=ALSA_PERIOD_FRAMES,
+                 rate=ALSA_PCM_RATE):
+        self.name = DSP_LIMITER
+        self.__threshold = 32768.0 * 10.0 ** (threshold_db / 20.0)
+        lookahead = max(1, int(round(lookahead_ms * rate / 1000.0)))
+        self.latency = lookahead
+        self.__lookahead = lookahead
+        self.__release_step = LIMITER_RELEASE_DB / max(1.0, release_ms * rate / 1000.0)
+        size = lookahead + block_frames
+        # the frames held back and those of this period
+        self.__delayed = numpy.zeros((size, channels))
+        # the gains of the frames before this period, for the average
+        self.__held = numpy.ones(lookahead + block_frames)
+        self.__gain_db = 0.0
+        self.__magnitudes = numpy.empty((size, channels))
+        self.__needed = numpy.empty(size)
+        self.__window = numpy.empty(size)
+        self.__sums = numpy.empty(size + 1)
+        self.__gains = numpy.empty(block_frames)
+        self.__ramp = self.__release_step * numpy.arange(block_frames)
+        self.__out = numpy.empty((block_frames, channels))
+        self.__delayed_carry = numpy.empty((lookahead, channels))
+        self.__held_carry = numpy.empty(lookahead)
+
+    def reset(self):
+        self.__delayed[...] = 0.0
+        self.__held[...] = 1.0
+        self.__gain_db = 0.0
+
+    def process(self, samples):
+        lookahead = self.__lookahead
+        frames = len(samples)
+        size = lookahead + frames
+        delayed = self.__delayed[:size]
+        delayed[lookahead:] = samples
+
+        # the gain each frame needs
+        magnitudes = self.__magnitudes[:size]
+        numpy.abs(delayed, out=magnitudes)
+        needed = self.__needed[:size]
+        numpy.max(magnitudes, axis=1, out=needed)
+        numpy.maximum(needed, self.__threshold, out=needed)
+        numpy.divide(self.__threshold, needed, out=needed)
+
+        # the least of them over the look-ahead time from each frame, each
+        # pass doubling the window, from one buffer to the other so numpy
+        # never has to copy for overlapping operands
+        window = needed
+        spare = self.__window[:size]
+        span = 1
+        while span < lookahead + 1:
+            step = min(span, lookahead + 1 - span)
+            numpy.minimum(window[:size - step], window[step:], out=spare[:size - step])
+            window, spare = spare, window
+            span += step
+        held = self.__held[:size]
+        held[lookahead:] = window[:frames]
+
+        # averaged over the look-ahead time before each frame
+        sums = self.__sums[:size + 1]
+        sums[0] = 0.0
+        numpy.cumsum(held, out=sums[1:])
+        gains = self.__gains[:frames]
+        numpy.subtract(sums[lookahead + 1:], sums[:frames], out=gains)
+        gains /= lookahead + 1
+
+        # coming back up no faster than the release allows
+        numpy.log10(gains, out=gains)
+        gains *= 20.0
+        ramp = self.__ramp[:frames]
+        gains -= ramp
+        numpy.minimum.accumulate(gains, out=gains)
+        numpy.minimum(gains, self.__gain_db + self.__release_step, out=gains)
+        gains += ramp
+        self.__gain_db = gains[-1]
+        gains /= 20.0
+        numpy.power(10.0, gains, out=gains)
+
+        # a channel at a time: broadcast over the channels, numpy would copy
+        # the samples into a buffer of its own
+        out = self.__out[:frames]
+        for channel in range(out.shape[1]):
+            numpy.multiply(delayed[:frames, channel], gains, out=out[:, channel])
+
+        # keep the frames held back, and the gains the average needs
+        self.__delayed_carry[...] = delayed[frames:size]
+        delayed[:lookahead] = self.__delayed_carry
+        self.__held_carry[...] = held[frames:size]
+        held[:lookahead] = self.__held_carry
+        return out
+
+
+# Make the stage a setting of soundbox.ini asks for. settings is a tuple
+# (kind, frequency, q, gain_db) for a biquad or (kind, threshold_db,
+# lookahead_ms, release_ms) for the limiter.
+def make_dsp_stage(settings, block_frames=ALSA_PERIOD_FRAMES):
+    kind = settings[0]
+    if kind == DSP_LIMITER:
+        return LimiterStage(settings[1], settings[2], settings[3],
+                            block_frames=block_frames)
+    b, a = biquad_coefficients(kind, settings[1], settings[2], settings[3])
+    return BiquadStage(kind, b, a, block_frames=block_frames)
+
+
+# Class definition for the DSP chain of the playback path, between the
+# gain stage and the sound device. Each period is converted once to
+# float64, goes through the stages in order, and is clipped back to int16,
+# all in buffers kept from one period to the next. The time each stage
+# takes is measured, so it can be checked against the time a period takes
+# to play.
+#
+# The chain is reset when a new sound starts or a sound is moved, so
+# nothing of the old one rings on. A limiter holds samples back; flush()
+# returns them at the end of a sound.
+class DSPChain(object):
+
+    def __init__(self, stage_settings, block_frames=ALSA_PERIOD_FRAMES,
+                 channels=ALSA_PCM_CHANNELS):
+        self.__block_frames = block_frames
+        self.__stages = [make_dsp_stage(settings, block_frames)
+                         for settings in stage_settings]
+        self.__work = numpy.empty((block_frames, channels))
+        self.__out = numpy.empty((block_frames, channels), numpy.int16)
+        self.__silence = numpy.zeros((block_frames, channels), numpy.float32)
+        self.__periods = [0] * len(self.__stages)
+        self.__seconds = [0.0] * len(self.__stages)
+        self.__slowest = [0.0] * len(self.__stages)
+        self.__latency = sum(stage.latency for stage in self.__stages)
+
+    def reset(self):
+        for stage in self.__stages:
+            stage.reset()
+
+    # Frames the chain holds back
+    def latency(self):
+        return self.__latency
+
+    # Process samples (int16 or float32), shape (frames, channels). Returns
+    # int16 samples in a buffer of the chain that is only valid until the
+    # next call.
+    def process(self, samples):
+        frames = len(samples)
+        if frames > len(self.__out):
+            self.__out = numpy.empty((frames, samples.shape[1]), numpy.int16)
+        for start in range(0, frames, self.__block_frames):
+            block = samples[start:start + self.__block_frames]
+            self.__process_block(block, self.__out[start:start + len(block)])
+        return self.__out[:frames]
+
+    def __process_block(self, samples, out):
+        x = self.__work[:len(samples)]
+        x[...] = samples
+        for number, stage in enumerate(self.__stages):
+            started = time.perf_counter()
+            x = stage.process(x)
+            seconds = time.perf_counter() - started
+            self.__periods[number] += 1
+            self.__seconds[number] += seconds
+            if seconds > self.__slowest[number]:
+                self.__slowest[number] = seconds
+        numpy.clip(x, -32768, 32767, out=x)
+        numpy.copyto(out, x, casting='unsafe')
+
+    # The samples held back at the end of a sound, None if there are none
+    def flush(self):
+        if self.__latency == 0:
+            return None
+        return self.process(self.__silence[:self.__latency])
+
+    # Time each stage takes per period: mean and slowest in microseconds,
+    # and the share (percent) of a period's playing time the whole chain
+    # takes on average
+    def stats(self):
+        period_us = 1e6 * self.__block_frames / ALSA_PCM_RATE
+        stages = []
+        total_us = 0.0
+        for number, stage in enumerate(self.__stages):
+            periods = self.__periods[number]
+            mean_us = 1e6 * self.__seconds[number] / periods if periods else 0.0
+            total_us += mean_us
+            stages.append({'stage': stage.name, 'periods': periods,
+                           'mean_us': round(mean_us, 1),
+                           'max_us': round(1e6 * self.__slowest[number], 1)})
+        return {'stages': stages, 'period_us': round(period_us, 1),
+                'budget_percent': round(100.0 * total_us / period_us, 2)}
@@ -0,0 +1,31 @@
+import time
+
+# The eye sees brightness roughly as duty cycle to the power 1/2.2, so a
+# fade that steps the duty cycle evenly seems to rush up and then stall.
+# Fade tables step evenly in perceived brightness instead.
+LED_GAMMA = 2.2
+
+_fade_tables = {}
+
+
+# Duty cycles (0 to 100) for a fade from dark to fully lit in a number of
+# steps. Entry 0 is dark and entry 'steps' is fully lit; a fade down reads
+# the table backwards. Tables are computed once per length and reused.
+# Duty cycles are rounded to a tenth of a percent, so steps too small to
+# see come out equal and need not be written.
+def fade_table(steps):
+    table = _fade_tables.get(steps)
+    if table is None:
+        table = tuple(round(100.0 * (step / float(steps)) ** LED_GAMMA, 1)
+                      for step in range(steps + 1))
+        _fade_tables[steps] = table
+    return table
+
+
+# Sleep until an absolute time on the monotonic clock. Timing a sequence of
+# steps against deadlines fixed from its start, rather than sleeping a
+# fixed time per step, keeps time lost to a slow step from adding up.
+def sleep_until(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
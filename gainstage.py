@@ -0,0 +1,162 @@
+import math
+import threading
+
+import numpy
+
+from globaldefs import *
+
+# Shapes of the ramp from one gain to the next. An exponential ramp changes
+# the gain by the same number of dB each frame, which sounds even for
+# volume changes; a linear ramp changes it by the same amount each frame.
+GAIN_RAMP_LINEAR = 'linear'
+GAIN_RAMP_EXPONENTIAL = 'exponential'
+GAIN_RAMP_CURVES = (GAIN_RAMP_LINEAR, GAIN_RAMP_EXPONENTIAL)
+
+# Default length of a ramp, long enough that a change of gain does not
+# click and short enough to sound immediate
+GAIN_RAMP_MS = 30
+
+# An exponential ramp cannot start or end at silence. Below this gain
+# (-80 dB) it runs from or to this instead, and lands on the gain asked
+# for with its last frame.
+GAIN_FLOOR = 1e-4
+
+# Software volume. 100 percent is full gain, each percent less lowers the
+# gain by SOFTWARE_VOLUME_RANGE_DB / 100 dB, and 0 percent is silence.
+SOFTWARE_VOLUME_RANGE_DB = 60.0
+SOFTWARE_VOLUME_DEFAULT = 100
+
+
+# Convert a volume in percent to a linear gain factor
+def percent_to_gain(percent):
+    if percent <= 0:
+        return 0.0
+    percent = min(100, percent)
+    return 10.0 ** ((percent - 100) * SOFTWARE_VOLUME_RANGE_DB / 100.0 / 20.0)
+
+
+# Class definition for the gain stage of the playback path. It scales each
+# buffer of int16 samples by a gain, clipping anything that overflows.
+# When the gain is changed it does not jump: it ramps to the new gain over
+# ramp_ms, frame by frame, and the ramp carries on across buffers, so the
+# gain reaches its target on the same frame however the samples are cut
+# into buffers.
+#
+# The scaling is a few vectorized numpy operations into buffers that are
+# kept from one call to the next, so a period costs no allocations and
+# far less time than it takes to play. set_gain() may be called from any
+# thread; process() is called by the playback thread only.
+class GainStage(object):
+
+    def __init__(self, gain=1.0, ramp_ms=GAIN_RAMP_MS,
+                 curve=GAIN_RAMP_EXPONENTIAL, rate=ALSA_PCM_RATE):
+        self.__lock = threading.Lock()
+        self.__rate = rate
+        self.__ramp_ms = ramp_ms
+        self.__curve = curve
+        # gain of the next frame to be processed, the gain it ramps to,
+        # the frames left in the ramp, and the change per frame (added for
+        # a linear ramp, the log of the factor for an exponential one)
+        self.__gain = float(gain)
+        self.__target = float(gain)
+        self.__ramp_frames = 0
+        self.__ramp_curve = curve
+        self.__ramp_step = 0.0
+        self.__allocate(0)
+
+    def __allocate(self, frames):
+        self.__index = numpy.arange(frames, dtype=numpy.float32)
+        self.__gains = numpy.empty(frames, numpy.float32)
+        self.__scaled = numpy.empty((frames, ALSA_PCM_CHANNELS), numpy.float32)
+        self.__out = numpy.empty((frames, ALSA_PCM_CHANNELS), numpy.int16)
+
+    # The gain asked for last
+    def target(self):
+        with self.__lock:
+            return self.__target
+
+    def is_ramping(self):
+        with self.__lock:
+            return self.__ramp_frames > 0
+
+    # Ramp to gain over ramp_ms (the stage's default if None, 0 to jump
+    # there), starting from wherever the gain is now, even mid-ramp
+    def set_gain(self, gain, ramp_ms=None, curve=None):
+        gain = float(gain)
+        if ramp_ms is None:
+            ramp_ms = self.__ramp_ms
+        if curve is None:
+            curve = self.__curve
+        frames = int(round(ramp_ms * self.__rate / 1000.0))
+        with self.__lock:
+            self.__target = gain
+            if frames <= 0 or gain == self.__gain:
+                self.__gain = gain
+                self.__ramp_frames = 0
+                return
+            if curve == GAIN_RAMP_EXPONENTIAL:
+                start = max(self.__gain, GAIN_FLOOR)
+                self.__gain = start
+                self.__ramp_step = math.log(max(gain, GAIN_FLOOR) / start) / frames
+            else:
+                self.__ramp_step = (gain - self.__gain) / frames
+            self.__ramp_curve = curve
+            self.__ramp_frames = frames
+
+    # Scale samples, shape (frames, ALSA_PCM_CHANNELS). Returns samples
+    # themselves at unity gain, else a buffer of the stage that is only
+    # valid until the next call.
+    def process(self, samples):
+        scaled = self.scale(samples)
+        if scaled is samples:
+            return samples
+        frames = len(samples)
+        out = self.__out[:frames]
+        numpy.clip(scaled, -32768, 32767, out=scaled)
+        out[...] = scaled
+        return out
+
+    # Scale samples as process() does, but into float32 samples that are
+    # not clipped, for a DSP chain to take on from. Returns samples
+    # themselves at unity gain.
+    def scale(self, samples):
+        frames = len(samples)
+        with self.__lock:
+            start = self.__gain
+            ramp = min(frames, self.__ramp_frames)
+            step = self.__ramp_step
+            curve = self.__ramp_curve
+            target = self.__target
+            if ramp > 0:
+                self.__ramp_frames -= ramp
+                if self.__ramp_frames == 0:
+                    self.__gain = target
+                elif curve == GAIN_RAMP_EXPONENTIAL:
+                    self.__gain = start * math.exp(step * ramp)
+                else:
+                    self.__gain = start + step * ramp
+
+        if ramp == 0:
+            if start == 1.0:
+                return samples
+            gains = numpy.float32(start)
+        else:
+            if frames > len(self.__index):
+                self.__allocate(frames)
+            gains = self.__gains[:frames]
+            ramp_gains = gains[:ramp]
+            numpy.multiply(self.__index[:ramp], numpy.float32(step), out=ramp_gains)
+            if curve == GAIN_RAMP_EXPONENTIAL:
+                numpy.exp(ramp_gains, out=ramp_gains)
+                ramp_gains *= numpy.float32(start)
+            else:
+                ramp_gains += numpy.float32(start)
+            # frames after the end of the ramp are at the target
+            gains[ramp:] = target
+            gains = gains[:, numpy.newaxis]
+
+        if frames > len(self.__out):
+            self.__allocate(frames)
+        scaled = self.__scaled[:frames]
+        numpy.multiply(samples, gains, out=scaled)
+        return scaled
@@ -0,0 +1,325 @@
+from gpiobackend import GPIO
+from threading import Thread
+from threading import Condition
+
+from globaldefs import *
+from platformdefs import *
+
+# Kinds of gestures reported by the GestureRecognizer
+GESTURE_PRESS = 'press'
+GESTURE_CLICK = 'click'
+GESTURE_DOUBLE_CLICK = 'double click'
+GESTURE_LONG_PRESS = 'long press'
+GESTURE_HOLD_REPEAT = 'hold repeat'
+GESTURE_MENU_HOLD = 'menu hold'
+
+# Default gesture timing, in milliseconds. soundbox.ini can change these in
+# its [gestures] section.
+GESTURE_DEBOUNCE_MS = 20
+GESTURE_DOUBLE_CLICK_MS = 300
+GESTURE_LONG_PRESS_MS = 1000
+GESTURE_HOLD_REPEAT_MS = 500
+GESTURE_MENU_HOLD_MS = 2000
+
+
+# Class definition for the timing of gestures, given in milliseconds and
+# kept in seconds
+#   debounce: a pin must hold its new level this long before the change
+#             counts; changes back within it are switch bounce
+#   double_click: a second press starting this soon after a click makes a
+#                 double click (0 turns double clicks off)
+#   long_press: holding a press this long makes it a long press
+#   hold_repeat: after a long press, a hold repeat is reported each time
+#                the press is held this much longer (0 turns repeats off)
+#   menu_hold: holding the command switch this long while no sound plays
+#              opens the shutdown menu
+class GestureTiming(object):
+
+    def __init__(self, debounce_ms=GESTURE_DEBOUNCE_MS,
+                 double_click_ms=GESTURE_DOUBLE_CLICK_MS,
+                 long_press_ms=GESTURE_LONG_PRESS_MS,
+                 hold_repeat_ms=GESTURE_HOLD_REPEAT_MS,
+                 menu_hold_ms=GESTURE_MENU_HOLD_MS):
+        self.debounce = debounce_ms / 1000.0
+        self.double_click = double_click_ms / 1000.0
+        self.long_press = long_press_ms / 1000.0
+        self.hold_repeat = hold_repeat_ms / 1000.0
+        self.menu_hold = menu_hold_ms / 1000.0
+
+
+# One gesture on one pin. started is when the press that began the gesture
+# went down (the first press of a double click), time is when the gesture
+# was recognized, and count numbers the hold repeats of a press.
+class Gesture(object):
+
+    def __init__(self, channel, kind, started, time, count=0):
+        self.channel = channel
+        self.kind = kind
+        self.started = started
+        self.time = time
+        self.count = count
+
+    # How long the press had been held when the gesture was recognized
+    def held(self):
+        return self.time - self.started
+
+
+# The state of one watched pin
+class PinGestures(object):
+
+    def __init__(self, channel, pressed_level, callback, exclusive_double_click):
+        self.channel = channel
+        self.pressed_level = pressed_level
+        self.callback = callback
+        self.exclusive_double_click = exclusive_double_click
+        # debounced state of the pin and when it last changed
+        self.pressed = False
+        self.changed_at = None
+        self.recheck_at = None
+        # the press being held
+        self.press_started = None
+        self.hold_at = None
+        self.hold_count = 0
+        self.menu_at = None
+        # a click that a second press may still turn into a double click
+        self.click_started = None
+        self.click_window_end = None
+        self.in_double_click = False
+
+
+# Class definition for the gesture recognizer. It watches pins for both
+# edges and works out gestures from when the edges happened, using the
+# edge times of the GPIO backend where it has them:
+#
+#   press: the press went down (reported at once, for instant response)
+#   click: the press came up before it became a long press
+#   double click: a second click started within the double click time
+#   long press: the press was held for the long press time
+#   hold repeat: the long press is still held, repeated at an interval
+#   menu hold: the press was held for the menu hold time, on a deadline
+#              of its own whatever the long press and repeat times are
+#
+# An edge is handled in the time it takes to compare it with the last
+# one; nothing ever sleeps on the GPIO callback thread. Gestures that are
+# recognized by time passing rather than by an edge (long press, hold
+# repeat, menu hold, the end of the double click time and the end of the debounce
+# time) are reported by a timer thread that sleeps until the next of them
+# is due, and not at all while no pin is pressed.
+#
+# By default a click is reported as soon as the press comes up, and a
+# double click is reported after the click of its first press. A pin
+# watched with exclusive_double_click holds back a click until the double
+# click time has passed, so it gets either a click or a double click.
+#
+# Created with threaded=False there is no timer thread; whoever drives the
+# recognizer instead (the asyncio runtime) calls step() when the time it
+# returned comes or when the waker set with set_waker() is called.
+class GestureRecognizer(object):
+
+    def __init__(self, timing=None, threaded=True):
+        self.__timing = timing if timing is not None else GestureTiming()
+        self.__pins = {}
+        self.__changed = Condition()
+        self.__waker = None
+        if threaded:
+            self.__thread = Thread(target=self.__run, name='gesture-timer')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def timing(self):
+        return self.__timing
+
+    # Time gestures from now on by other settings, e.g. when soundbox.ini
+    # is reloaded. Deadlines already set keep the timing they were set by.
+    def set_timing(self, timing):
+        with self.__changed:
+            self.__timing = timing
+            self.__wake_locked()
+
+    # Start recognizing gestures on a pin. pressed_level is the level of
+    # the pin while pressed. callback(gesture) is called for each gesture,
+    # on a GPIO or timer thread (or the thread calling step()), so it must
+    # return quickly.
+    def watch(self, channel, pressed_level, callback,
+              exclusive_double_click=False):
+        pin = PinGestures(channel, pressed_level, callback, exclusive_double_click)
+        with self.__changed:
+            pin.pressed = GPIO.input(channel) == pressed_level
+            self.__pins[channel] = pin
+        GPIO.add_event_detect(channel, GPIO.BOTH, callback=self.__edge)
+
+    def unwatch(self, channel):
+        with self.__changed:
+            if self.__pins.pop(channel, None) is None:
+                return
+        GPIO.remove_event_detect(channel)
+
+    def __now(self):
+        return GPIO.monotonic()
+
+    # Called on the GPIO callback thread for every edge. The level is that
+    # of the edge, not of the pin now: an edge handled late, behind a
+    # bounce, would otherwise be taken for one that bounced back, or given
+    # the wrong state.
+    def __edge(self, channel):
+        when = GPIO.edge_time(channel)
+        if when is None:
+            when = self.__now()
+        gestures = []
+        with self.__changed:
+            pin = self.__pins.get(channel)
+            if pin is None:
+                return
+            pressed = GPIO.edge_level(channel) == pin.pressed_level
+            if pressed == pin.pressed:
+                # bounced back to where it was
+                return
+            if pin.changed_at is not None and \
+               when - pin.changed_at < self.__timing.debounce:
+                # too soon after the last change to be trusted. look again
+                # when the debounce time is up, in case this was the last
+                # edge of the bounce.
+                pin.recheck_at = pin.changed_at + self.__timing.debounce
+                self.__wake_locked()
+                return
+            self.__change_locked(pin, pressed, when, gestures)
+            self.__wake_locked()
+        self.__report(gestures)
+
+    # Something new may be due, have the timer look again
+    def __wake_locked(self):
+        self.__changed.notify()
+        if self.__waker is not None:
+            self.__waker()
+
+    # Have waker() called, from any thread, whenever step() should be
+    # called before the time it last returned
+    def set_waker(self, waker):
+        with self.__changed:
+            self.__waker = waker
+
+    # The debounced state of a pin changed
+    def __change_locked(self, pin, pressed, when, gestures):
+        timing = self.__timing
+        pin.pressed = pressed
+        pin.changed_at = when
+        pin.recheck_at = None
+        if pressed:
+            if pin.click_window_end is not None and when > pin.click_window_end:
+                # too late for a double click
+                self.__end_click_window(pin, gestures)
+            pin.press_started = when
+            pin.hold_at = when + timing.long_press
+            pin.hold_count = 0
+            pin.menu_at = when + timing.menu_hold
+            pin.in_double_click = pin.click_window_end is not None and \
+                                  when <= pin.click_window_end
+            gestures.append(Gesture(pin.channel, GESTURE_PRESS, when, when))
+            return
+
+        pin.hold_at = None
+        pin.menu_at = None
+        if pin.hold_count > 0:
+            # the end of a long press, already reported
+            self.__end_click_window(pin, gestures)
+            return
+        if pin.in_double_click:
+            gestures.append(Gesture(pin.channel, GESTURE_DOUBLE_CLICK,
+                                    pin.click_started, when))
+            pin.in_double_click = False
+            pin.click_started = None
+            pin.click_window_end = None
+            return
+        if not pin.exclusive_double_click or timing.double_click <= 0:
+            gestures.append(Gesture(pin.channel, GESTURE_CLICK,
+                                    pin.press_started, when))
+        if timing.double_click > 0:
+            pin.click_started = pin.press_started
+            pin.click_window_end = when + timing.double_click
+        else:
+            pin.click_started = None
+            pin.click_window_end = None
+
+    # The click before a press can no longer become a double click. A pin
+    # with exclusive double clicks now gets the click held back for it.
+    def __end_click_window(self, pin, gestures):
+        if pin.click_started is not None and pin.exclusive_double_click:
+            gestures.append(Gesture(pin.channel, GESTURE_CLICK,
+                                    pin.click_started, pin.click_window_end))
+        pin.click_started = None
+        pin.click_window_end = None
+        pin.in_double_click = False
+
+    # Report what has become due by the time now. Returns the time the
+    # next thing is due, or None if nothing is waiting to happen.
+    def __due_locked(self, now, gestures):
+        timing = self.__timing
+        next_due = None
+        for pin in list(self.__pins.values()):
+            if pin.recheck_at is not None and pin.recheck_at <= now:
+                pressed = GPIO.input(pin.channel) == pin.pressed_level
+                recheck_at, pin.recheck_at = pin.recheck_at, None
+                if pressed != pin.pressed:
+                    self.__change_locked(pin, pressed, recheck_at, gestures)
+
+            if pin.hold_at is not None and pin.hold_at <= now:
+                if pin.hold_count == 0:
+                    if pin.in_double_click:
+                        # the second press was held, the first was a click
+                        self.__end_click_window(pin, gestures)
+                    gestures.append(Gesture(pin.channel, GESTURE_LONG_PRESS,
+                                            pin.press_started, pin.hold_at))
+                else:
+                    gestures.append(Gesture(pin.channel, GESTURE_HOLD_REPEAT,
+                                            pin.press_started, pin.hold_at,
+                                            pin.hold_count))
+                pin.hold_count += 1
+                if timing.hold_repeat > 0:
+                    pin.hold_at += timing.hold_repeat
+                else:
+                    pin.hold_at = None
+
+            if pin.menu_at is not None and pin.menu_at <= now:
+                gestures.append(Gesture(pin.channel, GESTURE_MENU_HOLD,
+                                        pin.press_started, pin.menu_at))
+                pin.menu_at = None
+
+            if pin.click_window_end is not None and pin.click_window_end <= now \
+               and not pin.in_double_click:
+                self.__end_click_window(pin, gestures)
+
+            for due in (pin.recheck_at, pin.hold_at, pin.menu_at,
+                        None if pin.in_double_click else pin.click_window_end):
+                if due is not None and (next_due is None or due < next_due):
+                    next_due = due
+        return next_due
+
+    def __report(self, gestures):
+        for gesture in gestures:
+            pin = self.__pins.get(gesture.channel)
+            if pin is not None:
+                pin.callback(gesture)
+
+    # Report the gestures that are due now. Returns the time (GPIO clock)
+    # the next one is due, or None if nothing is waiting to happen.
+    def step(self):
+        gestures = []
+        with self.__changed:
+            next_due = self.__due_locked(self.__now(), gestures)
+        self.__report(gestures)
+        return next_due
+
+    def __run(self):
+        while True:
+            gestures = []
+            with self.__changed:
+                next_due = self.__due_locked(self.__now(), gestures)
+                if not gestures:
+                    if next_due is None:
+                        self.__changed.wait()
+                    else:
+                        remaining = next_due - self.__now()
+                        if remaining > 0:
+                            self.__changed.wait(remaining)
+                    continue
+            self.__report(gestures)
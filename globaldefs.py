@@ -1,4 +1,4 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 from platformdefs import *
 
 # Command param signifying that a command pertains to ALL eligible entities
@@ -11,17 +11,19 @@ ALSA_DEVICE_NAME = 'default'
 # ALSA mixer name
 ALSA_MIXER_NAME = 'PCM'
 
+# Sample format written to the ALSA sound device. These match the dmix
+# slave settings in /etc/asound.conf, so samples pass through unconverted.
+ALSA_PCM_RATE = 44100
+ALSA_PCM_CHANNELS = 2
+ALSA_PERIOD_FRAMES = 1024
+
 # For convenience, make tuples for buttons and LEDs
 buttons = (BUTTON_WHITE, BUTTON_BLUE, BUTTON_GREEN, BUTTON_YELLOW, BUTTON_RED)
 leds = (LED_WHITE, LED_BLUE, LED_GREEN, LED_YELLOW, LED_RED)
 
 # Let there NOT be light.
 def turnoff_all_leds():
-    GPIO.output(LED_WHITE, GPIO.LOW)
-    GPIO.output(LED_BLUE, GPIO.LOW)
-    GPIO.output(LED_GREEN, GPIO.LOW)
-    GPIO.output(LED_YELLOW, GPIO.LOW)
-    GPIO.output(LED_RED, GPIO.LOW)
+    GPIO.output_many(dict((led_id, GPIO.LOW) for led_id in leds))
 
 
 
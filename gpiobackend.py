@@ -0,0 +1,221 @@
+import os
+import time
+import threading
+
+# Symbolic 'constants' shared by all GPIO backends. The values are those of
+# RPi.GPIO, so that backend can pass them straight through.
+HIGH = 1
+LOW = 0
+OUT = 0
+IN = 1
+BCM = 11
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+# Environment variable that overrides the backend chosen in soundbox.ini
+GPIO_BACKEND_ENV = 'SOUNDBOX_GPIO_BACKEND'
+GPIO_BACKEND_DEFAULT = 'rpi'
+
+
+# Base class for a GPIO backend. The calls are those of RPi.GPIO that
+# soundbox uses, plus batched reads and writes and edge timestamps, which
+# backends implement as efficiently as the hardware interface allows.
+# Channels are always BCM pin numbers.
+class GPIOBackend(object):
+
+    name = 'none'
+
+    def setmode(self, mode):
+        if mode != BCM:
+            raise ValueError('only BCM pin numbering is supported')
+
+    def setup(self, channels, direction, pull_up_down=PUD_OFF):
+        raise NotImplementedError
+
+    def input(self, channel):
+        raise NotImplementedError
+
+    def output(self, channels, values):
+        raise NotImplementedError
+
+    # Read several channels at once, returns their levels in order
+    def input_many(self, channels):
+        return tuple(self.input(channel) for channel in channels)
+
+    # Write several channels at once, given a {channel: level} dict
+    def output_many(self, levels):
+        for channel, level in levels.items():
+            self.output(channel, level)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        raise NotImplementedError
+
+    def remove_event_detect(self, channel):
+        raise NotImplementedError
+
+    # Monotonic time (seconds) of the last edge detected on a channel
+    def edge_time(self, channel):
+        raise NotImplementedError
+
+    # Level a channel changed to at the edge its callback is called for.
+    # Backends that queue edges report the level of each edge, so a
+    # callback that runs late still sees the edges in the order they came;
+    # others read the pin as it is now.
+    def edge_level(self, channel):
+        return self.input(channel)
+
+    # Block until an edge is seen, returns the channel, or None if timeout
+    # (in milliseconds, as for RPi.GPIO) runs out first
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        seen = threading.Event()
+        self.add_event_detect(channel, edge, lambda ch: seen.set(), bouncetime)
+        try:
+            if seen.wait(None if timeout is None else timeout / 1000.0):
+                return channel
+            return None
+        finally:
+            self.remove_event_detect(channel)
+
+    def PWM(self, channel, frequency):
+        return SoftwarePWM(self, channel, frequency)
+
+    # The clock edge times are measured on
+    def monotonic(self):
+        return time.monotonic()
+
+    def cleanup(self):
+        pass
+
+
+# Pulse-width modulation done by a thread switching an output on and off,
+# for backends without PWM of their own. It has the calls of RPi.GPIO.PWM.
+class SoftwarePWM(object):
+
+    def __init__(self, backend, channel, frequency):
+        self.__backend = backend
+        self.__channel = channel
+        self.__period = 1.0 / frequency
+        self.__duty_cycle = 0.0
+        self.__running = False
+        self.__changed = threading.Condition()
+        self.__thread = None
+
+    def start(self, duty_cycle):
+        with self.__changed:
+            self.__duty_cycle = duty_cycle
+            if not self.__running:
+                self.__running = True
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name='software-pwm')
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def ChangeDutyCycle(self, duty_cycle):
+        with self.__changed:
+            self.__duty_cycle = duty_cycle
+            self.__changed.notify()
+
+    def ChangeFrequency(self, frequency):
+        with self.__changed:
+            self.__period = 1.0 / frequency
+
+    def stop(self):
+        with self.__changed:
+            self.__running = False
+            self.__changed.notify()
+        if self.__thread is not None:
+            self.__thread.join(1.0)
+            self.__thread = None
+        self.__backend.output(self.__channel, LOW)
+
+    def __run(self):
+        deadline = time.monotonic()
+        while True:
+            with self.__changed:
+                if not self.__running:
+                    return
+                on_time = self.__period * self.__duty_cycle / 100.0
+                period = self.__period
+            if on_time > 0:
+                self.__backend.output(self.__channel, HIGH)
+                deadline += on_time
+                time.sleep(max(0.0, deadline - time.monotonic()))
+            if on_time < period:
+                self.__backend.output(self.__channel, LOW)
+                deadline += period - on_time
+                time.sleep(max(0.0, deadline - time.monotonic()))
+
+
+_gpio_backend = None
+_gpio_backend_lock = threading.Lock()
+
+
+# Create a backend by name: 'rpi', 'gpiod' or 'simulated'
+def create_gpio_backend(name):
+    if name == 'rpi':
+        from rpigpiobackend import RPiGPIOBackend
+        return RPiGPIOBackend()
+    if name == 'gpiod':
+        from gpiodbackend import GpiodBackend
+        return GpiodBackend()
+    if name == 'simulated':
+        from simgpiobackend import SimulatedGPIOBackend
+        return SimulatedGPIOBackend()
+    raise ValueError('unknown GPIO backend: ' + str(name))
+
+
+# Choose the backend used by everything in soundbox. Must be called before
+# the first GPIO call; the environment variable wins over the name given.
+def select_gpio_backend(name):
+    global _gpio_backend
+    name = os.environ.get(GPIO_BACKEND_ENV, name)
+    with _gpio_backend_lock:
+        if _gpio_backend is not None and _gpio_backend.name != name:
+            raise RuntimeError('GPIO backend ' + _gpio_backend.name +
+                               ' is already in use')
+        if _gpio_backend is None:
+            _gpio_backend = create_gpio_backend(name)
+        return _gpio_backend
+
+
+# Use an existing backend object, e.g. a simulated one set up by a
+# benchmark with its own clock
+def set_gpio_backend(backend):
+    global _gpio_backend
+    with _gpio_backend_lock:
+        _gpio_backend = backend
+
+
+def get_gpio_backend():
+    backend = _gpio_backend
+    if backend is None:
+        backend = select_gpio_backend(GPIO_BACKEND_DEFAULT)
+    return backend
+
+
+# Stand-in for the RPi.GPIO module. Modules do 'from gpiobackend import
+# GPIO' and make the same calls as before; each call goes to the selected
+# backend. The constants are available before any backend is chosen.
+class GPIOModule(object):
+
+    HIGH = HIGH
+    LOW = LOW
+    OUT = OUT
+    IN = IN
+    BCM = BCM
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    def __getattr__(self, name):
+        return getattr(get_gpio_backend(), name)
+
+
+GPIO = GPIOModule()
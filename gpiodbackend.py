@@ -0,0 +1,253 @@
+import os
+import time
+import select
+import threading
+
+import gpiod
+
+from gpiobackend import *
+
+# GPIO character device of the Raspberry Pi header pins. Its line offsets
+# are the BCM pin numbers.
+GPIOD_CHIP = 'gpiochip0'
+
+# The version 1 interface has no way to ask for the clock of the edge
+# timestamps: kernels before 5.7 stamp edges with CLOCK_REALTIME, later
+# ones with CLOCK_MONOTONIC. A timestamp further than this (seconds) from
+# the monotonic clock is taken to be on the realtime clock.
+GPIOD_CLOCK_TOLERANCE = 60.0
+
+# Name the lines are requested under, shown by gpioinfo
+GPIOD_CONSUMER = 'soundbox'
+
+
+# GPIO backend using the GPIO character device through the libgpiod
+# (version 1) bindings.
+#
+# Channels set up together are requested from the kernel as one bulk
+# request, so reading or writing all of them is a single system call. Edge
+# events are queued by the kernel with their own timestamps, and a single
+# thread waits on all of them with select(), so no edge is lost while a
+# callback runs, bounces are filtered on the time the edge really
+# happened, and the thread costs nothing while the pins are quiet. There is
+# no PWM in the character device interface; partly lit leds use a software
+# PWM thread.
+class GpiodBackend(GPIOBackend):
+
+    name = 'gpiod'
+
+    def __init__(self, chip_name=GPIOD_CHIP):
+        self.__chip = gpiod.Chip(chip_name)
+        self.__lock = threading.Lock()
+        # channel -> (bulk of lines requested together, index in bulk)
+        self.__requests = {}
+        # id(bulk) -> list of the levels last written to an output bulk
+        self.__output_levels = {}
+        # id(bulk) -> (channels, direction, pull) the bulk was set up with
+        self.__setups = {}
+        self.__pulls = {}
+        # channel -> [edge, callback, bounce seconds, last edge time]
+        self.__detects = {}
+        self.__event_lines = {}
+        self.__edge_times = {}
+        self.__edge_levels = {}
+        self.__wake_read, self.__wake_write = os.pipe()
+        self.__event_thread = None
+
+    def __bias_flag(self, pull_up_down):
+        if pull_up_down == PUD_UP:
+            return getattr(gpiod, 'LINE_REQ_FLAG_BIAS_PULL_UP', 0)
+        if pull_up_down == PUD_DOWN:
+            return getattr(gpiod, 'LINE_REQ_FLAG_BIAS_PULL_DOWN', 0)
+        return 0
+
+    # Request channels as one bulk, keeping what they were set up as so
+    # they can be requested again when some of them are taken for events
+    def __request_locked(self, channels, direction, pull_up_down, levels=None):
+        bulk = self.__chip.get_lines(channels)
+        if direction == OUT:
+            if levels is None:
+                levels = [LOW] * len(channels)
+            bulk.request(consumer=GPIOD_CONSUMER,
+                         type=gpiod.LINE_REQ_DIR_OUT, default_vals=levels)
+            self.__output_levels[id(bulk)] = list(levels)
+        else:
+            bulk.request(consumer=GPIOD_CONSUMER, type=gpiod.LINE_REQ_DIR_IN,
+                         flags=self.__bias_flag(pull_up_down))
+        self.__setups[id(bulk)] = (list(channels), direction, pull_up_down)
+        for index, channel in enumerate(channels):
+            self.__pulls[channel] = pull_up_down
+            self.__requests[channel] = (bulk, index)
+
+    # Release channels. Other channels requested in the same bulk are
+    # requested again as a smaller bulk, outputs keeping their levels.
+    def __release_locked(self, channels):
+        bulks = {}
+        for channel in channels:
+            request = self.__requests.get(channel)
+            if request is not None:
+                bulks[id(request[0])] = request[0]
+        for key, bulk in bulks.items():
+            bulk_channels, direction, pull_up_down = self.__setups.pop(key)
+            levels = self.__output_levels.pop(key, None)
+            bulk.release()
+            kept = [index for index, channel in enumerate(bulk_channels)
+                    if channel not in channels]
+            for channel in bulk_channels:
+                del self.__requests[channel]
+            if kept:
+                self.__request_locked([bulk_channels[index] for index in kept],
+                                      direction, pull_up_down,
+                                      None if levels is None else
+                                      [levels[index] for index in kept])
+
+    def setup(self, channels, direction, pull_up_down=PUD_OFF):
+        if isinstance(channels, int):
+            channels = [channels]
+        channels = list(channels)
+        with self.__lock:
+            self.__release_locked(channels)
+            self.__request_locked(channels, direction, pull_up_down)
+
+    def input(self, channel):
+        line = self.__event_lines.get(channel)
+        if line is not None:
+            return line.get_value()
+        bulk, index = self.__requests[channel]
+        return bulk.get_values()[index]
+
+    def input_many(self, channels):
+        # one read for channels that were set up together
+        requests = [self.__requests.get(channel) for channel in channels]
+        if requests and None not in requests and \
+                all(request[0] is requests[0][0] for request in requests):
+            values = requests[0][0].get_values()
+            return tuple(values[index] for bulk, index in requests)
+        return tuple(self.input(channel) for channel in channels)
+
+    def output(self, channels, values):
+        if isinstance(channels, int):
+            self.output_many({channels: values})
+        elif isinstance(values, int):
+            self.output_many(dict((channel, values) for channel in channels))
+        else:
+            self.output_many(dict(zip(channels, values)))
+
+    def output_many(self, levels):
+        # one write per bulk request, however many of its lines change
+        with self.__lock:
+            bulks = {}
+            for channel, level in levels.items():
+                bulk, index = self.__requests[channel]
+                self.__output_levels[id(bulk)][index] = HIGH if level else LOW
+                bulks[id(bulk)] = bulk
+            for key, bulk in bulks.items():
+                bulk.set_values(self.__output_levels[key])
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.__lock:
+            if channel in self.__detects:
+                raise RuntimeError('Conflicting edge detection already enabled '
+                                   'for this GPIO channel')
+            # edge events need a request of their own for the line
+            self.__release_locked([channel])
+            line = self.__chip.get_line(channel)
+            line.request(consumer=GPIOD_CONSUMER,
+                         type=gpiod.LINE_REQ_EV_BOTH_EDGES,
+                         flags=self.__bias_flag(self.__pulls.get(channel)))
+            bounce = 0.0 if bouncetime is None else bouncetime / 1000.0
+            self.__detects[channel] = [edge, callback, bounce, None]
+            self.__event_lines[channel] = line
+            if self.__event_thread is None:
+                self.__event_thread = threading.Thread(target=self.__watch_edges,
+                                                       name='gpio-events')
+                self.__event_thread.daemon = True
+                self.__event_thread.start()
+        self.__wake_watcher()
+
+    def remove_event_detect(self, channel):
+        with self.__lock:
+            self.__detects.pop(channel, None)
+            line = self.__event_lines.pop(channel, None)
+            if line is not None:
+                line.release()
+                # back to a plain input, as it was set up
+                self.__request_locked([channel], IN,
+                                      self.__pulls.get(channel, PUD_OFF))
+        self.__wake_watcher()
+
+    def edge_time(self, channel):
+        return self.__edge_times.get(channel)
+
+    def edge_level(self, channel):
+        level = self.__edge_levels.get(channel)
+        if level is None:
+            return self.input(channel)
+        return level
+
+    def __wake_watcher(self):
+        os.write(self.__wake_write, b'x')
+
+    def __watch_edges(self):
+        while True:
+            with self.__lock:
+                if self.__chip is None:
+                    return
+                fds = dict((line.event_get_fd(), channel)
+                           for channel, line in self.__event_lines.items())
+            try:
+                ready, _, _ = select.select(list(fds) + [self.__wake_read], [], [])
+            except (OSError, ValueError):
+                # a line was released while select() waited on it. the
+                # wake up that follows the release is still to be read,
+                # so the next select() returns at once with the lines as
+                # they are now.
+                continue
+            for fd in ready:
+                if fd == self.__wake_read:
+                    os.read(self.__wake_read, 64)
+                    continue
+                self.__handle_events(fds[fd], fd)
+
+    def __handle_events(self, channel, fd):
+        with self.__lock:
+            line = self.__event_lines.get(channel)
+            detect = self.__detects.get(channel)
+            # the line may have been released, and its fd number reused,
+            # since select() returned
+            if line is None or detect is None or line.event_get_fd() != fd:
+                return
+            events = line.event_read_multiple()
+        for event in events:
+            edge, callback, bounce, last_time = detect
+            rising = event.type == gpiod.LineEvent.RISING_EDGE
+            if edge == RISING and not rising or edge == FALLING and rising:
+                continue
+            when = self.__event_time(event)
+            if last_time is not None and when - last_time < bounce:
+                continue
+            detect[3] = when
+            self.__edge_times[channel] = when
+            self.__edge_levels[channel] = HIGH if rising else LOW
+            if callback is not None:
+                callback(channel)
+
+    # Kernel timestamp of an edge, on the monotonic clock
+    def __event_time(self, event):
+        when = event.sec + event.nsec / 1e9
+        now = time.monotonic()
+        if abs(when - now) > GPIOD_CLOCK_TOLERANCE:
+            when -= time.time() - now
+        return when
+
+    def cleanup(self):
+        with self.__lock:
+            lines = list(self.__event_lines.values())
+            self.__event_lines = {}
+            self.__detects = {}
+            for line in lines:
+                line.release()
+            self.__release_locked(list(self.__requests))
+            self.__chip.close()
+            self.__chip = None
+        self.__wake_watcher()
@@ -0,0 +1,369 @@
+from gpiobackend import GPIO
+import time
+from threading import Thread
+from threading import Condition
+from threading import Event
+from threading import Lock
+
+from globaldefs import *
+from platformdefs import *
+from fadetable import *
+
+# Frames per second rendered while any led pattern is changing
+LED_FRAME_RATE = 50
+
+# Pulse-width modulation frequency used for leds that are partly lit
+LED_PWM_FREQUENCY = 50
+
+# Layer priorities. Layers with higher priority are drawn over lower ones.
+SCAN_PRIORITY = 0
+PLAYING_PRIORITY = 10
+PAUSE_FLASH_PRIORITY = 20
+MENU_PRIORITY = 30
+PRESSED_PRIORITY = 40
+
+
+def seconds_to_frames(seconds):
+    return max(1, int(round(seconds * LED_FRAME_RATE)))
+
+
+# Base class for a led pattern drawn by the LEDCompositor. Each frame the
+# compositor asks every layer, lowest priority first, to render the levels
+# (0 = dark to 100 = fully lit) of the leds it lights. Leds a layer does
+# not set show whatever the layers below set.
+class LEDLayer(object):
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.__compositor = None
+        self.__start_frame = 0
+        self.__finished = False
+        # a layer that was never added is not on the leds either
+        self.__removed = Event()
+        self.__removed.set()
+
+    # Called by the compositor when the layer is added and removed. The
+    # layer's frames are counted from the first frame it is drawn in.
+    def attach(self, compositor):
+        self.__compositor = compositor
+        self.__start_frame = None
+        self.__removed.clear()
+
+    def detach(self):
+        self.__compositor = None
+        self.__removed.set()
+
+    def start_frame(self, frame):
+        if self.__start_frame is None:
+            self.__start_frame = frame
+        return self.__start_frame
+
+    def is_shown(self):
+        return self.__compositor is not None
+
+    # Wait until the compositor has taken the layer off the leds
+    def wait_removed(self, timeout=None):
+        return self.__removed.wait(timeout)
+
+    # Ask for the layer to be removed at the next frame
+    def finish(self):
+        self.__finished = True
+        self.changed()
+
+    def is_finished(self):
+        return self.__finished
+
+    # Tell the compositor the layer needs drawing again
+    def changed(self):
+        compositor = self.__compositor
+        if compositor is not None:
+            compositor.wake()
+
+    # Set levels for this layer's leds. frame counts from when the layer
+    # was added.
+    def render(self, frame, levels):
+        pass
+
+    # Number of frames from frame until this layer looks different, or
+    # None if it only changes when changed() is called
+    def frames_to_change(self, frame):
+        return None
+
+
+# Layer holding leds at fixed levels until told otherwise
+class SolidLayer(LEDLayer):
+
+    def __init__(self, led_levels, priority):
+        LEDLayer.__init__(self, priority)
+        self.__levels = dict(led_levels)
+
+    def set_level(self, led_id, level):
+        self.__levels[led_id] = level
+        self.changed()
+
+    def set_all(self, level):
+        for led_id in self.__levels:
+            self.__levels[led_id] = level
+        self.changed()
+
+    def render(self, frame, levels):
+        levels.update(self.__levels)
+
+
+# Layer flashing leds on and off, forever or for a number of flashes
+class FlashLayer(LEDLayer):
+
+    def __init__(self, led_ids, half_period_frames, priority,
+                 count=None, start_on=True):
+        LEDLayer.__init__(self, priority)
+        self.__led_ids = led_ids
+        self.__half_period = half_period_frames
+        self.__count = count
+        self.__start_on = start_on
+
+    def render(self, frame, levels):
+        half_periods = frame // self.__half_period
+        if self.__count is not None and half_periods >= 2 * self.__count:
+            self.finish()
+            return
+        lit = (half_periods % 2 == 0) == self.__start_on
+        for led_id in self.__led_ids:
+            levels[led_id] = 100 if lit else 0
+
+    def frames_to_change(self, frame):
+        return self.__half_period - frame % self.__half_period
+
+
+# Layer lighting leds one after another in a repeating sequence. While
+# is_paused() returns True the layer lights nothing. When it resumes it
+# starts from resume_led if one was set, else where it left off.
+class ScanLayer(LEDLayer):
+
+    def __init__(self, sequence, step_frames, is_paused, priority=SCAN_PRIORITY):
+        LEDLayer.__init__(self, priority)
+        self.__sequence = sequence
+        self.__step_frames = step_frames
+        self.__is_paused = is_paused
+        self.__index = 0
+        self.__next_step = step_frames
+        self.__was_paused = False
+        self.resume_led = None
+
+    def render(self, frame, levels):
+        if self.__is_paused():
+            self.__was_paused = True
+            return
+        if self.__was_paused:
+            self.__was_paused = False
+            if self.resume_led in self.__sequence:
+                self.__index = self.__sequence.index(self.resume_led)
+            self.resume_led = None
+            self.__next_step = frame + self.__step_frames
+        while frame >= self.__next_step:
+            self.__index = (self.__index + 1) % len(self.__sequence)
+            self.__next_step += self.__step_frames
+        levels[self.__sequence[self.__index]] = 100
+
+    def frames_to_change(self, frame):
+        if self.__was_paused:
+            return None
+        return max(1, self.__next_step - frame)
+
+
+# Class definition for the led compositor. A single thread draws all led
+# patterns, stacked as layers, at a fixed frame rate. Only leds whose level
+# differs from what was last written are written, so steady leds cost
+# nothing and patterns never fight over the same pins. When no layer is
+# changing, the thread sleeps until a layer is added, removed or changed.
+#
+# Frame numbers come from the monotonic clock: frame n is due at a fixed
+# time n frame periods after the compositor started. A frame that is drawn
+# late does not delay the ones after it, so patterns take their nominal
+# time however busy the processor is.
+#
+# Created with threaded=False the compositor has no thread. Whoever drives
+# it instead (the asyncio runtime) calls step() when the time it returned
+# comes or when the waker set with set_waker() is called.
+class LEDCompositor(object):
+
+    def __init__(self, led_ids=leds, frame_rate=LED_FRAME_RATE, threaded=True):
+        self.__led_ids = led_ids
+        self.__frame_period = 1.0 / frame_rate
+        self.__layers = []
+        self.__written = {}
+        self.__pwms = {}
+        self.__pwm_running = set()
+        self.__epoch = time.monotonic()
+        self.__frame = 0
+        self.__changed = Condition()
+        self.__woken = False
+        self.__waker = None
+        self.__running = True
+        self.__thread = None
+        if threaded:
+            self.__thread = Thread(target=self.__run, name='led-compositor')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def add_layer(self, layer):
+        with self.__changed:
+            if layer not in self.__layers:
+                layer.attach(self)
+                self.__layers.append(layer)
+                # keep the layers in drawing order, equal priorities in
+                # the order they were added
+                self.__layers.sort(key=lambda each: each.priority)
+            self.__wake_locked()
+
+    def remove_layer(self, layer):
+        with self.__changed:
+            if layer in self.__layers:
+                self.__layers.remove(layer)
+                layer.detach()
+            self.__wake_locked()
+
+    def wake(self):
+        with self.__changed:
+            self.__wake_locked()
+
+    def __wake_locked(self):
+        self.__woken = True
+        self.__changed.notify()
+        if self.__waker is not None:
+            self.__waker()
+
+    # Have waker() called, from any thread, whenever step() should be
+    # called before the time it last returned
+    def set_waker(self, waker):
+        with self.__changed:
+            self.__waker = waker
+
+    # Forget what was written so the next frame writes every led, e.g.
+    # after something else has changed the leds directly
+    def invalidate(self):
+        with self.__changed:
+            self.__written = {}
+            self.__wake_locked()
+
+    def close(self):
+        with self.__changed:
+            self.__running = False
+            self.__wake_locked()
+        if self.__thread is not None:
+            self.__thread.join(1.0)
+        for pwm in self.__pwms.values():
+            pwm.stop()
+
+    # Draw one frame. Returns the number of frames until any layer changes,
+    # or None if none will change by itself.
+    def __render_locked(self):
+        levels = dict((led_id, 0) for led_id in self.__led_ids)
+        wait_frames = None
+        for layer in list(self.__layers):
+            if layer.is_finished():
+                self.__layers.remove(layer)
+                layer.detach()
+                continue
+            frame = self.__frame - layer.start_frame(self.__frame)
+            layer.render(frame, levels)
+            if layer.is_finished():
+                # finished itself while drawing this frame
+                self.__layers.remove(layer)
+                layer.detach()
+                continue
+            frames = layer.frames_to_change(frame)
+            if frames is not None and (wait_frames is None or frames < wait_frames):
+                wait_frames = frames
+        # leds fully on or off are written together in one call
+        switched = {}
+        for led_id, level in levels.items():
+            self.__write(led_id, level, switched)
+        if switched:
+            GPIO.output_many(switched)
+        return wait_frames
+
+    # The frame due now according to the monotonic clock. The small margin
+    # keeps a wake-up right on a deadline from counting as the frame before.
+    def __clock_frame(self):
+        elapsed = time.monotonic() - self.__epoch + 1e-6
+        return max(self.__frame, int(elapsed / self.__frame_period))
+
+    def __write(self, led_id, level, switched):
+        if self.__written.get(led_id) == level:
+            return
+        self.__written[led_id] = level
+        if 0 < level < 100:
+            # partly lit, needs pulse-width modulation
+            if led_id not in self.__pwms:
+                self.__pwms[led_id] = GPIO.PWM(led_id, LED_PWM_FREQUENCY)
+            if led_id in self.__pwm_running:
+                self.__pwms[led_id].ChangeDutyCycle(level)
+            else:
+                self.__pwms[led_id].start(level)
+                self.__pwm_running.add(led_id)
+        else:
+            # fully on or off, stop modulating so no PWM thread runs for
+            # leds that are not dimmed
+            if led_id in self.__pwm_running:
+                self.__pwms[led_id].stop()
+                self.__pwm_running.discard(led_id)
+            switched[led_id] = GPIO.HIGH if level else GPIO.LOW
+
+    # Draw the frame due now. Returns the time (monotonic clock) the next
+    # frame is due, or None if nothing will change until woken.
+    def step(self):
+        with self.__changed:
+            return self.__step_locked()
+
+    def __step_locked(self):
+        while self.__running:
+            self.__woken = False
+            self.__frame = self.__clock_frame()
+            wait_frames = self.__render_locked()
+            if self.__woken:
+                # something changed while drawing, draw again
+                continue
+            if wait_frames is None:
+                # nothing is moving
+                return None
+            # the frame in which the next change is due
+            return self.__epoch + \
+                   (self.__frame + wait_frames) * self.__frame_period
+        return None
+
+    def __run(self):
+        try:
+            with self.__changed:
+                while self.__running:
+                    deadline = self.__step_locked()
+                    if not self.__running:
+                        break
+                    if deadline is None:
+                        # nothing is moving, sleep until told otherwise
+                        self.__changed.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining > 0:
+                        self.__changed.wait(remaining)
+        except RuntimeError:
+            print('Ignoring RuntimeError at shutdown (LEDCompositor)')
+
+
+# The one compositor that draws all leds of the soundbox. It is created on
+# first use, which must come after the led pins are set up as outputs.
+_led_compositor = None
+_led_compositor_lock = Lock()
+
+def get_led_compositor():
+    global _led_compositor
+    with _led_compositor_lock:
+        if _led_compositor is None:
+            _led_compositor = LEDCompositor()
+        return _led_compositor
+
+# Use compositor as the one compositor, e.g. one without a thread for the
+# asyncio runtime. Must be called before anything draws on the leds.
+def set_led_compositor(compositor):
+    global _led_compositor
+    with _led_compositor_lock:
+        _led_compositor = compositor
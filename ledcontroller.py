@@ -1,166 +1,151 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
+import os
+import signal
 import time
 
 from globaldefs import *
 from platformdefs import *
+from ledcompositor import *
 
-class LEDController(object):
 
-    def __init__(self, num_dimming_cycles, led_ids):
+# Layer for the dimming cycles and countdown of the LEDController. The leds
+# are faded dark-->light-->dark a number of times, brought up to fully lit
+# once more, and then shut off one by one as a countdown. on_countdown_done
+# is called by the compositor when the last led goes off. Fade levels come
+# from a precomputed, gamma corrected fade table.
+class DimmingCountdownLayer(LEDLayer):
+
+    def __init__(self, led_ids, num_dimming_cycles, fade_frames,
+                 countdown_frames, on_countdown_done):
+        LEDLayer.__init__(self, MENU_PRIORITY)
         self.__led_ids = led_ids
+        self.__cycle_frames = 2 * fade_frames
+        self.__dimming_frames = num_dimming_cycles * self.__cycle_frames
+        self.__fade_frames = fade_frames
+        self.__fade_table = fade_table(fade_frames)
+        self.__countdown_frames = countdown_frames
+        self.__on_countdown_done = on_countdown_done
+
+    def render(self, frame, levels):
+        if frame < self.__dimming_frames:
+            # dimming cycles, up then down
+            cycle_frame = frame % self.__cycle_frames
+            if cycle_frame < self.__fade_frames:
+                level = self.__fade_table[cycle_frame]
+            else:
+                level = self.__fade_table[self.__cycle_frames - cycle_frame]
+            for led_id in self.__led_ids:
+                levels[led_id] = level
+            return
+
+        frame -= self.__dimming_frames
+        if frame < self.__fade_frames:
+            # First bring up the lights again...
+            for led_id in self.__led_ids:
+                levels[led_id] = self.__fade_table[frame]
+            return
+
+        # All are fully lit now...
+        # Shut them off one by one, on countdown intervals
+        frame -= self.__fade_frames
+        num_off = min(frame // self.__countdown_frames, len(self.__led_ids))
+        for index, led_id in enumerate(self.__led_ids):
+            levels[led_id] = 0 if index < num_off else 100
+        if num_off == len(self.__led_ids):
+            self.finish()
+            self.__on_countdown_done()
+
+    def frames_to_change(self, frame):
+        countdown_start = self.__dimming_frames + self.__fade_frames
+        if frame < countdown_start:
+            return 1
+        return self.__countdown_frames - (frame - countdown_start) % self.__countdown_frames
+
+
+class LEDController(object):
+
+    # Time for the leds to fade from dark to fully lit, or back
+    FADE_TIME = 1.0
+
+    # Time between leds going off during the countdown
+    COUNTDOWN_TIME = 1.0
+
+    # Time a flashing led stays on, and off
+    FLASH_DELAY = 0.5
+
+    # on_countdown_done is called when the countdown ends without having
+    # been stopped. By default it ends the program.
+    def __init__(self, num_dimming_cycles, led_ids, on_countdown_done=None):
+        # count down in panel order, whatever order the leds were given in
+        self.__led_ids = tuple(led_id for led_id in leds if led_id in led_ids)
+        self.__led_for_button = dict(zip(buttons, leds))
         self.__keep_running = True
         # Store the number of dark-->light-->dark cycles before
         # five second countdown to termination
         self.__num_dimming_cycles = num_dimming_cycles
-
-        # Pulse-width modulation @ 50 Hz for dimming effect
-        if LED_WHITE in self.__led_ids:
-            self.__pwm_white   = GPIO.PWM(LED_WHITE, 50)
-            self.__pwm_white.start(0)
-        if LED_BLUE in self.__led_ids:
-            self.__pwm_blue    = GPIO.PWM(LED_BLUE, 50)
-            self.__pwm_blue.start(0)
-        if LED_GREEN in self.__led_ids:
-            self.__pwm_green   = GPIO.PWM(LED_GREEN, 50)
-            self.__pwm_green.start(0)
-        if LED_YELLOW in self.__led_ids:
-            self.__pwm_yellow  = GPIO.PWM(LED_YELLOW, 50)
-            self.__pwm_yellow.start(0)
-        if LED_RED in self.__led_ids:
-            self.__pwm_red     = GPIO.PWM(LED_RED, 50)
-            self.__pwm_red.start(0)
-
-        # LEDs fully dimmed to start
-
+        self.__on_countdown_done = on_countdown_done
+
+        # The dimming and countdown, and above it the leds lit up on
+        # command. LEDs fully dimmed to start.
+        self.__cycling_layer = DimmingCountdownLayer(self.__led_ids,
+                                    num_dimming_cycles,
+                                    seconds_to_frames(self.FADE_TIME),
+                                    seconds_to_frames(self.COUNTDOWN_TIME),
+                                    self.countdown_done)
+        self.__command_layer = SolidLayer({}, MENU_PRIORITY + 1)
+        get_led_compositor().add_layer(self.__command_layer)
+
+    def __led_id(self, button_id):
+        led_id = self.__led_for_button.get(button_id)
+        if led_id in self.__led_ids:
+            return led_id
+        return None
+
+    # Flash the led of a button count times. Returns when done flashing.
     def flash(self, button_id, count):
 
         self.go_dark()
 
-        duty_cycle = 100
-
-        for counter in range(0, count*2):
-            counter += 1
-            if button_id == BUTTON_WHITE and LED_WHITE in self.__led_ids:
-                self.__pwm_white.ChangeDutyCycle(duty_cycle)
-            if button_id == BUTTON_BLUE  and LED_BLUE in self.__led_ids:
-                self.__pwm_blue.ChangeDutyCycle(duty_cycle)
-            if button_id == BUTTON_GREEN and LED_GREEN in self.__led_ids:
-                self.__pwm_green.ChangeDutyCycle(duty_cycle)
-            if button_id == BUTTON_YELLOW and LED_YELLOW in self.__led_ids:
-                self.__pwm_yellow.ChangeDutyCycle(duty_cycle)
-            if button_id == BUTTON_RED and LED_RED in self.__led_ids:
-                self.__pwm_red.ChangeDutyCycle(duty_cycle)
-            if duty_cycle == 0:
-                duty_cycle = 100
-            else:
-                duty_cycle = 0
-            time.sleep(0.5)
-
+        led_id = self.__led_id(button_id)
+        if led_id is not None:
+            flash_layer = FlashLayer((led_id,), seconds_to_frames(self.FLASH_DELAY),
+                                     MENU_PRIORITY + 2, count=count)
+            get_led_compositor().add_layer(flash_layer)
+            flash_layer.wait_removed()
 
     def light_up(self, button_id):
-        if button_id == BUTTON_WHITE and LED_WHITE in self.__led_ids:
-            self.__pwm_white.ChangeDutyCycle(100)
-        if button_id == BUTTON_BLUE and LED_BLUE in self.__led_ids:
-            self.__pwm_blue.ChangeDutyCycle(100)
-        if button_id == BUTTON_GREEN and LED_GREEN in self.__led_ids:
-            self.__pwm_green.ChangeDutyCycle(100)
-        if button_id == BUTTON_YELLOW and LED_YELLOW in self.__led_ids:
-            self.__pwm_yellow.ChangeDutyCycle(100)
-        if button_id == BUTTON_RED and LED_RED in self.__led_ids:
-            self.__pwm_red.ChangeDutyCycle(100)
-
-    def change_duty_cycle(self, time_on, pwm_obj):
-        if pwm_obj is None:
-            # Change all of them
-            if LED_WHITE in self.__led_ids:
-                self.__pwm_white.ChangeDutyCycle(time_on)
-            if LED_BLUE in self.__led_ids:
-                self.__pwm_blue.ChangeDutyCycle(time_on)
-            if LED_GREEN in self.__led_ids:
-                self.__pwm_green.ChangeDutyCycle(time_on)
-            if LED_YELLOW in self.__led_ids:
-                self.__pwm_yellow.ChangeDutyCycle(time_on)
-            if LED_RED in self.__led_ids:
-                self.__pwm_red.ChangeDutyCycle(time_on)
-        else:
-            # Change the specific pwm that was passed
-            pwm_obj.ChangeDutyCycle(time_on)
+        led_id = self.__led_id(button_id)
+        if led_id is not None:
+            self.__command_layer.set_level(led_id, 100)
 
     def go_dark(self):
-        time_on = 0
         self.stop_cycling()
-        if LED_WHITE in self.__led_ids:
-            self.__pwm_white.ChangeDutyCycle(time_on)
-        if LED_BLUE in self.__led_ids:
-            self.__pwm_blue.ChangeDutyCycle(time_on)
-        if LED_GREEN in self.__led_ids:
-            self.__pwm_green.ChangeDutyCycle(time_on)
-        if LED_YELLOW in self.__led_ids:
-            self.__pwm_yellow.ChangeDutyCycle(time_on)
-        if LED_RED in self.__led_ids:
-            self.__pwm_red.ChangeDutyCycle(time_on)
+        for led_id in self.__led_ids:
+            self.__command_layer.set_level(led_id, 0)
 
     def stop_cycling(self):
         self.__keep_running = False
+        get_led_compositor().remove_layer(self.__cycling_layer)
 
 
     def close(self):
-
-        if LED_WHITE in self.__led_ids:
-            self.__pwm_white.stop()
-        if LED_BLUE in self.__led_ids:
-            self.__pwm_blue.stop()
-        if LED_GREEN in self.__led_ids:
-            self.__pwm_green.stop()
-        if LED_YELLOW in self.__led_ids:
-            self.__pwm_yellow.stop()
-        if LED_RED in self.__led_ids:
-            self.__pwm_red.stop()
         self.__keep_running = False
+        get_led_compositor().remove_layer(self.__cycling_layer)
+        get_led_compositor().remove_layer(self.__command_layer)
 
+    # Start the dimming cycles and countdown. They are drawn by the led
+    # compositor, this returns at once.
+    def start(self):
+        if self.__keep_running:
+            get_led_compositor().add_layer(self.__cycling_layer)
 
-    def run(self):
-        for cycle_count in range(self.__num_dimming_cycles):
-            if not self.__keep_running:
-                break
-            for on_time in range(100):
-                if not self.__keep_running:
-                    break
-                self.change_duty_cycle(on_time, ALL)
-                time.sleep(0.01)
-
-            for on_time in range(100,0,-1):
-                if not self.__keep_running:
-                    break
-                self.change_duty_cycle(on_time, ALL)
-                time.sleep(0.01)
-        # Done with dimming cycles. Now countdown...
-        # First bring up the lights again...
-        for on_time in range(100):
-            if not self.__keep_running:
-                break
-            self.change_duty_cycle(on_time, ALL)
-            time.sleep(0.01)
-
-        # All are fully lit now...
-        # Shut them off one by one, on one second intervals
-        if self.__keep_running and LED_WHITE in self.__led_ids:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_white)
-        if self.__keep_running and LED_BLUE in self.__led_ids:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_blue)
-        if self.__keep_running and LED_GREEN in self.__led_ids:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_green)
-        if self.__keep_running and LED_YELLOW in self.__led_ids:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_yellow)
-        if self.__keep_running and LED_RED in self.__led_ids:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_red)
-
+    # Called by the compositor when the countdown ends
+    def countdown_done(self):
         if self.__keep_running:
             # Countdown is completed without correct button-press
-            # combination being detected. Exit now...
-            os.kill(os.getpid(), signal.SIGINT)
+            # combination being detected.
+            if self.__on_countdown_done is not None:
+                self.__on_countdown_done()
+            else:
+                # Exit now...
+                os.kill(os.getpid(), signal.SIGINT)
@@ -1,40 +1,30 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 import time
 
 from globaldefs import *
 from platformdefs import *
+from ledcompositor import *
 
+# Class definition for flashing the LEDs of paused sounds. The flashing is
+# a layer drawn by the led compositor over the LEDs' steady light, so no
+# thread of its own is needed.
 class LEDFlasher(object):
 
     PAUSE_FLASH_DELAY = 0.25
 
-    def __init__(self, led_id):
-        self.__led_id = led_id
-        self.__run_flag = True
-        self.__flashing = False
+    def __init__(self, *led_ids):
+        self.__led_ids = led_ids
+        self.__layer = FlashLayer(led_ids,
+                                  seconds_to_frames(self.PAUSE_FLASH_DELAY),
+                                  PAUSE_FLASH_PRIORITY, start_on=False)
 
-    def stop_flashing(self):
-        self.__run_flag = False
+    def start_flashing(self):
+        get_led_compositor().add_layer(self.__layer)
 
-    def set_run_flag(self):
-        self.__run_flag = True
+    # The flashing ends at once. The compositor's next frame, drawn as
+    # soon as it is woken, shows the leds without it.
+    def stop_flashing(self):
+        get_led_compositor().remove_layer(self.__layer)
 
     def is_flashing(self):
-        return self.__flashing
-
-    def flash_til_stopped(self):
-        try:
-            while self.__run_flag == True:
-                self.__flashing = True
-                GPIO.output(self.__led_id, GPIO.LOW)
-                time.sleep(self.PAUSE_FLASH_DELAY)
-                GPIO.output(self.__led_id, GPIO.HIGH)
-                time.sleep(self.PAUSE_FLASH_DELAY)
-                if self.__run_flag == False:
-                    GPIO.output(self.__led_id, GPIO.LOW)
-            self.__flashing = False
-
-        except RuntimeError:
-            print('Ignoring RuntimeError at shutdown (LEDFlasher)')
-
-
+        return self.__layer.is_shown()
@@ -0,0 +1,205 @@
+import math
+
+import numpy
+
+from globaldefs import *
+
+# Loudness (LUFS) sounds are brought to, and the highest true peak (dBTP)
+# the gain that does so may take a sound to, when soundbox.ini does not say
+LOUDNESS_TARGET_DEFAULT = -16
+TRUE_PEAK_LIMIT_DEFAULT = -1
+
+# Loudness reported for a sound that is silent, or too short to measure
+LOUDNESS_SILENT = -70.0
+
+# ITU-R BS.1770 gating blocks: 400 ms long, starting every 100 ms, and the
+# absolute and relative gates (LUFS, LU)
+LOUDNESS_BLOCK_SECONDS = 0.4
+LOUDNESS_STEP_SECONDS = 0.1
+LOUDNESS_ABSOLUTE_GATE = -70.0
+LOUDNESS_RELATIVE_GATE = -10.0
+
+# The K-weighting filter is applied as its impulse response, cut off where
+# it has died away, by FFT convolution of this many frames at a time
+K_WEIGHTING_RESPONSE_FRAMES = 8192
+K_WEIGHTING_FFT_FRAMES = 65536
+
+# True peaks are found on the samples upsampled four times by a windowed
+# sinc filter of this many taps per phase
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_TAPS_PER_PHASE = 12
+
+
+def gain_to_db(gain):
+    if gain <= 0.0:
+        return -math.inf
+    return 20.0 * math.log10(gain)
+
+
+# Coefficients (b, a) of the two biquads of the K-weighting filter, the
+# high shelf for the head and the high pass, for any sample rate
+def k_weighting_biquads(rate):
+    f0 = 1681.974450955533
+    gain_db = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10.0 ** (gain_db / 20.0)
+    vb = vh ** 0.4996667741545416
+    a0 = 1.0 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2.0 * (k * k - vh) / a0,
+              (vh - vb * k / q + k * k) / a0],
+             [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0])
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1.0 + k / q + k * k
+    high_pass = ([1.0, -2.0, 1.0],
+                 [1.0, 2.0 * (k * k - 1.0) / a0, (1.0 - k / q + k * k) / a0])
+    return (shelf, high_pass)
+
+
+# Impulse response of the K-weighting filter. The biquads are run sample
+# by sample, but only once for each rate.
+def k_weighting_response(rate, frames=K_WEIGHTING_RESPONSE_FRAMES):
+    response = [0.0] * frames
+    response[0] = 1.0
+    for b, a in k_weighting_biquads(rate):
+        x1 = x2 = y1 = y2 = 0.0
+        for n in range(frames):
+            x = response[n]
+            y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            x2, x1 = x1, x
+            y2, y1 = y1, y
+            response[n] = y
+    return numpy.array(response)
+
+
+# Polyphase filter of the true peak upsampling, one row of taps per phase
+def true_peak_filter(oversampling=TRUE_PEAK_OVERSAMPLING,
+                     taps_per_phase=TRUE_PEAK_TAPS_PER_PHASE):
+    taps = oversampling * taps_per_phase
+    n = numpy.arange(taps) - (taps - 1) / 2.0
+    response = numpy.sinc(n / oversampling) * numpy.kaiser(taps, 8.0)
+    return response.reshape(taps_per_phase, oversampling).T
+
+
+# Class definition for the measurement of the integrated loudness (ITU-R
+# BS.1770, in LUFS) and the true peak (dBTP) of a sound. The samples are
+# given to add() a chunk at a time, as decoded, so a sound of any length
+# is measured in the same memory. Every step works on whole chunks with
+# numpy: the K-weighting filter by FFT convolution with its impulse
+# response, the block energies by sums over 100 ms steps, and the true
+# peak by four times upsampling with a polyphase filter.
+class LoudnessMeter(object):
+
+    __responses = {}
+
+    def __init__(self, rate=ALSA_PCM_RATE, channels=ALSA_PCM_CHANNELS):
+        if rate not in LoudnessMeter.__responses:
+            LoudnessMeter.__responses[rate] = k_weighting_response(rate)
+        response = LoudnessMeter.__responses[rate]
+        self.__chunk_frames = K_WEIGHTING_FFT_FRAMES - len(response) + 1
+        self.__response_fft = numpy.fft.rfft(response, K_WEIGHTING_FFT_FRAMES)
+        self.__tail = numpy.zeros((len(response) - 1, channels))
+        self.__pending = numpy.zeros((0, channels))
+        self.__step_frames = int(round(rate * LOUDNESS_STEP_SECONDS))
+        self.__steps_per_block = int(round(LOUDNESS_BLOCK_SECONDS /
+                                           LOUDNESS_STEP_SECONDS))
+        self.__partial = numpy.zeros((0, channels))
+        self.__step_energies = []
+        self.__phases = true_peak_filter()
+        self.__history = numpy.zeros((self.__phases.shape[1] - 1, channels))
+        self.__peak = 0.0
+
+    # Measure more of the sound, int16 samples of shape (frames, channels)
+    def add(self, samples):
+        samples = samples.astype(numpy.float64) / 32768.0
+        self.__find_peak(samples)
+        pending = numpy.concatenate((self.__pending, samples))
+        start = 0
+        while len(pending) - start >= self.__chunk_frames:
+            self.__weigh(pending[start:start + self.__chunk_frames])
+            start += self.__chunk_frames
+        self.__pending = pending[start:]
+
+    def __weigh(self, chunk):
+        spectrum = numpy.fft.rfft(chunk, K_WEIGHTING_FFT_FRAMES, axis=0)
+        filtered = numpy.fft.irfft(spectrum * self.__response_fft[:, None],
+                                   K_WEIGHTING_FFT_FRAMES, axis=0)
+        # overlap-add: the end of the last chunk's response rings on here
+        filtered[:len(self.__tail)] += self.__tail
+        self.__tail = filtered[len(chunk):len(chunk) + len(self.__tail)]
+        self.__add_energy(filtered[:len(chunk)])
+
+    def __add_energy(self, weighted):
+        squares = numpy.concatenate((self.__partial, weighted * weighted))
+        steps = len(squares) // self.__step_frames
+        used = steps * self.__step_frames
+        if steps:
+            sums = squares[:used].reshape(steps, self.__step_frames, -1).sum(axis=1)
+            self.__step_energies.extend(sums.sum(axis=1))
+        self.__partial = squares[used:]
+
+    def __find_peak(self, samples):
+        padded = numpy.concatenate((self.__history, samples))
+        self.__history = padded[len(padded) - len(self.__history):]
+        for channel in range(samples.shape[1]):
+            for taps in self.__phases:
+                upsampled = numpy.convolve(padded[:, channel], taps, 'valid')
+                if len(upsampled):
+                    self.__peak = max(self.__peak,
+                                      float(numpy.abs(upsampled).max()))
+        if len(samples):
+            self.__peak = max(self.__peak, float(numpy.abs(samples).max()))
+
+    # Returns (integrated loudness in LUFS, true peak in dBTP) of what has
+    # been added
+    def result(self):
+        if len(self.__pending):
+            self.__weigh(self.__pending)
+            self.__pending = self.__pending[:0]
+        steps = numpy.array(self.__step_energies)
+        blocks = len(steps) - self.__steps_per_block + 1
+        true_peak = round(gain_to_db(self.__peak), 2)
+        if blocks < 1:
+            return (LOUDNESS_SILENT, true_peak)
+        cumulative = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+        block_power = (cumulative[self.__steps_per_block:] -
+                       cumulative[:blocks]) / \
+                      (self.__steps_per_block * self.__step_frames)
+        with numpy.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10.0 * numpy.log10(block_power)
+        gated = block_power[block_loudness > LOUDNESS_ABSOLUTE_GATE]
+        if len(gated) == 0:
+            return (LOUDNESS_SILENT, true_peak)
+        relative_gate = -0.691 + 10.0 * math.log10(gated.mean()) + \
+                        LOUDNESS_RELATIVE_GATE
+        with numpy.errstate(divide='ignore'):
+            gated = gated[-0.691 + 10.0 * numpy.log10(gated) > relative_gate]
+        return (round(-0.691 + 10.0 * math.log10(gated.mean()), 2), true_peak)
+
+
+# Measure the loudness of everything a decoder reads. Returns (integrated
+# loudness in LUFS, true peak in dBTP).
+def measure_loudness(decoder, chunk_frames=K_WEIGHTING_FFT_FRAMES):
+    meter = LoudnessMeter()
+    while True:
+        samples = decoder.read(chunk_frames)
+        if len(samples) == 0:
+            break
+        meter.add(samples)
+    return meter.result()
+
+
+# Gain (millibels) that brings a sound of the given loudness to the target
+# loudness, lowered if need be so its true peak stays under the limit.
+# None when the loudness of the sound is not known.
+def normalizing_millibels(loudness, true_peak, target=LOUDNESS_TARGET_DEFAULT,
+                          true_peak_limit=TRUE_PEAK_LIMIT_DEFAULT):
+    if loudness is None or loudness <= LOUDNESS_SILENT:
+        return None
+    gain_db = target - loudness
+    if true_peak is not None and true_peak + gain_db > true_peak_limit:
+        gain_db = true_peak_limit - true_peak
+    return int(round(100.0 * gain_db))
@@ -0,0 +1,251 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from globaldefs import *
+from pcmdecoder import *
+
+# Defaults used when soundbox.ini has no [pcm_cache] section
+PCM_CACHE_BUDGET_MB_DEFAULT = 64
+PCM_CACHE_BACKING_DIR_DEFAULT = ''
+
+# Frames decoded per read while filling the cache
+PCM_CACHE_DECODE_FRAMES = 64 * 1024
+
+BYTES_PER_FRAME = 2 * ALSA_PCM_CHANNELS
+
+
+# A sound file decoded to int16 samples at the sound card's format. The
+# samples are either an ordinary array in memory or a numpy.memmap of a
+# backing file.
+class PCMClip(object):
+
+    def __init__(self, source, samples):
+        self.source = source
+        self.samples = samples
+        self.nbytes = samples.nbytes
+
+
+# Decoder reading from a cached clip. It has the same interface as the
+# decoders in pcmdecoder, so the playback engine can't tell the difference,
+# but reading is just slicing an array.
+class ClipDecoder(object):
+
+    def __init__(self, clip):
+        self.__samples = clip.samples
+        self.__position = 0
+
+    def read(self, num_frames):
+        start = self.__position
+        self.__position = min(start + num_frames, len(self.__samples))
+        return self.__samples[start:self.__position]
+
+    def seek(self, seconds):
+        frame = int(seconds * ALSA_PCM_RATE)
+        self.__position = max(0, min(frame, len(self.__samples)))
+
+    def position(self):
+        return self.__position / float(ALSA_PCM_RATE)
+
+    def close(self):
+        self.__samples = None
+
+
+# Class definition for the cache of decoded sound files. Clips are kept in
+# least recently used order and the oldest are evicted when the decoded
+# size would go over the memory budget. With a backing directory, clips
+# are decoded once into raw sample files there and memory-mapped, so they
+# survive restarts and the kernel can page them out under pressure.
+class PCMCache(object):
+
+    def __init__(self, memory_budget_bytes, backing_dir=None):
+        self.__budget = memory_budget_bytes
+        self.__backing_dir = backing_dir or None
+        self.__clips = OrderedDict()
+        self.__loading = {}
+        self.__bytes_used = 0
+        self.__lock = threading.Lock()
+        self.__source_for = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.__backing_dir is not None and not os.path.isdir(self.__backing_dir):
+            os.makedirs(self.__backing_dir)
+
+    # Have sounds decoded from the file source_for(source) returns, e.g. a
+    # rendition of the sound in the sound card's format. Clips are still
+    # kept under the sound's own path.
+    def set_source_for(self, source_for):
+        self.__source_for = source_for
+
+    def __open_source(self, source):
+        if self.__source_for is not None:
+            source = self.__source_for(source)
+        return open_decoder(source)
+
+    # Sounds that can't be cached (streams, stream .url files, missing
+    # files) are played straight from their decoder
+    def is_cacheable(self, source):
+        return '://' not in source and not source.endswith('.url') and \
+               os.path.isfile(source)
+
+    # Return a decoder for a sound, from the cache if possible. A sound
+    # that is not cached is still decoded from its source_for() file.
+    def open_decoder(self, source):
+        if self.is_cacheable(source):
+            clip = self.get(source)
+            if clip is not None:
+                return ClipDecoder(clip)
+        return self.__open_source(source)
+
+    # Return the cached clip for a sound file, decoding it on a miss.
+    # Returns None if the decoded sound is bigger than the whole budget.
+    def get(self, source):
+        with self.__lock:
+            clip = self.__clips.get(source)
+            if clip is not None:
+                self.__clips.move_to_end(source)
+                self.hits += 1
+                return clip
+            self.misses += 1
+            loading = self.__loading.get(source)
+            if loading is None:
+                loading = self.__loading[source] = threading.Event()
+                is_loader = True
+            else:
+                is_loader = False
+
+        if not is_loader:
+            # another thread is decoding this sound already, wait for it
+            loading.wait()
+            with self.__lock:
+                return self.__clips.get(source)
+
+        try:
+            clip = self.__decode(source)
+            if clip is not None:
+                with self.__lock:
+                    self.__add_locked(clip)
+            return clip
+        finally:
+            with self.__lock:
+                del self.__loading[source]
+            loading.set()
+
+    # Decode sounds on a background thread so the first press of each
+    # plays from memory too
+    def preload(self, sources):
+        def load_all():
+            for source in sources:
+                if self.is_cacheable(source):
+                    try:
+                        self.get(source)
+                    except DecoderError as ex:
+                        print('PCMCache: cannot preload ', source, ': ', ex)
+        loader = threading.Thread(target=load_all, name='pcm-preload')
+        loader.daemon = True
+        loader.start()
+        return loader
+
+    # Drop the clips of sound files that changed, and of all sounds in
+    # directories that changed, so they are decoded again. A clip that is
+    # playing plays on, as its decoder holds on to the samples.
+    def forget(self, paths):
+        prefixes = tuple(os.path.join(path, '') for path in paths)
+        with self.__lock:
+            for source in list(self.__clips):
+                if source in paths or source.startswith(prefixes):
+                    clip = self.__clips.pop(source)
+                    self.__bytes_used -= clip.nbytes
+
+    # Whether a sound is decoded in the cache, without counting a hit
+    def is_cached(self, source):
+        with self.__lock:
+            return source in self.__clips
+
+    def clear(self):
+        with self.__lock:
+            self.__clips.clear()
+            self.__bytes_used = 0
+
+    def stats(self):
+        with self.__lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'clips': len(self.__clips),
+                    'bytes_used': self.__bytes_used,
+                    'budget': self.__budget}
+
+    def __add_locked(self, clip):
+        if clip.source in self.__clips:
+            return
+        while self.__clips and self.__bytes_used + clip.nbytes > self.__budget:
+            source, evicted = self.__clips.popitem(last=False)
+            self.__bytes_used -= evicted.nbytes
+            self.evictions += 1
+            print('PCMCache: evicted ', source)
+        self.__clips[clip.source] = clip
+        self.__bytes_used += clip.nbytes
+
+    def __decode(self, source):
+        if self.__backing_dir is not None:
+            return self.__decode_to_backing_file(source)
+
+        decoder = self.__open_source(source)
+        try:
+            chunks = []
+            size = 0
+            while True:
+                samples = decoder.read(PCM_CACHE_DECODE_FRAMES)
+                if len(samples) == 0:
+                    break
+                size += samples.nbytes
+                if size > self.__budget:
+                    return None
+                chunks.append(samples)
+        finally:
+            decoder.close()
+        if not chunks:
+            return PCMClip(source, numpy.zeros((0, ALSA_PCM_CHANNELS), numpy.int16))
+        return PCMClip(source, numpy.concatenate(chunks))
+
+    # Backing files are named after the sound's path, size and modification
+    # time, so a changed sound file is decoded again
+    def __backing_file_name(self, source):
+        info = os.stat(source)
+        key = '%s|%d|%d' % (os.path.abspath(source), info.st_size,
+                            int(info.st_mtime))
+        return os.path.join(self.__backing_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.pcm')
+
+    def __decode_to_backing_file(self, source):
+        backing_file = self.__backing_file_name(source)
+        if not os.path.isfile(backing_file):
+            # decode a chunk at a time into a temporary file and rename it
+            # when complete, so a half written file is never mapped
+            temp_file = backing_file + '.tmp'
+            decoder = self.__open_source(source)
+            try:
+                with open(temp_file, 'wb') as out:
+                    while True:
+                        samples = decoder.read(PCM_CACHE_DECODE_FRAMES)
+                        if len(samples) == 0:
+                            break
+                        out.write(samples.tobytes())
+            finally:
+                decoder.close()
+            os.rename(temp_file, backing_file)
+
+        size = os.path.getsize(backing_file)
+        if size > self.__budget:
+            return None
+        if size == 0:
+            return PCMClip(source, numpy.zeros((0, ALSA_PCM_CHANNELS), numpy.int16))
+        samples = numpy.memmap(backing_file, dtype=numpy.int16, mode='r')
+        return PCMClip(source, samples.reshape(-1, ALSA_PCM_CHANNELS))
@@ -0,0 +1,177 @@
+import os
+import wave
+import subprocess
+
+import numpy
+
+from globaldefs import *
+
+# libsndfile bindings are optional. When present they decode most formats
+# (including mp3 with libsndfile 1.1 or later) inside this process.
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+# Raised when a sound file cannot be opened for decoding
+class DecoderError(Exception):
+    pass
+
+
+# Make sure decoded samples are int16 with the channel count of the sound
+# card. Mono files are copied to both channels.
+def to_native_channels(samples):
+    if samples.ndim == 1:
+        samples = samples.reshape(-1, 1)
+    if samples.shape[1] == ALSA_PCM_CHANNELS:
+        return samples
+    if samples.shape[1] == 1:
+        return numpy.repeat(samples, ALSA_PCM_CHANNELS, axis=1)
+    return samples[:, :ALSA_PCM_CHANNELS]
+
+
+# All decoders share this interface:
+#   read(num_frames) returns up to num_frames frames as an int16 array of
+#                    shape (frames, ALSA_PCM_CHANNELS), empty at the end
+#   seek(seconds)    moves the read position
+#   position()       the read position in seconds
+#   close()          releases the file or decoder process
+
+
+# Decoder for 16 bit wav files already at the sound card's rate. This is
+# what the prompts and most of the drop zone use, and it needs nothing but
+# the standard library.
+class WaveDecoder(object):
+
+    def __init__(self, file_path_name):
+        try:
+            self.__wave = wave.open(file_path_name, 'rb')
+        except (wave.Error, EOFError) as ex:
+            raise DecoderError(str(ex))
+        if self.__wave.getsampwidth() != 2 or \
+           self.__wave.getframerate() != ALSA_PCM_RATE:
+            self.__wave.close()
+            raise DecoderError('not a 16 bit ' + str(ALSA_PCM_RATE) + ' Hz wav')
+        self.__channels = self.__wave.getnchannels()
+
+    def read(self, num_frames):
+        data = self.__wave.readframes(num_frames)
+        samples = numpy.frombuffer(data, dtype=numpy.int16)
+        return to_native_channels(samples.reshape(-1, self.__channels))
+
+    def seek(self, seconds):
+        frame = int(seconds * ALSA_PCM_RATE)
+        frame = max(0, min(frame, self.__wave.getnframes()))
+        self.__wave.setpos(frame)
+
+    def position(self):
+        return self.__wave.tell() / float(ALSA_PCM_RATE)
+
+    def close(self):
+        self.__wave.close()
+
+
+# Decoder using libsndfile, for files at the sound card's rate in any
+# format it understands.
+class SoundFileDecoder(object):
+
+    def __init__(self, file_path_name):
+        try:
+            self.__file = soundfile.SoundFile(file_path_name)
+        except RuntimeError as ex:
+            raise DecoderError(str(ex))
+        if self.__file.samplerate != ALSA_PCM_RATE:
+            self.__file.close()
+            raise DecoderError('not at ' + str(ALSA_PCM_RATE) + ' Hz')
+
+    def read(self, num_frames):
+        samples = self.__file.read(num_frames, dtype='int16', always_2d=True)
+        return to_native_channels(samples)
+
+    def seek(self, seconds):
+        frame = int(seconds * ALSA_PCM_RATE)
+        self.__file.seek(max(0, min(frame, self.__file.frames)))
+
+    def position(self):
+        return self.__file.tell() / float(ALSA_PCM_RATE)
+
+    def close(self):
+        self.__file.close()
+
+
+# Decoder for everything else, including internet streams: ffmpeg writes
+# raw samples already converted to the sound card's rate and channel count
+# into a pipe. Seeking restarts ffmpeg at the new position.
+class FFmpegDecoder(object):
+
+    FRAME_BYTES = 2 * ALSA_PCM_CHANNELS
+
+    def __init__(self, source):
+        self.__source = source
+        self.__process = None
+        self.__frames_read = 0
+        self.__start_seconds = 0.0
+        self.__start(0.0)
+
+    def __start(self, seconds):
+        self.close()
+        try:
+            self.__process = subprocess.Popen(['ffmpeg', '-nostdin',
+                        '-loglevel', 'error',
+                        '-ss', str(seconds),
+                        '-i', self.__source,
+                        '-f', 's16le', '-acodec', 'pcm_s16le',
+                        '-ac', str(ALSA_PCM_CHANNELS),
+                        '-ar', str(ALSA_PCM_RATE), '-'],
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE, stderr=None)
+        except OSError as ex:
+            raise DecoderError('cannot start ffmpeg: ' + str(ex))
+        self.__start_seconds = seconds
+        self.__frames_read = 0
+
+    def read(self, num_frames):
+        data = self.__process.stdout.read(num_frames * self.FRAME_BYTES)
+        # a pipe read can end part way through a frame, drop the fragment
+        usable = len(data) - len(data) % self.FRAME_BYTES
+        samples = numpy.frombuffer(data[:usable], dtype=numpy.int16)
+        samples = samples.reshape(-1, ALSA_PCM_CHANNELS)
+        self.__frames_read += len(samples)
+        return samples
+
+    def seek(self, seconds):
+        self.__start(max(0.0, seconds))
+
+    def position(self):
+        return self.__start_seconds + self.__frames_read / float(ALSA_PCM_RATE)
+
+    def close(self):
+        if self.__process is not None:
+            self.__process.stdout.close()
+            self.__process.terminate()
+            self.__process.wait()
+            self.__process = None
+
+
+# Open the best available decoder for a sound file or stream url
+def open_decoder(source):
+    if '://' in source:
+        return FFmpegDecoder(source)
+
+    if not os.path.isfile(source):
+        raise DecoderError('no such sound file: ' + source)
+
+    if source.lower().endswith('.wav'):
+        try:
+            return WaveDecoder(source)
+        except DecoderError:
+            pass
+
+    if soundfile is not None:
+        try:
+            return SoundFileDecoder(source)
+        except DecoderError:
+            pass
+
+    return FFmpegDecoder(source)
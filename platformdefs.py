@@ -1,4 +1,4 @@
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 
 
 # depending on how the switches are wired, one of the following pairs of
@@ -8,11 +8,13 @@ import RPi.GPIO as GPIO
 # pidevzero does this
 BUTTON_ACTIVATED = GPIO.HIGH
 BUTTON_PUD = GPIO.PUD_DOWN
+BUTTON_EDGE = GPIO.RISING
 
 # if the button press connects to LOW, use these
 # fivebtns does this
 #BUTTON_ACTIVATED = GPIO.HIGH
 #BUTTON_PUD = GPIO.PUD_UP
+#BUTTON_EDGE = GPIO.FALLING
 
 # The ini file path name, this file must exist
 SOUNDBOX_INI_FILE_PATH_NAME = '/home/pi/pizerodev/soundbox/soundbox.ini'
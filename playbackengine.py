@@ -0,0 +1,351 @@
+import threading
+
+import numpy
+
+# pyalsaaudio is only needed to play through ALSA. Without it sounds can
+# still be played to other outputs, e.g. the simulated one of soundbench.
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+from globaldefs import *
+from gainstage import *
+from dspchain import *
+
+# Return codes reported by a PlaybackHandle. They follow those of the
+# omxplayer subprocess that used to play sounds: 0 when the sound played
+# to its end, negative SIGTERM when it was stopped.
+PLAYBACK_FINISHED = 0
+PLAYBACK_FAILED = 1
+PLAYBACK_STOPPED = -15
+
+
+# Convert a level in millibels (as used by omxplayer's --vol and --amp
+# options) to a linear gain factor
+def millibels_to_gain(millibels):
+    return 10.0 ** (float(millibels) / 2000.0)
+
+
+# Class definition for the ALSA sound device that samples are written to.
+# It is opened once and kept open, so starting a sound costs nothing but
+# the first write.
+class AlsaOutput(object):
+
+    def __init__(self, device_name=ALSA_DEVICE_NAME):
+        self.__device_name = device_name
+        self.__pcm = None
+        self.__open()
+
+    def __open(self):
+        if alsaaudio is None:
+            raise RuntimeError('pyalsaaudio is not installed')
+        self.__pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, alsaaudio.PCM_NORMAL,
+                                   device=self.__device_name)
+        self.__pcm.setchannels(ALSA_PCM_CHANNELS)
+        self.__pcm.setrate(ALSA_PCM_RATE)
+        self.__pcm.setformat(alsaaudio.PCM_FORMAT_S16_LE)
+        self.__pcm.setperiodsize(ALSA_PERIOD_FRAMES)
+
+    # Write int16 samples. Blocks while the device buffer is full, which
+    # is what paces the playback thread.
+    def write(self, samples):
+        self.__pcm.write(samples.tobytes())
+
+    # Pause or resume the device. Returns False if the device (e.g. dmix)
+    # cannot pause, in which case the caller simply stops writing.
+    def pause(self, paused):
+        try:
+            self.__pcm.pause(1 if paused else 0)
+            return True
+        except alsaaudio.ALSAAudioError:
+            return False
+
+    # Throw away whatever is still buffered in the device so a stopped
+    # sound goes quiet at once. Older pyalsaaudio has no drop(), so the
+    # device is reopened instead.
+    def drop(self):
+        try:
+            self.__pcm.drop()
+        except AttributeError:
+            self.__pcm.close()
+            self.__open()
+        except alsaaudio.ALSAAudioError as ex:
+            print('AlsaOutput: ignoring error on drop: ', ex)
+
+    def close(self):
+        if self.__pcm is not None:
+            self.__pcm.close()
+            self.__pcm = None
+
+
+# Class definition for the handle of one sound being played. It answers the
+# same poll() and wait() calls as the subprocess.Popen object omxplayer was
+# run in, so the rest of soundbox can treat it the same way. Callbacks
+# added with add_done_callback() are called once the sound has ended, so
+# nothing has to wait on a thread of its own to find out.
+class PlaybackHandle(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.returncode = None
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.__done.wait(timeout)
+        return self.returncode
+
+    # Call callback(handle) when the sound has ended, on the thread that
+    # ends it, or at once if it already has
+    def add_done_callback(self, callback):
+        with self.__lock:
+            if self.returncode is None:
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, returncode):
+        with self.__lock:
+            if self.returncode is not None:
+                return
+            self.returncode = returncode
+            callbacks, self.__callbacks = self.__callbacks, []
+        self.__done.set()
+        for callback in callbacks:
+            callback(self)
+
+
+# Class definition for the in-process playback engine. A single playback
+# thread reads decoded samples and writes them to the sound device. The
+# control functions (play, pause, resume, seek, stop) may be called from
+# any thread; they only change state under a lock and wake the playback
+# thread, which does all decoder and device work itself.
+#
+# With dsp_stages (the stage settings of soundbox.ini's [dsp] section) the
+# samples go through a DSPChain after the gain stage. The chain is reset
+# for each new sound and after a seek, and what it holds back is written
+# out at the end of a sound.
+class PlaybackEngine(object):
+
+    def __init__(self, output_factory=AlsaOutput,
+                 period_frames=ALSA_PERIOD_FRAMES, ramp_ms=GAIN_RAMP_MS,
+                 dsp_stages=None):
+        self.__output_factory = output_factory
+        self.__output = None
+        self.__output_paused = False
+        self.__native_pause = False
+        self.__period_frames = period_frames
+
+        self.__wakeup = threading.Condition()
+        self.__decoder = None
+        self.__handle = None
+        # samples are scaled by the gain of the sound times the volume.
+        # changes of either ramp in the gain stage rather than jump.
+        self.__gain = 1.0
+        self.__volume = 1.0
+        self.__gain_stage = GainStage(ramp_ms=ramp_ms)
+        self.__dsp_chain = None
+        if dsp_stages:
+            self.__dsp_chain = DSPChain(dsp_stages, period_frames)
+        # the decoder the chain last processed, used by the playback
+        # thread only
+        self.__dsp_decoder = None
+        self.__paused = False
+        self.__seek_to = None
+        self.__drop_pending = False
+        self.__retired = []
+        self.__open_pending = False
+        self.__closing = False
+
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='playback-engine')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    # Open the sound device now rather than on the first play, so even the
+    # first sound starts without that cost
+    def prepare(self):
+        with self.__wakeup:
+            self.__open_pending = True
+            self.__wakeup.notify()
+
+    # Start playing from a decoder, stopping anything already playing.
+    # Returns the PlaybackHandle for the new sound.
+    def play(self, decoder, gain=1.0):
+        handle = PlaybackHandle(decoder)
+        with self.__wakeup:
+            self.__stop_locked()
+            self.__decoder = decoder
+            self.__handle = handle
+            self.__gain = gain
+            # a new sound starts at its gain, there is nothing to ramp from
+            self.__gain_stage.set_gain(gain * self.__volume, 0)
+            self.__paused = False
+            self.__wakeup.notify()
+        return handle
+
+    def pause(self):
+        with self.__wakeup:
+            self.__paused = True
+            self.__wakeup.notify()
+
+    def resume(self):
+        with self.__wakeup:
+            self.__paused = False
+            self.__wakeup.notify()
+
+    def seek(self, seconds):
+        with self.__wakeup:
+            if self.__decoder is not None:
+                self.__seek_to = seconds
+                self.__drop_pending = True
+                self.__wakeup.notify()
+
+    # Change the gain of the sound playing, ramping to it
+    def set_gain(self, gain):
+        with self.__wakeup:
+            self.__gain = gain
+            self.__gain_stage.set_gain(self.__gain * self.__volume)
+
+    # Change the volume (a linear gain factor) of this and later sounds,
+    # ramping to it. This is the software volume: it costs no mixer
+    # calls and works the same on any sound device.
+    def set_volume(self, volume):
+        with self.__wakeup:
+            self.__volume = volume
+            self.__gain_stage.set_gain(self.__gain * self.__volume)
+
+    def stop(self):
+        with self.__wakeup:
+            self.__stop_locked()
+            self.__wakeup.notify()
+
+    def is_playing(self):
+        return self.__decoder is not None
+
+    # Time taken by each stage of the DSP chain, None without one
+    def dsp_stats(self):
+        if self.__dsp_chain is None:
+            return None
+        return self.__dsp_chain.stats()
+
+    def close(self):
+        with self.__wakeup:
+            self.__stop_locked()
+            self.__closing = True
+            self.__wakeup.notify()
+        self.__thread.join(1.0)
+
+    def __stop_locked(self):
+        if self.__decoder is not None:
+            self.__retired.append(self.__decoder)
+            self.__handle.finish(PLAYBACK_STOPPED)
+            self.__decoder = None
+            self.__handle = None
+            self.__paused = False
+            self.__seek_to = None
+            self.__drop_pending = True
+
+    # True when the playback thread has nothing to do
+    def __idle(self):
+        if self.__closing or self.__retired or self.__drop_pending or \
+           self.__open_pending:
+            return False
+        if self.__decoder is None:
+            return True
+        return self.__paused and self.__output_paused
+
+    # A sound reached its end or failed. Forget it unless it was already
+    # replaced by another sound.
+    def __finished(self, decoder, handle, returncode):
+        with self.__wakeup:
+            if self.__decoder is decoder:
+                self.__decoder = None
+                self.__handle = None
+                self.__paused = False
+        decoder.close()
+        handle.finish(returncode)
+
+    def __set_output_paused(self, paused):
+        if paused:
+            self.__native_pause = self.__output.pause(True)
+            if not self.__native_pause:
+                self.__output.drop()
+        elif self.__native_pause:
+            self.__output.pause(False)
+            self.__native_pause = False
+        self.__output_paused = paused
+
+    def __run(self):
+        while True:
+            with self.__wakeup:
+                while self.__idle():
+                    self.__wakeup.wait()
+                if self.__closing:
+                    break
+                retired, self.__retired = self.__retired, []
+                drop, self.__drop_pending = self.__drop_pending, False
+                seek_to, self.__seek_to = self.__seek_to, None
+                open_output, self.__open_pending = self.__open_pending, False
+                decoder = self.__decoder
+                handle = self.__handle
+                paused = self.__paused
+
+            for old_decoder in retired:
+                old_decoder.close()
+
+            if open_output and self.__output is None:
+                try:
+                    self.__output = self.__output_factory()
+                except Exception as ex:
+                    print('PlaybackEngine: cannot open sound device: ', ex)
+
+            if decoder is None:
+                if drop and self.__output is not None:
+                    self.__output.drop()
+                self.__output_paused = False
+                continue
+
+            try:
+                if self.__output is None:
+                    self.__output = self.__output_factory()
+                if drop:
+                    self.__output.drop()
+                if paused != self.__output_paused:
+                    self.__set_output_paused(paused)
+                if paused:
+                    continue
+                if seek_to is not None:
+                    decoder.seek(seek_to)
+
+                samples = decoder.read(self.__period_frames)
+                if self.__dsp_chain is None:
+                    if len(samples) == 0:
+                        self.__finished(decoder, handle, PLAYBACK_FINISHED)
+                        continue
+                    self.__output.write(self.__gain_stage.process(samples))
+                    continue
+
+                if decoder is not self.__dsp_decoder or seek_to is not None:
+                    self.__dsp_chain.reset()
+                    self.__dsp_decoder = decoder
+                if len(samples) == 0:
+                    tail = self.__dsp_chain.flush()
+                    if tail is not None:
+                        self.__output.write(tail)
+                    self.__finished(decoder, handle, PLAYBACK_FINISHED)
+                    continue
+                self.__output.write(self.__dsp_chain.process(
+                    self.__gain_stage.scale(samples)))
+            except Exception as ex:
+                print('PlaybackEngine: playback failed: ', ex)
+                self.__finished(decoder, handle, PLAYBACK_FAILED)
+
+        if self.__output is not None:
+            self.__output.close()
+            self.__output = None
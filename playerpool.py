@@ -0,0 +1,303 @@
+import threading
+
+from globaldefs import *
+from playbackengine import *
+from pcmdecoder import *
+
+# Defaults used when soundbox.ini has no [player] section
+PLAYER_POOL_SIZE_DEFAULT = 2
+PLAYER_MAX_PLAYS_DEFAULT = 100
+
+# How long (seconds) play() waits for a worker to become idle
+PLAYER_WORKER_WAIT = 5.0
+
+# Worker states, as shown by PlayerPool.describe()
+WORKER_STARTING = 'starting'
+WORKER_IDLE = 'idle'
+WORKER_PLAYING = 'playing'
+WORKER_RETIRED = 'retired'
+WORKER_CRASHED = 'crashed'
+
+
+# Entry point of a player worker process. The worker opens the sound device
+# as soon as it starts, reports that it is ready, and then waits on its
+# control pipe for commands:
+#   ('play', play_id, source, gain), ('pause',), ('resume',),
+#   ('seek', seconds), ('gain', gain), ('volume', volume), ('stop',),
+#   ('quit',)
+# When a sound ends, for any reason, it sends ('finished', play_id, rc).
+# With a DSP chain the worker prints the time its stages took as it quits.
+def player_worker_main(conn, ramp_ms=GAIN_RAMP_MS, dsp_stages=None):
+    engine = PlaybackEngine(ramp_ms=ramp_ms, dsp_stages=dsp_stages)
+    engine.prepare()
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def report_when_finished(play_id, handle):
+        send(('finished', play_id, handle.wait()))
+
+    send(('ready',))
+    try:
+        while True:
+            command = conn.recv()
+            if command[0] == 'play':
+                play_id, source, gain = command[1:]
+                try:
+                    handle = engine.play(open_decoder(source), gain)
+                except DecoderError as ex:
+                    print('player worker: cannot play ', source, ': ', ex)
+                    handle = PlaybackHandle(source)
+                    handle.finish(PLAYBACK_FAILED)
+                watcher = threading.Thread(target=report_when_finished,
+                                           args=(play_id, handle))
+                watcher.daemon = True
+                watcher.start()
+            elif command[0] == 'pause':
+                engine.pause()
+            elif command[0] == 'resume':
+                engine.resume()
+            elif command[0] == 'seek':
+                engine.seek(command[1])
+            elif command[0] == 'gain':
+                engine.set_gain(command[1])
+            elif command[0] == 'volume':
+                engine.set_volume(command[1])
+            elif command[0] == 'stop':
+                engine.stop()
+            elif command[0] == 'quit':
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    if dsp_stages:
+        print('player worker dsp: ', engine.dsp_stats())
+    engine.close()
+
+
+# The parent's side of one player worker process
+class PlayerWorker(object):
+
+    def __init__(self, context, worker_number, ramp_ms=GAIN_RAMP_MS,
+                 dsp_stages=None):
+        self.number = worker_number
+        self.state = WORKER_STARTING
+        self.plays = 0
+        self.handle = None
+        self.play_id = None
+        self.__conn, child_conn = context.Pipe()
+        self.process = context.Process(target=player_worker_main,
+                                       args=(child_conn, ramp_ms, dsp_stages),
+                                       name='soundbox-player-%d' % worker_number)
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def send(self, command):
+        try:
+            self.__conn.send(command)
+            return True
+        except (OSError, EOFError):
+            return False
+
+    def receive(self):
+        return self.__conn.recv()
+
+    def close(self):
+        self.send(('quit',))
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.__conn.close()
+
+
+# Class definition for a pool of pre-started player worker processes. Each
+# worker has already imported everything and opened the sound device while
+# idle, so a play request only has to pass the file name over a pipe.
+# Switching sounds takes another idle worker rather than waiting for the
+# old one to stop. Workers that crash, or that have played max_plays
+# sounds, are replaced with fresh ones.
+#
+# The pool has the same control functions as a PlaybackEngine, but is given
+# file names rather than decoders since decoding happens in the worker.
+class PlayerPool(object):
+
+    def __init__(self, size=PLAYER_POOL_SIZE_DEFAULT,
+                 max_plays=PLAYER_MAX_PLAYS_DEFAULT, ramp_ms=GAIN_RAMP_MS,
+                 dsp_stages=None):
+        self.__size = max(1, size)
+        self.__max_plays = max_plays
+        self.__ramp_ms = ramp_ms
+        self.__dsp_stages = dsp_stages
+        self.__volume = 1.0
+        # imported here, it is only needed with the pool player engine
+        import multiprocessing
+        self.__context = multiprocessing.get_context('spawn')
+        self.__workers = []
+        self.__active = None
+        self.__next_number = 0
+        self.__next_play_id = 0
+        self.__changed = threading.Condition()
+        self.__closing = False
+        self.recycled = 0
+        self.crashed = 0
+
+        with self.__changed:
+            for index in range(self.__size):
+                self.__start_worker_locked()
+
+    def __start_worker_locked(self):
+        self.__next_number += 1
+        worker = PlayerWorker(self.__context, self.__next_number, self.__ramp_ms,
+                              self.__dsp_stages)
+        # a fresh worker plays at the volume the others were set to
+        if self.__volume != 1.0:
+            worker.send(('volume', self.__volume))
+        self.__workers.append(worker)
+        listener = threading.Thread(target=self.__listen, args=(worker,))
+        listener.daemon = True
+        listener.start()
+
+    # Runs on its own thread for each worker, blocked reading the messages
+    # the worker sends back
+    def __listen(self, worker):
+        while True:
+            try:
+                message = worker.receive()
+            except (EOFError, OSError):
+                break
+            with self.__changed:
+                if message[0] == 'ready':
+                    worker.state = WORKER_IDLE
+                elif message[0] == 'finished':
+                    play_id, rc = message[1:]
+                    if play_id == worker.play_id:
+                        worker.handle.finish(rc)
+                        worker.handle = None
+                        worker.play_id = None
+                        worker.state = WORKER_IDLE
+                        if self.__active is worker:
+                            self.__active = None
+                        if worker.plays >= self.__max_plays:
+                            self.__retire_locked(worker, WORKER_RETIRED)
+                self.__changed.notify_all()
+            if worker.state == WORKER_RETIRED:
+                worker.close()
+                return
+
+        # the pipe closed without the worker being retired: it crashed
+        with self.__changed:
+            if worker.state != WORKER_RETIRED:
+                print('PlayerPool: worker ', worker.number, ' crashed')
+                if worker.handle is not None:
+                    worker.handle.finish(PLAYBACK_FAILED)
+                    worker.handle = None
+                if self.__active is worker:
+                    self.__active = None
+                self.crashed += 1
+                self.__retire_locked(worker, WORKER_CRASHED)
+            self.__changed.notify_all()
+        worker.process.join(1.0)
+
+    def __retire_locked(self, worker, state):
+        worker.state = state
+        if worker in self.__workers:
+            self.__workers.remove(worker)
+        if state == WORKER_RETIRED:
+            self.recycled += 1
+        if not self.__closing:
+            self.__start_worker_locked()
+
+    # Play a sound file on an idle worker, stopping the sound on the active
+    # worker. Returns a PlaybackHandle for the new sound.
+    def play(self, source, gain=1.0):
+        with self.__changed:
+            self.__stop_locked()
+            worker = self.__wait_for_idle_locked()
+            handle = PlaybackHandle(source)
+            if worker is None:
+                print('PlayerPool: no idle worker to play ', source)
+                handle.finish(PLAYBACK_FAILED)
+                return handle
+            self.__next_play_id += 1
+            worker.play_id = self.__next_play_id
+            worker.handle = handle
+            worker.plays += 1
+            worker.state = WORKER_PLAYING
+            self.__active = worker
+            if not worker.send(('play', worker.play_id, source, gain)):
+                handle.finish(PLAYBACK_FAILED)
+            return handle
+
+    def __wait_for_idle_locked(self):
+        def idle_worker():
+            for worker in self.__workers:
+                if worker.state == WORKER_IDLE:
+                    return worker
+            return None
+        self.__changed.wait_for(idle_worker, PLAYER_WORKER_WAIT)
+        return idle_worker()
+
+    def __send_to_active(self, command):
+        with self.__changed:
+            if self.__active is not None:
+                self.__active.send(command)
+
+    def pause(self):
+        self.__send_to_active(('pause',))
+
+    def resume(self):
+        self.__send_to_active(('resume',))
+
+    def seek(self, seconds):
+        self.__send_to_active(('seek', seconds))
+
+    # Change the gain of the sound playing, as PlaybackEngine.set_gain()
+    def set_gain(self, gain):
+        self.__send_to_active(('gain', gain))
+
+    # Set the software volume of every worker, so whichever plays next
+    # plays at it
+    def set_volume(self, volume):
+        with self.__changed:
+            self.__volume = volume
+            for worker in self.__workers:
+                worker.send(('volume', volume))
+
+    def stop(self):
+        with self.__changed:
+            self.__stop_locked()
+
+    # The stopped worker becomes idle again once it reports the sound as
+    # finished; the handle is finished at once so callers need not wait.
+    def __stop_locked(self):
+        if self.__active is not None:
+            self.__active.send(('stop',))
+            self.__active.handle.finish(PLAYBACK_STOPPED)
+            self.__active = None
+
+    def is_playing(self):
+        return self.__active is not None
+
+    # State of every worker, for diagnostics
+    def describe(self):
+        with self.__changed:
+            return {'workers': [{'number': worker.number,
+                                 'pid': worker.process.pid,
+                                 'state': worker.state,
+                                 'plays': worker.plays}
+                                for worker in self.__workers],
+                    'recycled': self.recycled,
+                    'crashed': self.crashed}
+
+    def close(self):
+        with self.__changed:
+            self.__closing = True
+            self.__stop_locked()
+            workers = list(self.__workers)
+            for worker in workers:
+                worker.state = WORKER_RETIRED
+            self.__workers = []
+        for worker in workers:
+            worker.close()
@@ -0,0 +1,64 @@
+import os
+
+from globaldefs import *
+from playbackengine import *
+from pcmcache import *
+
+# Memory budget for the decoded prompts. The prompts are short spoken
+# messages, all of them fit in far less than this.
+PROMPT_CACHE_BUDGET = 16 * 1024 * 1024
+
+
+# Class definition for the audio prompt service. Every prompt in the
+# prompts directory is decoded into memory when the service starts, and
+# prompts are played by a playback engine of their own that has the sound
+# device open already. Playing a prompt returns at once, and a prompt can
+# be cut off at any time, e.g. as soon as the user presses a button to
+# answer it.
+class PromptPlayer(object):
+
+    def __init__(self, prompts_dir, output_factory=AlsaOutput):
+        self.__prompts_dir = prompts_dir
+        self.__cache = PCMCache(PROMPT_CACHE_BUDGET)
+        self.__engine = PlaybackEngine(output_factory)
+        self.__engine.prepare()
+        self.__handle = None
+        self.preload()
+
+    # Decode every prompt in the background
+    def preload(self):
+        try:
+            names = sorted(os.listdir(self.__prompts_dir))
+        except OSError as ex:
+            print('PromptPlayer: cannot list prompts: ', ex)
+            return
+        self.__cache.preload([os.path.join(self.__prompts_dir, name)
+                              for name in names])
+
+    # Start playing a prompt, cutting off any prompt already playing.
+    # Returns the prompt's PlaybackHandle.
+    def play(self, prompt_name, gain=1.0):
+        prompt = os.path.join(self.__prompts_dir, prompt_name)
+        try:
+            self.__handle = self.__engine.play(self.__cache.open_decoder(prompt),
+                                               gain)
+        except DecoderError as ex:
+            print('PromptPlayer: cannot play ', prompt_name, ': ', ex)
+            self.__handle = PlaybackHandle(prompt)
+            self.__handle.finish(PLAYBACK_FAILED)
+        return self.__handle
+
+    # Play a prompt and wait until it has been heard, for the times when
+    # nothing else can happen until the user has heard it
+    def play_and_wait(self, prompt_name, gain=1.0):
+        return self.play(prompt_name, gain).wait()
+
+    # Cut off the prompt being played, if any
+    def stop(self):
+        self.__engine.stop()
+
+    def is_playing(self):
+        return self.__engine.is_playing()
+
+    def close(self):
+        self.__engine.close()
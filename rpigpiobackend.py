@@ -0,0 +1,72 @@
+import time
+
+import RPi.GPIO
+
+from gpiobackend import *
+
+
+# GPIO backend using the RPi.GPIO module. Calls go straight through; the
+# batched calls group channels by level so a write of many leds takes at
+# most two calls into the module.
+class RPiGPIOBackend(GPIOBackend):
+
+    name = 'rpi'
+
+    def __init__(self):
+        self.__edge_times = {}
+
+    def setmode(self, mode):
+        RPi.GPIO.setmode(mode)
+
+    def setup(self, channels, direction, pull_up_down=PUD_OFF):
+        RPi.GPIO.setup(channels, direction, pull_up_down=pull_up_down)
+
+    def input(self, channel):
+        return RPi.GPIO.input(channel)
+
+    def output(self, channels, values):
+        RPi.GPIO.output(channels, values)
+
+    def output_many(self, levels):
+        high = [channel for channel, level in levels.items() if level]
+        low = [channel for channel, level in levels.items() if not level]
+        if high:
+            RPi.GPIO.output(high, HIGH)
+        if low:
+            RPi.GPIO.output(low, LOW)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        # RPi.GPIO does not give the time of an edge, take it as the
+        # callback starts
+        def timed_callback(ch):
+            self.__edge_times[ch] = time.monotonic()
+            if callback is not None:
+                callback(ch)
+        if bouncetime is None:
+            RPi.GPIO.add_event_detect(channel, edge, callback=timed_callback)
+        else:
+            RPi.GPIO.add_event_detect(channel, edge, callback=timed_callback,
+                                      bouncetime=bouncetime)
+
+    def remove_event_detect(self, channel):
+        RPi.GPIO.remove_event_detect(channel)
+
+    def edge_time(self, channel):
+        return self.__edge_times.get(channel)
+
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        kwargs = {}
+        if bouncetime is not None:
+            kwargs['bouncetime'] = bouncetime
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        result = RPi.GPIO.wait_for_edge(channel, edge, **kwargs)
+        if result is not None:
+            self.__edge_times[channel] = time.monotonic()
+        return result
+
+    def PWM(self, channel, frequency):
+        return RPi.GPIO.PWM(channel, frequency)
+
+    def cleanup(self):
+        RPi.GPIO.cleanup()
@@ -0,0 +1,217 @@
+import time
+import threading
+from queue import Queue
+
+from gpiobackend import *
+
+
+# Clock that only moves when told to. Edge times and debouncing of a
+# simulated backend using it do not depend on how fast the machine is.
+class VirtualClock(object):
+
+    def __init__(self, start=0.0):
+        self.__now = start
+        self.__lock = threading.Lock()
+
+    def monotonic(self):
+        with self.__lock:
+            return self.__now
+
+    def advance(self, seconds):
+        with self.__lock:
+            self.__now += seconds
+            return self.__now
+
+
+# Software stand-in for RPi.GPIO.PWM that records the duty cycle
+class SimulatedPWM(object):
+
+    def __init__(self, backend, channel, frequency):
+        self.__backend = backend
+        self.channel = channel
+        self.frequency = frequency
+        self.duty_cycle = None
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.__backend.record_pwm(self.channel, duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self.__backend.record_pwm(self.channel, duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.duty_cycle = None
+        self.__backend.record_pwm(self.channel, None)
+
+
+# GPIO backend with no hardware behind it, for running soundbox on any
+# machine and for benchmarks. Inputs are driven with set_input(), which
+# detects edges, debounces them and runs callbacks on a callback thread
+# the way RPi.GPIO does. Every output write is counted and the level of
+# each pin can be read back.
+#
+# By default time is the real monotonic clock. Given a VirtualClock, edge
+# times and bounce filtering follow that clock instead.
+class SimulatedGPIOBackend(GPIOBackend):
+
+    name = 'simulated'
+
+    def __init__(self, clock=None):
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__directions = {}
+        self.__levels = {}
+        # channel -> [edge, callback, bounce seconds, last edge time]
+        self.__detects = {}
+        self.__edge_times = {}
+        self.__edge_levels = {}
+        self.__pwm_duty = {}
+        self.__callbacks = Queue()
+        self.__callback_thread = None
+        self.output_writes = 0
+        self.input_reads = 0
+
+    def monotonic(self):
+        if self.__clock is None:
+            return time.monotonic()
+        return self.__clock.monotonic()
+
+    def setup(self, channels, direction, pull_up_down=PUD_OFF):
+        if isinstance(channels, int):
+            channels = [channels]
+        with self.__lock:
+            for channel in channels:
+                self.__directions[channel] = direction
+                # an open input reads as its pull resistor sets it
+                self.__levels[channel] = HIGH if pull_up_down == PUD_UP else LOW
+
+    def input(self, channel):
+        with self.__lock:
+            self.input_reads += 1
+            return self.__levels.get(channel, LOW)
+
+    def input_many(self, channels):
+        with self.__lock:
+            self.input_reads += 1
+            return tuple(self.__levels.get(channel, LOW) for channel in channels)
+
+    def output(self, channels, values):
+        if isinstance(channels, int):
+            self.output_many({channels: values})
+        elif isinstance(values, int):
+            self.output_many(dict((channel, values) for channel in channels))
+        else:
+            self.output_many(dict(zip(channels, values)))
+
+    def output_many(self, levels):
+        with self.__lock:
+            self.output_writes += 1
+            for channel, level in levels.items():
+                if self.__directions.get(channel) != OUT:
+                    raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+                self.__levels[channel] = HIGH if level else LOW
+
+    # Level last written to an output, or driven on an input
+    def level(self, channel):
+        with self.__lock:
+            return self.__levels.get(channel, LOW)
+
+    def record_pwm(self, channel, duty_cycle):
+        with self.__lock:
+            self.output_writes += 1
+            if duty_cycle is None:
+                self.__pwm_duty.pop(channel, None)
+            else:
+                self.__pwm_duty[channel] = duty_cycle
+
+    # Duty cycle of a pin being modulated, or None if it is not
+    def pwm_duty(self, channel):
+        with self.__lock:
+            return self.__pwm_duty.get(channel)
+
+    # Drive an input pin as the hardware would. An edge the pin is watched
+    # for queues its callback, unless it comes within the bounce time of
+    # the last edge reported.
+    def set_input(self, channel, level):
+        level = HIGH if level else LOW
+        with self.__lock:
+            if self.__levels.get(channel, LOW) == level:
+                return
+            self.__levels[channel] = level
+            detect = self.__detects.get(channel)
+            if detect is None:
+                return
+            edge, callback, bounce, last_time = detect
+            if edge == RISING and not level or edge == FALLING and level:
+                return
+            when = self.monotonic()
+            if last_time is not None and when - last_time < bounce:
+                return
+            detect[3] = when
+            self.__edge_times[channel] = when
+        if callback is not None:
+            self.__callbacks.put((callback, channel, level, when))
+
+    # Press and release a button wired as on the soundbox panel, where a
+    # pressed button pulls its pin to the pressed level
+    def press(self, channel, pressed_level=HIGH):
+        self.set_input(channel, pressed_level)
+
+    def release(self, channel, pressed_level=HIGH):
+        self.set_input(channel, LOW if pressed_level == HIGH else HIGH)
+
+    # Wait until every callback queued so far has run
+    def settle(self):
+        self.__callbacks.join()
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.__lock:
+            if channel in self.__detects:
+                raise RuntimeError('Conflicting edge detection already enabled '
+                                   'for this GPIO channel')
+            bounce = 0.0 if bouncetime is None else bouncetime / 1000.0
+            self.__detects[channel] = [edge, callback, bounce, None]
+            if self.__callback_thread is None:
+                self.__callback_thread = threading.Thread(
+                    target=self.__run_callbacks, name='gpio-callbacks')
+                self.__callback_thread.daemon = True
+                self.__callback_thread.start()
+
+    def remove_event_detect(self, channel):
+        with self.__lock:
+            self.__detects.pop(channel, None)
+
+    def edge_time(self, channel):
+        with self.__lock:
+            return self.__edge_times.get(channel)
+
+    def edge_level(self, channel):
+        with self.__lock:
+            return self.__edge_levels.get(channel, self.__levels.get(channel, LOW))
+
+    def PWM(self, channel, frequency):
+        return SimulatedPWM(self, channel, frequency)
+
+    def cleanup(self):
+        with self.__lock:
+            self.__detects = {}
+            self.__pwm_duty = {}
+
+    def __run_callbacks(self):
+        while True:
+            callback, channel, level, when = self.__callbacks.get()
+            # the callback sees the edge it is called for, however far
+            # behind the pin it has fallen
+            with self.__lock:
+                self.__edge_levels[channel] = level
+                self.__edge_times[channel] = when
+            try:
+                callback(channel)
+            except Exception as ex:
+                print('Simulated GPIO callback failed: ', ex)
+            finally:
+                self.__callbacks.task_done()
@@ -0,0 +1,1241 @@
+import os
+import sys
+import json
+import math
+import time
+import wave
+import shutil
+import argparse
+import tracemalloc
+import platform
+import tempfile
+import threading
+import subprocess
+
+import numpy
+
+from gpiobackend import GPIO
+from gpiobackend import set_gpio_backend
+from simgpiobackend import SimulatedGPIOBackend
+
+from globaldefs import *
+from platformdefs import *
+from volumecontrol import *
+from soundplayer import *
+from soundboxcontrol import *
+from buttonmonitor import *
+from asyncruntime import *
+from soundindex import *
+from dropzonewatcher import *
+from soundingest import *
+from loudness import *
+from dspchain import *
+from voicemixer import *
+
+# Benchmark of the soundbox control flow, run without a Pi, a sound card or
+# a network. The SoundboxControl of soundbox.py runs on simulated pins, a
+# simulated sound device and a simulated mixer, and the benchmark presses
+# buttons and turns the knob through the simulated pins while timing how
+# long the soundbox takes to respond:
+#
+#   press_to_playback: button press to the first samples of its sound
+#                      being written to the sound device
+#   pause: command switch click to the sound device being paused
+#   resume: command switch click to the sound device being resumed
+#   encoder_to_mixer: last edge of one knob detent to the mixer being set
+#   idle_cpu: CPU used by each thread while the leds scan and nothing else
+#             happens
+#   idle_waits: CPU used by each thread while a sound is paused, and while
+#               a menu waits for a button to be pressed
+#   sound_index: time to index the benchmark's sounds the first time, and
+#                to load the unchanged index again as at every start
+#   gain_stage: time the gain stage takes to scale one period of samples
+#               while ramping, which must be well under the period's
+#               playing time
+#   drop_zone: time from a sound file being replaced while another sound
+#              plays to the buttons having the new sound, the rebuilds
+#              that took, and whether the playing sound was interrupted
+#   collection_switch: time to make another collection the active one, as
+#                      the configuration menu does, and from then until
+#                      its sounds are decoded and a button plays one
+#   menu_hold: time from the command switch being held down to it opening
+#              the menu, with and without hold repeats on the way
+#
+# The idle measurements also count the threads, their context switches and
+# the resident memory of the process. --runtime asyncio benchmarks the
+# control flow running on an event loop rather than on threads.
+#
+# Spins of the knob, one as fast as a hand turns it and one far faster
+# than the edges are handled, check that no detents are lost. A result
+# showing something broken rather than slow fails the run: a lost detent,
+# a thread that uses CPU while the soundbox waits for the user, or a check
+# (drop zone, voice mixer, transitions and the others) that did not pass.
+# The end of the script lists them all.
+# Results are printed, and can be written as JSON and compared with an
+# earlier run:
+#
+#   python3 soundbench.py --json before.json
+#   ...change something...
+#   python3 soundbench.py --json after.json --compare before.json
+
+# Time between iterations, long enough for the bounce filters of the
+# buttons and the command switch to pass
+BENCH_SETTLE_TIME = 0.4
+
+# Longest wait for the soundbox to respond before an iteration counts as
+# missed
+BENCH_RESPONSE_TIMEOUT = 5.0
+
+# Length of a click of the command switch
+SWITCH_CLICK_TIME = 0.05
+
+# Time between the edges of a single detent turned at a normal speed
+ENCODER_EDGE_TIME = 0.002
+
+# Knob spin of the lost-detent check, in detents per second
+SPIN_DETENTS = 8
+SPIN_RATE = 40.0
+
+# The same check at several thousand pin transitions per second, faster
+# than the edges are handled, so the GPIO callback falls behind the pins
+# as on a busy single core Pi
+SPIN_FAST_RATE = 1250.0
+
+# Edge times shorter than this are waited out by spinning, as sleep() is
+# not that precise
+SPIN_SLEEP_RESOLUTION = 0.001
+
+# Share of a CPU (percent) a thread may use while the soundbox waits for
+# the user. A thread using more is polling or spinning, not waiting.
+IDLE_CPU_LIMIT = 2.0
+
+# Quiet time of the drop zone watcher before a change is taken in, and the
+# level of the sound that replaces one of the benchmark's sounds
+BENCH_DROP_ZONE_DEBOUNCE_MS = 200
+BENCH_REPLACED_LEVEL = 1500
+
+# The second collection of the benchmark, and the level of its sounds
+BENCH_OTHER_COLLECTION = 'other'
+BENCH_OTHER_LEVEL = 7000
+
+# Level of the mono sound copied in to be made into a rendition
+BENCH_MONO_LEVEL = 2500
+
+# Tones recorded far apart in level (dBFS), for loudness normalization to
+# bring together
+BENCH_LOUDNESS_TONES = ((220.0, -32.0), (1000.0, -12.0), (3000.0, -3.0))
+
+# Most the normalized tones may still be apart as played (LU)
+BENCH_LOUDNESS_SPREAD_LU = 1.0
+
+# DSP chain timed per period: every kind of stage, fed noise loud enough
+# that the limiter is always at work
+BENCH_DSP_STAGES = (('lowcut', 100.0, 0.707, 0.0), ('highcut', 12000.0, 0.707, 0.0),
+                    ('peak', 1000.0, 1.0, 3.0), ('lowshelf', 200.0, 0.707, -3.0),
+                    ('highshelf', 5000.0, 0.707, 2.0), ('limiter', -1.0, 5.0, 200.0))
+BENCH_DSP_LEVEL = 30000
+
+# Most a period of the DSP chain may allocate (bytes), if only for a
+# moment: the views and Python objects numpy makes along the way, but
+# not a buffer of the period's samples, which is 8 KB or more
+BENCH_DSP_PERIOD_ALLOCATION = 4096
+
+# Voice counts the mixer is timed at, and the level of the noise each voice
+# plays, loud enough that a few voices together are soft clipped
+BENCH_MIXER_VOICES = (1, 2, 4, 8)
+BENCH_MIXER_LEVEL = 12000
+
+# Full scale of the int16 samples the mixer writes. A soft clipped mix
+# stays within it; a sum clipped or wrapped past it reaches -32768.
+BENCH_FULL_SCALE = 32767
+
+# Transitions checked on a recording of what reaches the simulated device:
+# the levels of the sound switched from and to, and the times of the
+# crossfade and fade out
+BENCH_TRANSITION_LEVELS = (8000, 4000)
+BENCH_CROSSFADE_MS = 60
+BENCH_FADE_OUT_MS = 30
+
+# Largest step from one sample to the next a transition may make. The
+# fades above move a few steps a frame; a click is a step the size of a
+# sound's level, thousands.
+BENCH_TRANSITION_STEP_LIMIT = 64
+
+# Gesture timings (long press, hold repeat, menu hold) in milliseconds the
+# menu is checked to open at: with no repeats, and with the menu hold
+# between two repeats. The switch is held on a spare pin, apart from the
+# soundbox's own, and the menu must open within the tolerance (ms).
+BENCH_MENU_HOLD_TIMINGS = ((300, 0, 500), (300, 200, 650))
+BENCH_MENU_PIN = 26
+BENCH_MENU_HOLD_TOLERANCE_MS = 50
+
+# Gray code states (a, b) of the rotary encoder pins for one detent of
+# turning the volume up, starting from the resting state
+ENCODER_UP_STATES = ((1, 0), (1, 1), (0, 1), (0, 0))
+
+
+# Class definition for a stand-in for the ALSA sound device. Samples are
+# taken at the pace a real device plays them, so writes block once a few
+# periods are buffered, and every write, pause, resume and drop is logged
+# with its time. Each benchmark sound is a constant level, so the level of
+# a write tells which sound it belongs to.
+class SimulatedOutput(object):
+
+    # Periods the device buffers before a write blocks
+    BUFFER_PERIODS = 4
+
+    def __init__(self, log):
+        self.__log = log
+        self.__buffer_time = float(self.BUFFER_PERIODS * ALSA_PERIOD_FRAMES) / \
+                             ALSA_PCM_RATE
+        # time the buffered samples will have been played by
+        self.__played_by = None
+        self.__paused_remaining = None
+
+    def write(self, samples):
+        now = time.monotonic()
+        start = now if self.__played_by is None else max(now, self.__played_by)
+        self.__played_by = start + float(len(samples)) / ALSA_PCM_RATE
+        self.__log.record('write', now, int(samples[0][0]) if len(samples) else None)
+        wait = self.__played_by - self.__buffer_time - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, paused):
+        now = time.monotonic()
+        if paused:
+            if self.__played_by is not None:
+                self.__paused_remaining = max(0.0, self.__played_by - now)
+            self.__played_by = None
+            self.__log.record('pause', now)
+        else:
+            if self.__paused_remaining is not None:
+                self.__played_by = now + self.__paused_remaining
+            self.__paused_remaining = None
+            self.__log.record('resume', now)
+        return True
+
+    def drop(self):
+        self.__played_by = None
+        self.__paused_remaining = None
+        self.__log.record('drop', time.monotonic())
+
+    def close(self):
+        pass
+
+
+# Simulated sound device that keeps every sample written, to check what
+# was played sample by sample
+class RecordingOutput(SimulatedOutput):
+
+    def __init__(self, log):
+        SimulatedOutput.__init__(self, log)
+        self.written = []
+
+    def write(self, samples):
+        self.written.append(numpy.array(samples))
+        SimulatedOutput.write(self, samples)
+
+    def recording(self):
+        if not self.written:
+            return numpy.zeros((0, ALSA_PCM_CHANNELS), numpy.int16)
+        return numpy.concatenate(self.written)
+
+
+# Class definition for a stand-in for the sound player with nothing
+# playing, so the command switch acts on gestures as while the leds scan
+class IdlePlayer(object):
+
+    def is_active(self):
+        return False
+
+
+# Class definition for a stand-in for the ALSA mixer
+class SimulatedMixer(object):
+
+    def __init__(self, log, volume=50):
+        self.__log = log
+        self.volume = volume
+
+    def getvolume(self):
+        return [self.volume]
+
+    def setvolume(self, volume):
+        self.volume = volume
+        self.__log.record('setvolume', time.monotonic(), volume)
+
+    def close(self):
+        return 0
+
+
+# Time-ordered record of what the simulated devices were asked to do, which
+# the benchmark waits on
+class DeviceLog(object):
+
+    def __init__(self):
+        self.__entries = []
+        self.__changed = threading.Condition()
+
+    def record(self, kind, when, value=None):
+        with self.__changed:
+            self.__entries.append((when, kind, value))
+            self.__changed.notify_all()
+
+    # Wait for an entry of a kind (and value, if given) at or after a time.
+    # Returns the time of the entry, or None on timeout.
+    def wait_for(self, kind, since, value=None, timeout=BENCH_RESPONSE_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        with self.__changed:
+            checked = 0
+            while True:
+                for when, entry_kind, entry_value in self.__entries[checked:]:
+                    if when >= since and entry_kind == kind and \
+                       (value is None or entry_value == value):
+                        return when
+                checked = len(self.__entries)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.__changed.wait(remaining)
+
+
+# Percentiles (nearest rank) and mean of a list of latencies in seconds,
+# reported in milliseconds
+def summarize(latencies, missed=0):
+    summary = {'count': len(latencies), 'missed': missed}
+    if latencies:
+        ordered = sorted(latencies)
+        def percentile(p):
+            rank = int(round(p / 100.0 * (len(ordered) - 1)))
+            return round(1000.0 * ordered[rank], 3)
+        summary['mean_ms'] = round(1000.0 * sum(ordered) / len(ordered), 3)
+        summary['p50_ms'] = percentile(50)
+        summary['p90_ms'] = percentile(90)
+        summary['p99_ms'] = percentile(99)
+        summary['max_ms'] = round(1000.0 * ordered[-1], 3)
+    return summary
+
+
+# CPU time (seconds) used so far by each thread of this process, from
+# /proc, keyed by thread id
+def thread_cpu_times():
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    times = {}
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open('/proc/self/task/' + tid + '/stat') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        # utime and stime are fields 14 and 15 of stat, the 12th and 13th
+        # after the command name
+        times[int(tid)] = (int(fields[11]) + int(fields[12])) / ticks
+    return times
+
+
+# Context switches made so far by each thread of this process, from /proc,
+# keyed by thread id
+def context_switches():
+    switches = {}
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open('/proc/self/task/' + tid + '/status') as status_file:
+                # voluntary_ctxt_switches and nonvoluntary_ctxt_switches
+                switches[int(tid)] = sum(int(line.split()[1])
+                                         for line in status_file
+                                         if 'ctxt_switches:' in line)
+        except IOError:
+            continue
+    return switches
+
+
+# Resident memory (kB) of this process, from /proc
+def resident_kb():
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+# Names of the python threads by thread id. Thread ids are only known to
+# python 3.8 and later; before that threads are reported by id.
+def thread_names():
+    names = {}
+    for thread in threading.enumerate():
+        native_id = getattr(thread, 'native_id', None)
+        if native_id is not None:
+            names[native_id] = thread.name
+    return names
+
+
+def write_wave(path, level, seconds, channels=ALSA_PCM_CHANNELS):
+    frames = int(seconds * ALSA_PCM_RATE)
+    samples = numpy.full((frames, channels), level, dtype=numpy.int16)
+    wave_file = wave.open(path, 'wb')
+    wave_file.setnchannels(channels)
+    wave_file.setsampwidth(2)
+    wave_file.setframerate(ALSA_PCM_RATE)
+    wave_file.writeframes(samples.tobytes())
+    wave_file.close()
+
+
+# Class definition for the benchmark: a soundbox on simulated hardware and
+# the measurements made on it
+class SoundBench(object):
+
+    def __init__(self, work_dir, sound_seconds, runtime_mode=RUNTIME_DEFAULT):
+        self.backend = SimulatedGPIOBackend()
+        set_gpio_backend(self.backend)
+        setup_pins()
+        threaded = runtime_mode == RUNTIME_THREADS
+        if not threaded:
+            set_led_compositor(LEDCompositor(threaded=False))
+
+        # one sound per button, each a level of its own, and the prompts
+        sound_dir = os.path.join(work_dir, 'sounds')
+        prompts_dir = os.path.join(work_dir, 'prompts')
+        os.mkdir(sound_dir)
+        os.mkdir(prompts_dir)
+        self.sound_levels = {}
+        for index, button in enumerate(buttons):
+            level = 1000 * (index + 1)
+            self.sound_levels[button] = level
+            write_wave(os.path.join(sound_dir, str(index) + '.wav'), level,
+                       sound_seconds)
+        write_wave(os.path.join(prompts_dir, 'shutdown-admin-resume.wav'), 0, 1.0)
+        other_dir = os.path.join(work_dir, BENCH_OTHER_COLLECTION)
+        os.mkdir(other_dir)
+        for index in range(len(buttons)):
+            write_wave(os.path.join(other_dir, str(index) + '.wav'),
+                       BENCH_OTHER_LEVEL, sound_seconds)
+
+        # the drop zone is watched, as by soundbox.py, and indexed once
+        # the soundbox is ready
+        started = time.monotonic()
+        self.__sound_dir = sound_dir
+        self.sound_index = SoundIndex(':memory:')
+        self.reloads = []
+        self.__reloaded = threading.Condition()
+
+        self.log = DeviceLog()
+        self.mixer = SimulatedMixer(self.log)
+        self.pcm_cache = PCMCache(PCM_CACHE_BUDGET_MB_DEFAULT * 1024 * 1024)
+        output_factory = lambda: SimulatedOutput(self.log)
+        # no gain, so the sounds reach the device at their own level
+        self.sound_player = SoundPlayer('0', '0', self.pcm_cache,
+                                        output_factory=output_factory,
+                                        mixer_factory=lambda: self.mixer,
+                                        volume_thread=threaded)
+        self.sound_ingest = SoundIngest(self.sound_index)
+        self.sound_player.set_sound_ingest(self.sound_ingest)
+        self.control = SoundboxControl(self.sound_player, sound_dir,
+                                       prompts_dir, output_factory,
+                                       threaded=threaded,
+                                       sound_index=self.sound_index)
+        self.pcm_cache.preload(self.control.sound_paths())
+        self.__work_dir = work_dir
+        self.__watcher = DropZoneWatcher(work_dir, self.__drop_zone_changed,
+                                         BENCH_DROP_ZONE_DEBOUNCE_MS)
+        self.__watcher.start()
+        if threaded:
+            self.control.start()
+            run = self.control.run
+        else:
+            # the main thread drives the simulated pins, so the event loop
+            # runs on the control thread, where it cannot take signals
+            runtime = AsyncRuntime(stop_signals=())
+            run = lambda: runtime.run(self.control.run_async(runtime.loop()))
+        self.__control_thread = threading.Thread(target=run,
+                                                 name='soundbox-control')
+        # the time from creating the soundbox to its buttons being served,
+        # then what soundbox.py puts off until then
+        ready = threading.Event()
+        self.control.set_ready_callback(ready.set)
+        self.__control_thread.daemon = True
+        self.__control_thread.start()
+        ready.wait(BENCH_RESPONSE_TIMEOUT)
+        self.ready_ms = round(1000.0 * (time.monotonic() - started), 3)
+        self.sound_index.scan(work_dir)
+        self.control.reload_sounds()
+        self.control.prepare()
+        self.sound_player.volume_control().open_mixer()
+
+    def close(self):
+        self.__watcher.stop()
+        self.control.shutdown()
+        self.sound_player.close()
+        self.__control_thread.join(1.0)
+
+    def __drop_zone_changed(self, paths):
+        self.sound_index.scan(self.__work_dir)
+        self.pcm_cache.forget(paths)
+        self.control.reload_sounds()
+        self.pcm_cache.preload(self.control.sound_paths())
+        self.sound_ingest.request()
+        with self.__reloaded:
+            self.reloads.append(time.monotonic())
+            self.__reloaded.notify_all()
+
+    # Wait for the decoded sounds, so the first presses are not timed
+    # against the decoding
+    def wait_for_preload(self):
+        deadline = time.monotonic() + BENCH_RESPONSE_TIMEOUT
+        while self.pcm_cache.stats()['clips'] < len(buttons) and \
+              time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def press_button(self, button):
+        self.backend.set_input(button, BUTTON_PRESSED_LEVEL)
+
+    def release_button(self, button):
+        self.backend.set_input(button, GPIO.LOW if BUTTON_PRESSED_LEVEL else GPIO.HIGH)
+
+    # Press a button, returns the time from the press to its sound playing
+    def time_press(self, button):
+        pressed = time.monotonic()
+        self.press_button(button)
+        played = self.log.wait_for('write', pressed, self.sound_levels[button])
+        self.release_button(button)
+        if played is None:
+            return None
+        return played - pressed
+
+    def bench_press_to_playback(self, iterations):
+        latencies = []
+        for iteration in range(iterations):
+            latency = self.time_press(buttons[iteration % len(buttons)])
+            if latency is not None:
+                latencies.append(latency)
+            time.sleep(BENCH_SETTLE_TIME)
+        return summarize(latencies, iterations - len(latencies))
+
+    # Click the command switch, returns the time from the click to the
+    # sound device doing what the click asked for
+    def time_switch_click(self, expected):
+        clicked = time.monotonic()
+        self.backend.set_input(ROTARY_SWITCH_PIN, GPIO.LOW)
+        time.sleep(SWITCH_CLICK_TIME)
+        self.backend.set_input(ROTARY_SWITCH_PIN, GPIO.HIGH)
+        done = self.log.wait_for(expected, clicked)
+        if done is None:
+            return None
+        return done - clicked
+
+    def bench_pause(self, iterations):
+        self.time_press(buttons[0])
+        time.sleep(BENCH_SETTLE_TIME)
+        pauses = []
+        resumes = []
+        for iteration in range(iterations):
+            latency = self.time_switch_click('pause')
+            if latency is not None:
+                pauses.append(latency)
+            time.sleep(BENCH_SETTLE_TIME)
+            latency = self.time_switch_click('resume')
+            if latency is not None:
+                resumes.append(latency)
+            time.sleep(BENCH_SETTLE_TIME)
+        return (summarize(pauses, iterations - len(pauses)),
+                summarize(resumes, iterations - len(resumes)))
+
+    # Turn the knob through detents, up for positive counts, waiting
+    # edge_time between the edges. Returns the time of the last edge.
+    def turn_knob(self, detents, edge_time):
+        spin = edge_time < SPIN_SLEEP_RESOLUTION
+        states = ENCODER_UP_STATES if detents > 0 else \
+                 tuple(reversed(ENCODER_UP_STATES[:-1])) + ((0, 0),)
+        last_edge = None
+        for detent in range(abs(detents)):
+            for a, b in states:
+                if last_edge is not None and spin:
+                    while time.monotonic() < last_edge + edge_time:
+                        pass
+                elif last_edge is not None:
+                    time.sleep(edge_time)
+                last_edge = time.monotonic()
+                self.backend.set_input(ROTARY_PIN_A, a)
+                self.backend.set_input(ROTARY_PIN_B, b)
+        return last_edge
+
+    def bench_encoder(self, iterations):
+        latencies = []
+        for iteration in range(iterations):
+            # alternate up and down so the volume never reaches its limits
+            direction = 1 if iteration % 2 == 0 else -1
+            turned = self.turn_knob(direction, ENCODER_EDGE_TIME)
+            changed = self.log.wait_for('setvolume', turned)
+            if changed is not None:
+                latencies.append(changed - turned)
+            time.sleep(0.05)
+        return summarize(latencies, iterations - len(latencies))
+
+    # Spin the knob fast, up and then back down, and count the detents
+    # that did not reach the mixer and the mixer writes made for them
+    def check_encoder_spin(self, detents=SPIN_DETENTS, rate=SPIN_RATE):
+        edge_time = 1.0 / (rate * len(ENCODER_UP_STATES))
+        start_volume = self.mixer.volume
+        start_writes = self.sound_player.volume_control().stats()['mixer_writes']
+        lost = 0
+        for direction in (1, -1):
+            before = self.mixer.volume
+            expected = before + direction * detents * VOLUME_DELTA
+            self.turn_knob(direction * detents, edge_time)
+            deadline = time.monotonic() + 2.0
+            while self.mixer.volume != expected and time.monotonic() < deadline:
+                time.sleep(0.01)
+            lost += abs(expected - self.mixer.volume) // VOLUME_DELTA
+        writes = self.sound_player.volume_control().stats()['mixer_writes']
+        return {'detents': 2 * detents, 'rate_per_second': rate, 'lost': lost,
+                'mixer_writes': writes - start_writes,
+                'start_volume': start_volume, 'end_volume': self.mixer.volume}
+
+    # Hold a command switch down with each of the menu hold timings and
+    # time how long after the press the switch opens the menu
+    def check_menu_hold(self):
+        self.backend.setup(BENCH_MENU_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        results = []
+        for long_press_ms, hold_repeat_ms, menu_hold_ms in BENCH_MENU_HOLD_TIMINGS:
+            timing = GestureTiming(long_press_ms=long_press_ms,
+                                   hold_repeat_ms=hold_repeat_ms,
+                                   menu_hold_ms=menu_hold_ms)
+            recognizer = GestureRecognizer(timing, threaded=False)
+            switch = CommandSwitch(None, threading.Event(), IdlePlayer(), None,
+                                   gesture_recognizer=recognizer)
+            opened = []
+            switch.set_menu_runner(lambda menu: opened.append(time.monotonic()))
+            recognizer.watch(BENCH_MENU_PIN, GPIO.LOW, switch.handle_gesture)
+            pressed = time.monotonic()
+            self.backend.set_input(BENCH_MENU_PIN, GPIO.LOW)
+            self.backend.settle()
+            deadline = pressed + 2 * menu_hold_ms / 1000.0
+            while not opened and time.monotonic() < deadline:
+                due = recognizer.step()
+                if due is not None:
+                    time.sleep(max(0.0, min(due, deadline) - time.monotonic()))
+                else:
+                    time.sleep(0.01)
+            self.backend.set_input(BENCH_MENU_PIN, GPIO.HIGH)
+            self.backend.settle()
+            recognizer.unwatch(BENCH_MENU_PIN)
+            opened_ms = None
+            if opened:
+                opened_ms = round(1000.0 * (opened[0] - pressed), 1)
+            results.append({'long_press_ms': long_press_ms,
+                            'hold_repeat_ms': hold_repeat_ms,
+                            'menu_hold_ms': menu_hold_ms,
+                            'opened_ms': opened_ms,
+                            'on_time': opened_ms is not None and
+                                       abs(opened_ms - menu_hold_ms) <=
+                                       BENCH_MENU_HOLD_TOLERANCE_MS})
+        return results
+
+    # Replace the sound of the second button while the first one plays, and
+    # check that the playing sound carries on, that the file written in
+    # pieces makes one rebuild, and that the button then plays the new
+    # sound
+    def check_drop_zone_reload(self):
+        self.time_press(buttons[0])
+        time.sleep(BENCH_SETTLE_TIME)
+        reloads = len(self.reloads)
+        replaced = time.monotonic()
+        write_wave(os.path.join(self.__sound_dir, '1.wav'),
+                   BENCH_REPLACED_LEVEL, 1.0)
+        written = time.monotonic()
+        with self.__reloaded:
+            self.__reloaded.wait_for(lambda: len(self.reloads) > reloads,
+                                     BENCH_RESPONSE_TIMEOUT)
+        # wait out another debounce time, for any extra rebuild
+        time.sleep(2 * BENCH_DROP_ZONE_DEBOUNCE_MS / 1000.0)
+        rebuilds = len(self.reloads) - reloads
+        reloaded = self.reloads[reloads] if rebuilds else None
+        interrupted = self.log.wait_for('drop', replaced, timeout=0) is not None or \
+                      self.log.wait_for('write', time.monotonic(),
+                                        self.sound_levels[buttons[0]]) is None
+        self.sound_levels[buttons[1]] = BENCH_REPLACED_LEVEL
+        played = self.time_press(buttons[1])
+        time.sleep(BENCH_SETTLE_TIME)
+        return {'rebuilds': rebuilds,
+                'reload_ms': None if reloaded is None else
+                             round(1000.0 * (reloaded - written), 3),
+                'interrupted': interrupted,
+                'new_sound_played': played is not None}
+
+    # Copy a mono sound into the drop zone, which is not in the sound
+    # card's format, and time its rendition being made. A part file left
+    # as by a power cut is to be cleared away. The button then plays the
+    # rendition, decoded again from it.
+    def check_ingest(self):
+        path = os.path.join(self.__sound_dir, '2.wav')
+        rendition_dir = os.path.join(self.__sound_dir, RENDITION_DIR_NAME)
+        if not os.path.isdir(rendition_dir):
+            os.mkdir(rendition_dir)
+        stale_part = os.path.join(rendition_dir, 'cut-short' + RENDITION_SUFFIX +
+                                  RENDITION_PART_SUFFIX)
+        with open(stale_part, 'wb') as part_file:
+            part_file.write(b'RIFF')
+        reloads = len(self.reloads)
+        written = time.monotonic()
+        write_wave(path, BENCH_MONO_LEVEL, 1.0, channels=1)
+        with self.__reloaded:
+            self.__reloaded.wait_for(lambda: len(self.reloads) > reloads,
+                                     BENCH_RESPONSE_TIMEOUT)
+        self.sound_ingest.wait_idle(BENCH_RESPONSE_TIMEOUT)
+        rendered = time.monotonic()
+        source = self.sound_ingest.source_for(path)
+        self.pcm_cache.forget([path])
+        self.sound_levels[buttons[2]] = BENCH_MONO_LEVEL
+        played = self.time_press(buttons[2])
+        time.sleep(BENCH_SETTLE_TIME)
+        return {'rendered': source != path and os.path.isfile(source),
+                'ready_ms': round(1000.0 * (rendered - written), 3),
+                'part_cleared': not os.path.exists(stale_part),
+                'rendition_played': played is not None}
+
+    # Switch to the other collection and time it, press a button of it,
+    # and switch back
+    def check_collection_switch(self):
+        started = time.monotonic()
+        selected = self.control.select_collection(BENCH_OTHER_COLLECTION)
+        switched = time.monotonic()
+        other_paths = self.control.sound_paths()
+        deadline = switched + BENCH_RESPONSE_TIMEOUT
+        while not all(self.pcm_cache.is_cached(path) for path in other_paths) and \
+              time.monotonic() < deadline:
+            time.sleep(0.01)
+        decoded = time.monotonic()
+        pressed = time.monotonic()
+        self.press_button(buttons[0])
+        played = self.log.wait_for('write', pressed, BENCH_OTHER_LEVEL)
+        self.release_button(buttons[0])
+        time.sleep(BENCH_SETTLE_TIME)
+        self.control.select_collection(os.path.basename(self.__sound_dir))
+        self.wait_for_preload()
+        return {'selected': selected,
+                'switch_ms': round(1000.0 * (switched - started), 3),
+                'decoded_ms': round(1000.0 * (decoded - switched), 3),
+                'press_to_playback_ms': None if played is None else
+                                        round(1000.0 * (played - pressed), 3)}
+
+    # CPU used by each thread over a time in which nothing is asked of
+    # the soundbox
+    def measure_idle_cpu(self, seconds):
+        switches = context_switches()
+        before = thread_cpu_times()
+        time.sleep(seconds)
+        after = thread_cpu_times()
+        # threads that came or went meanwhile are left out
+        switches = sum(count - switches[tid]
+                       for tid, count in context_switches().items()
+                       if tid in switches)
+        names = thread_names()
+        threads = {}
+        for tid, cpu in after.items():
+            used = cpu - before.get(tid, 0.0)
+            name = names.get(tid, 'thread') + ' (' + str(tid) + ')'
+            threads[name] = round(100.0 * used / seconds, 2)
+        return {'seconds': seconds,
+                'total_percent': round(sum(threads.values()), 2),
+                'threads_percent': threads,
+                'threads': len(after),
+                'context_switches_per_second': round(switches / seconds, 1),
+                'rss_kb': resident_kb(),
+                'busy_threads': sorted(name for name, percent in threads.items()
+                                       if percent > IDLE_CPU_LIMIT)}
+
+    # CPU used while the soundbox waits for the user: with a sound paused,
+    # and with a ButtonMonitor waiting for the answer to a menu. The
+    # buttons are taken from the control flow for the menu, so this has to
+    # come last.
+    def bench_idle_waits(self, seconds):
+        waits = {}
+        self.time_press(buttons[1])
+        time.sleep(BENCH_SETTLE_TIME)
+        self.time_switch_click('pause')
+        time.sleep(BENCH_SETTLE_TIME)
+        waits['paused'] = self.measure_idle_cpu(seconds)
+        self.time_switch_click('resume')
+        time.sleep(BENCH_SETTLE_TIME)
+
+        self.control.shutdown()
+        answers = []
+        monitor = ButtonMonitor(1)
+        monitor_thread = threading.Thread(
+            target=lambda: answers.extend(monitor.get_button_presses()),
+            name='button-monitor')
+        monitor_thread.daemon = True
+        monitor_thread.start()
+        time.sleep(BENCH_SETTLE_TIME)
+        waits['button_monitor'] = self.measure_idle_cpu(seconds)
+        # a press, counted on release as by the menus
+        self.press_button(buttons[0])
+        self.release_button(buttons[0])
+        monitor_thread.join(BENCH_RESPONSE_TIMEOUT)
+        waits['button_monitor']['answered'] = answers == [buttons[0]]
+        return waits
+
+
+# Index the sound files below work_dir, first into a new index and then
+# again from the index left by that, as a start with nothing changed
+def bench_sound_index(work_dir):
+    index_path = os.path.join(work_dir, SOUND_INDEX_FILE_NAME)
+    started = time.monotonic()
+    sound_index = SoundIndex(index_path)
+    cold = sound_index.scan(work_dir)
+    sound_index.close()
+    cold_time = time.monotonic() - started
+    started = time.monotonic()
+    sound_index = SoundIndex(index_path)
+    warm = sound_index.scan(work_dir)
+    sound_index.close()
+    warm_time = time.monotonic() - started
+    return {'files': cold['files'], 'probed': cold['probed'],
+            'reprobed': warm['probed'],
+            'cold_ms': round(1000.0 * cold_time, 3),
+            'warm_ms': round(1000.0 * warm_time, 3)}
+
+
+# Stand-in for the sound device that takes samples as fast as they come,
+# so the mixer is timed on nothing but its own work. It keeps the loudest
+# sample written.
+class CountingOutput(object):
+
+    def __init__(self):
+        self.writes = 0
+        self.loudest = 0
+
+    def write(self, samples):
+        self.writes += 1
+        if len(samples):
+            # not numpy.abs(), which leaves -32768 as it is in int16
+            self.loudest = max(self.loudest, int(samples.max()), -int(samples.min()))
+
+    def pause(self, paused):
+        return True
+
+    def drop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Time the voice mixer mixing a period of 1, 2, 4 and 8 voices of noise,
+# which should cost a fixed amount plus the same for each voice, and check
+# that the loud mixes are soft clipped rather than hard clipped, and that
+# a sound started with every voice playing takes the oldest one's place.
+# It needs no soundbox, only the processor.
+def bench_voice_mixer(periods, period_frames=ALSA_PERIOD_FRAMES):
+    frames = periods * period_frames
+    noise = numpy.random.randint(-BENCH_MIXER_LEVEL, BENCH_MIXER_LEVEL,
+                                 (frames * max(BENCH_MIXER_VOICES),
+                                  ALSA_PCM_CHANNELS)).astype(numpy.int16)
+    outputs = []
+    mix_us = {}
+    for voices in BENCH_MIXER_VOICES:
+        output = CountingOutput()
+        outputs.append(output)
+        mixer = VoiceMixer(lambda: output, voices, period_frames)
+        handles = [mixer.play(ClipDecoder(PCMClip(str(voice),
+                                                  noise[voice * frames:(voice + 1) * frames])),
+                              1.0, voice)
+                   for voice in range(voices)]
+        for handle in handles:
+            handle.wait(BENCH_RESPONSE_TIMEOUT)
+        mix_us[voices] = mixer.stats()['mix_us'].get(voices)
+        mixer.close()
+    per_voice_us, fixed_us = numpy.polyfit(BENCH_MIXER_VOICES,
+                                           [mix_us[voices] for voices in BENCH_MIXER_VOICES], 1)
+
+    mixer = VoiceMixer(CountingOutput, 2, period_frames)
+    clip = PCMClip('steal', noise[:frames])
+    handles = [mixer.play(ClipDecoder(clip), 1.0, key) for key in range(3)]
+    oldest_stolen = handles[0].wait(BENCH_RESPONSE_TIMEOUT) == PLAYBACK_STOPPED and \
+        handles[1].returncode is None and handles[2].returncode is None
+    mixer.stop()
+    mixer.close()
+    return {'mix_us': mix_us, 'per_voice_us': round(per_voice_us, 1),
+            'fixed_us': round(fixed_us, 1),
+            'period_us': round(1e6 * period_frames / ALSA_PCM_RATE, 1),
+            'loudest': max(output.loudest for output in outputs),
+            'oldest_stolen': oldest_stolen}
+
+
+# Switch from one sound to another and stop it, through a mixer of one
+# voice with a crossfade and a fade out, on a simulated device that plays
+# at the pace of a real one, and check the recording of what was played:
+# how long the crossfade and fade out took, that the level never fell
+# between the two sounds (no gap) and the largest step from one sample
+# to the next (a click is a step of the size of the sound's level).
+# It needs no soundbox, only the processor.
+def check_transitions():
+    log = DeviceLog()
+    output = RecordingOutput(log)
+    mixer = VoiceMixer(lambda: output, 1, crossfade_ms=BENCH_CROSSFADE_MS,
+                       fade_out_ms=BENCH_FADE_OUT_MS)
+    first, second = BENCH_TRANSITION_LEVELS
+    clips = [PCMClip(str(level), numpy.full((10 * ALSA_PCM_RATE, ALSA_PCM_CHANNELS),
+                                            level, numpy.int16))
+             for level in BENCH_TRANSITION_LEVELS]
+    mixer.play(ClipDecoder(clips[0]))
+    time.sleep(BENCH_SETTLE_TIME)
+    mixer.play(ClipDecoder(clips[1]))
+    time.sleep(BENCH_SETTLE_TIME)
+    mixer.stop()
+    time.sleep(BENCH_SETTLE_TIME)
+    mixer.close()
+
+    played = output.recording()[:, 0].astype(numpy.int32)
+    frames_ms = 1000.0 / ALSA_PCM_RATE
+    # the crossfade runs from the last sample of the first sound alone to
+    # the first of the second alone, the fade out from the last sample of
+    # the second sound to silence
+    crossfade_start = int(numpy.argmax(played != first))
+    crossfade_end = crossfade_start + int(numpy.argmax(played[crossfade_start:] == second))
+    fade_start = crossfade_end + int(numpy.argmax(played[crossfade_end:] != second))
+    fade_end = fade_start + int(numpy.argmax(played[fade_start:] == 0))
+    crossfade_ms = (crossfade_end - crossfade_start) * frames_ms
+    fade_out_ms = (fade_end - fade_start) * frames_ms
+    # the fades are made a period at a time, so each may be off by one
+    period_ms = 1000.0 * ALSA_PERIOD_FRAMES / ALSA_PCM_RATE
+    return {'crossfade_ms': round(crossfade_ms, 1),
+            'fade_out_ms': round(fade_out_ms, 1),
+            'on_time': abs(crossfade_ms - BENCH_CROSSFADE_MS) <= period_ms and
+                       abs(fade_out_ms - BENCH_FADE_OUT_MS) <= period_ms,
+            'gap_frames': int(numpy.count_nonzero(
+                played[crossfade_start:crossfade_end] < second)),
+            'largest_step': int(numpy.abs(numpy.diff(played[:fade_end + 1])).max()),
+            'ends_silent': bool(len(played) and played[-1] == 0)}
+
+
+# Time the gain stage scaling one period of noise while it ramps between
+# two volumes. It needs no soundbox, only the processor.
+def bench_gain_stage(iterations, period_frames=ALSA_PERIOD_FRAMES):
+    samples = numpy.random.randint(-20000, 20000,
+                                   (period_frames, ALSA_PCM_CHANNELS)).astype(numpy.int16)
+    latencies = []
+    for curve in GAIN_RAMP_CURVES:
+        stage = GainStage(0.25, curve=curve)
+        for iteration in range(iterations):
+            # a ramp longer than the period, so every period is ramping
+            stage.set_gain(0.25 if iteration % 2 else 0.75, 1000)
+            started = time.perf_counter()
+            stage.process(samples)
+            latencies.append(time.perf_counter() - started)
+    summary = summarize(latencies)
+    summary['period_ms'] = round(1000.0 * period_frames / ALSA_PCM_RATE, 3)
+    return summary
+
+
+# Most memory (bytes) traced by tracemalloc that any one call of
+# process(samples) allocates, for samples in periods, if only for a moment
+def most_allocated(process, periods):
+    most = 0
+    for samples in periods:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        process(samples)
+        most = max(most, tracemalloc.get_traced_memory()[1] - before)
+    return most
+
+
+# Time each stage of a DSP chain on periods of noise, and check that once
+# running it allocates no buffers (numpy reports its buffers to
+# tracemalloc), neither for a moment within a period nor kept from one
+# period to the next, and that the limiter keeps every sample under its
+# threshold. It needs no soundbox, only the processor.
+def bench_dsp_chain(iterations, period_frames=ALSA_PERIOD_FRAMES):
+    noise = numpy.random.randint(-BENCH_DSP_LEVEL, BENCH_DSP_LEVEL,
+                                 (iterations * period_frames, ALSA_PCM_CHANNELS))
+    periods = list(noise.astype(numpy.float32).reshape(iterations, period_frames,
+                                                       ALSA_PCM_CHANNELS))
+    chain = DSPChain(BENCH_DSP_STAGES, period_frames)
+    loudest = 0
+    for samples in periods:
+        loudest = max(loudest, int(numpy.abs(chain.process(samples)).max()))
+    stats = chain.stats()
+
+    tracemalloc.start()
+    try:
+        # the same loop doing nothing, for what the measuring allocates
+        overhead = most_allocated(lambda samples: None, periods)
+        started = tracemalloc.get_traced_memory()[0]
+        allocated = most_allocated(chain.process, periods) - overhead
+        kept = tracemalloc.get_traced_memory()[0] - started
+    finally:
+        tracemalloc.stop()
+    threshold = 32768.0 * 10.0 ** (BENCH_DSP_STAGES[-1][1] / 20.0)
+    stats['allocated_per_period'] = allocated
+    stats['kept_bytes'] = kept
+    stats['limited'] = loudest <= int(math.ceil(threshold))
+    return stats
+
+
+# Measure tones recorded at different levels, play them at the gains that
+# normalize them and measure what they play at. The loudness of the
+# played tones should be the same and their true peaks under the limit.
+# It needs no soundbox, only the processor.
+def check_loudness(seconds):
+    frames = int(seconds * ALSA_PCM_RATE)
+    t = numpy.arange(frames) / float(ALSA_PCM_RATE)
+    measured = []
+    played = []
+    started = time.perf_counter()
+    for frequency, level in BENCH_LOUDNESS_TONES:
+        tone = 32767.0 * 10.0 ** (level / 20.0) * numpy.sin(2 * numpy.pi * frequency * t)
+        samples = numpy.repeat(tone.astype(numpy.int16).reshape(-1, 1),
+                               ALSA_PCM_CHANNELS, axis=1)
+        loudness, true_peak = measure_loudness(ClipDecoder(PCMClip('tone', samples)))
+        measured.append(loudness)
+        gain = millibels_to_gain(normalizing_millibels(loudness, true_peak))
+        scaled = numpy.clip(samples * gain, -32768, 32767).astype(numpy.int16)
+        played.append(measure_loudness(ClipDecoder(PCMClip('tone', scaled))))
+    elapsed = time.perf_counter() - started
+    return {'measured_spread_lu': round(max(measured) - min(measured), 2),
+            'played_spread_lu': round(max(loudness for loudness, peak in played) -
+                                      min(loudness for loudness, peak in played), 2),
+            'played_max_true_peak': max(peak for loudness, peak in played),
+            'realtime_factor': round(2 * len(BENCH_LOUDNESS_TONES) * seconds /
+                                     elapsed, 1)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    work_dir = tempfile.mkdtemp(prefix='soundbench-')
+    bench = SoundBench(work_dir, args.sound_seconds, args.runtime)
+    try:
+        bench.wait_for_preload()
+        # let start up settle before timing anything
+        time.sleep(1.0)
+        results = {}
+        results['ready_ms'] = bench.ready_ms
+        results['idle_cpu'] = bench.measure_idle_cpu(args.idle_seconds)
+        results['press_to_playback'] = bench.bench_press_to_playback(args.iterations)
+        results['pause'], results['resume'] = bench.bench_pause(args.iterations)
+        results['encoder_to_mixer'] = bench.bench_encoder(args.iterations)
+        results['encoder_spin'] = bench.check_encoder_spin()
+        results['encoder_fast_spin'] = bench.check_encoder_spin(rate=SPIN_FAST_RATE)
+        results['menu_hold'] = bench.check_menu_hold()
+        results['drop_zone'] = bench.check_drop_zone_reload()
+        results['collection_switch'] = bench.check_collection_switch()
+        results['ingest'] = bench.check_ingest()
+        results['idle_waits'] = bench.bench_idle_waits(args.idle_seconds)
+        results['gain_stage'] = bench_gain_stage(100 * args.iterations)
+        results['dsp_chain'] = bench_dsp_chain(100 * args.iterations)
+        results['voice_mixer'] = bench_voice_mixer(100 * args.iterations)
+        results['transitions'] = check_transitions()
+        results['sound_index'] = bench_sound_index(work_dir)
+        results['loudness'] = check_loudness(args.sound_seconds)
+        return results
+    finally:
+        bench.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_results(report, baseline, out):
+    results = report['results']
+    out.write('soundbench ' + str(report['commit']) + ' (' +
+              report['runtime'] + ' runtime)\n')
+    for name in ('press_to_playback', 'pause', 'resume', 'encoder_to_mixer'):
+        summary = results[name]
+        line = '  %-18s' % name
+        for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'):
+            value = summary.get(key)
+            line += ' %s=%s' % (key[:-3], '-' if value is None else '%.1f' % value)
+            if baseline is not None:
+                old = baseline['results'].get(name, {}).get(key)
+                if old is not None and value is not None:
+                    line += '(%+.1f)' % (value - old)
+        line += ' ms, %d missed\n' % summary['missed']
+        out.write(line)
+    idle_reports = [('idle_cpu', results['idle_cpu'],
+                     baseline and baseline['results'].get('idle_cpu'))]
+    for name, idle in sorted(results['idle_waits'].items()):
+        old = baseline and baseline['results'].get('idle_waits', {}).get(name)
+        idle_reports.append(('idle_' + name, idle, old))
+    for name, idle, old in idle_reports:
+        line = '  %-18s total=%.2f%%' % (name, idle['total_percent'])
+        if old:
+            line += '(%+.2f)' % (idle['total_percent'] - old['total_percent'])
+        line += ' threads=%d switches=%.1f/s rss=%skB' % (
+            idle['threads'], idle['context_switches_per_second'], idle['rss_kb'])
+        if idle['busy_threads']:
+            line += ' BUSY: ' + ', '.join(idle['busy_threads'])
+        out.write(line + '\n')
+        for thread, percent in sorted(idle['threads_percent'].items()):
+            if percent > 0:
+                out.write('    %-30s %.2f%%\n' % (thread, percent))
+    gain = results['gain_stage']
+    out.write('  %-18s p50=%.1f p99=%.1f max=%.1f us per %.1f ms period\n' %
+              ('gain_stage', 1000.0 * gain['p50_ms'], 1000.0 * gain['p99_ms'],
+               1000.0 * gain['max_ms'], gain['period_ms']))
+    dsp = results['dsp_chain']
+    for stage in dsp['stages']:
+        out.write('  %-18s mean=%.1f max=%.1f us per %.1f ms period\n' %
+                  ('dsp_' + stage['stage'], stage['mean_us'], stage['max_us'],
+                   dsp['period_us'] / 1000.0))
+    out.write('  %-18s %.2f%% of the period, %d bytes allocated per period '
+              '(%d kept), %s\n' %
+              ('dsp_chain', dsp['budget_percent'], dsp['allocated_per_period'],
+               dsp['kept_bytes'],
+               'limited' if dsp['limited'] else 'OVER THE LIMITER THRESHOLD'))
+    mixer = results['voice_mixer']
+    out.write('  %-18s %s us per %.1f ms period, %.1f us + %.1f us per voice, '
+              'loudest %d, %s\n' %
+              ('voice_mixer', ' '.join('%d=%.1f' % (voices, mixer['mix_us'][voices])
+                                       for voices in sorted(mixer['mix_us'])),
+               mixer['period_us'] / 1000.0, mixer['fixed_us'],
+               mixer['per_voice_us'], mixer['loudest'],
+               'oldest voice stolen' if mixer['oldest_stolen']
+               else 'OLDEST VOICE NOT STOLEN'))
+    transitions = results['transitions']
+    out.write('  %-18s crossfade=%.1f ms fade_out=%.1f ms (asked %d and %d%s), '
+              '%d gap frames, largest step %d, %s\n' %
+              ('transitions', transitions['crossfade_ms'],
+               transitions['fade_out_ms'], BENCH_CROSSFADE_MS, BENCH_FADE_OUT_MS,
+               '' if transitions['on_time'] else ', OFF BY MORE THAN A PERIOD',
+               transitions['gap_frames'], transitions['largest_step'],
+               'ends in silence' if transitions['ends_silent']
+               else 'DOES NOT END IN SILENCE'))
+    index = results['sound_index']
+    out.write('  %-18s %d files, cold=%.1f ms warm=%.1f ms, %d reprobed\n' %
+              ('sound_index', index['files'], index['cold_ms'],
+               index['warm_ms'], index['reprobed']))
+    drop_zone = results['drop_zone']
+    out.write('  %-18s reload=%s ms after the write, %d rebuilds, %s, %s\n' %
+              ('drop_zone', drop_zone['reload_ms'], drop_zone['rebuilds'],
+               'INTERRUPTED' if drop_zone['interrupted'] else 'not interrupted',
+               'new sound played' if drop_zone['new_sound_played']
+               else 'NEW SOUND NOT PLAYED'))
+    switch = results['collection_switch']
+    out.write('  %-18s switch=%.1f ms, decoded after %.1f ms, press_to_playback=%s ms%s\n' %
+              ('collection_switch', switch['switch_ms'], switch['decoded_ms'],
+               switch['press_to_playback_ms'],
+               '' if switch['selected'] else ' NOT SELECTED'))
+    loudness = results['loudness']
+    out.write('  %-18s %.1f LU apart as recorded, %.1f LU as played%s, '
+              'true peak %.1f dBTP, measured at %.0fx real time\n' %
+              ('loudness', loudness['measured_spread_lu'],
+               loudness['played_spread_lu'],
+               '' if loudness['played_spread_lu'] <= BENCH_LOUDNESS_SPREAD_LU
+               else ' NOT NORMALIZED',
+               loudness['played_max_true_peak'], loudness['realtime_factor']))
+    ingest = results['ingest']
+    out.write('  %-18s rendition ready %s ms after the write, %s, %s, %s\n' %
+              ('ingest', ingest['ready_ms'],
+               'rendered' if ingest['rendered'] else 'NOT RENDERED',
+               'part file cleared' if ingest['part_cleared'] else 'PART FILE LEFT',
+               'rendition played' if ingest['rendition_played']
+               else 'RENDITION NOT PLAYED'))
+    for hold in results['menu_hold']:
+        out.write('  %-18s long_press=%d hold_repeat=%d menu_hold=%d ms, opened '
+                  'after %s ms%s\n' %
+                  ('menu_hold', hold['long_press_ms'], hold['hold_repeat_ms'],
+                   hold['menu_hold_ms'], hold['opened_ms'],
+                   '' if hold['on_time'] else ' NOT ON TIME'))
+    out.write('  %-18s %.1f ms from start to buttons served\n' %
+              ('ready', results['ready_ms']))
+    for name in ('encoder_spin', 'encoder_fast_spin'):
+        spin = results[name]
+        out.write('  %-18s %d detents at %.0f/s (%.0f transitions/s), %d lost, '
+                  '%d mixer writes\n' %
+                  (name, spin['detents'], spin['rate_per_second'],
+                   spin['rate_per_second'] * len(ENCODER_UP_STATES),
+                   spin['lost'], spin['mixer_writes']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the soundbox control flow on simulated hardware')
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='measurements per latency (default 20)')
+    parser.add_argument('--idle-seconds', type=float, default=5.0,
+                        help='time idle CPU is measured over (default 5)')
+    parser.add_argument('--sound-seconds', type=float, default=10.0,
+                        help='length of the test sounds (default 10)')
+    parser.add_argument('--json', help='write the results to this file, - for stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--runtime', choices=RUNTIME_MODES, default=RUNTIME_DEFAULT,
+                        help='run the control flow on threads or an asyncio '
+                             'event loop (default threads)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show what the soundbox prints while benchmarked')
+    args = parser.parse_args()
+
+    # the soundbox prints as it works, keep that out of the results
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    report = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'iterations': args.iterations,
+              'runtime': args.runtime,
+              'results': run_benchmarks(args)}
+
+    print_results(report, baseline, out)
+    if args.json == '-':
+        out.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+    elif args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+
+    # a result showing something broken, not just slow, fails the run:
+    #   a lost detent or a thread busy while idle,
+    #   a menu opened late,
+    #   a DSP period that allocates a buffer,
+    #   a drop zone reload that interrupts the playing sound, or after
+    #   which the button does not play its new sound,
+    #   a mixer that steals the wrong voice or clips a sum past full scale,
+    #   a transition that clicks, leaves a gap, takes the wrong time or does
+    #   not end in silence,
+    #   a sound copied in that is not rendered, a part file left behind, or
+    #   a rendition that does not play,
+    #   sounds that still play further apart in loudness than
+    #   BENCH_LOUDNESS_SPREAD_LU,
+    #   a collection that is not selected, or whose sound a button does not
+    #   play once it is
+    results = report['results']
+    failed = results['encoder_spin']['lost'] or \
+             results['encoder_fast_spin']['lost'] or results['idle_cpu']['busy_threads']
+    for idle in results['idle_waits'].values():
+        failed = failed or idle['busy_threads']
+    failed = failed or not results['idle_waits']['button_monitor']['answered']
+    for hold in results['menu_hold']:
+        failed = failed or not hold['on_time']
+    failed = failed or \
+        results['dsp_chain']['allocated_per_period'] > BENCH_DSP_PERIOD_ALLOCATION
+    drop_zone = results['drop_zone']
+    failed = failed or drop_zone['interrupted'] or \
+        not drop_zone['new_sound_played']
+    mixer = results['voice_mixer']
+    failed = failed or not mixer['oldest_stolen'] or \
+        mixer['loudest'] > BENCH_FULL_SCALE
+    transitions = results['transitions']
+    failed = failed or transitions['gap_frames'] != 0 or \
+        not transitions['ends_silent'] or not transitions['on_time'] or \
+        transitions['largest_step'] > BENCH_TRANSITION_STEP_LIMIT
+    ingest = results['ingest']
+    failed = failed or not ingest['rendered'] or not ingest['part_cleared'] or \
+        not ingest['rendition_played']
+    failed = failed or \
+        results['loudness']['played_spread_lu'] > BENCH_LOUDNESS_SPREAD_LU
+    switch = results['collection_switch']
+    failed = failed or not switch['selected'] or \
+        switch['press_to_playback_ms'] is None
+    sys.exit(1 if failed else 0)
@@ -2,14 +2,18 @@ import time
 import sys
 import os
 import signal
-import subprocess
 from os import listdir
 
 import configparser
 
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
 from threading import Thread
 from threading import Event
+from threading import Condition
+
+from promptplayer import PromptPlayer
+from playbackengine import millibels_to_gain
+from fadetable import fade_table, sleep_until
 
 
 # Symbolic 'constants' for the Raspberry Pi pins where buttons are connected
@@ -43,6 +47,9 @@ DIR_RED     = SOUND_HOME_DIR + "/red"
 
 DIR_PROMPTS = SOUND_HOME_DIR + "/prompts/"
 
+# Gain for the closing prompts, which omxplayer used to play at --vol 300
+PROMPT_GAIN = millibels_to_gain(300)
+
 # Lists that are handy when setting and changing things
 buttons = (BUTTON_WHITE, BUTTON_BLUE, BUTTON_GREEN, BUTTON_YELLOW, BUTTON_RED)
 leds = (LED_WHITE, LED_BLUE, LED_GREEN, LED_YELLOW, LED_RED)
@@ -57,6 +64,13 @@ def authenticate(entered_list, accepted_list):
 
 class LEDController(object):
 
+    # Number of steps, and time taken, to fade from dark to fully lit
+    FADE_STEPS = 100
+    FADE_TIME = 1.0
+
+    # Time between leds going off during the countdown
+    COUNTDOWN_TIME = 1.0
+
     def __init__(self, num_dimming_cycles):
         self.__keep_running = True
         # Store the number of dark-->light-->dark cycles before
@@ -69,6 +83,11 @@ class LEDController(object):
         self.__pwm_green   = GPIO.PWM(LED_GREEN, 50)
         self.__pwm_yellow  = GPIO.PWM(LED_YELLOW, 50)
         self.__pwm_red     = GPIO.PWM(LED_RED, 50)
+        self.__all_pwms = (self.__pwm_white, self.__pwm_blue, self.__pwm_green,
+                           self.__pwm_yellow, self.__pwm_red)
+
+        # Last duty cycle set on each pwm, so unchanged ones are not set again
+        self.__duty_cycles = {}
 
         # LEDs fully dimmed to start
         self.__pwm_white.start(0)
@@ -76,6 +95,8 @@ class LEDController(object):
         self.__pwm_green.start(0)
         self.__pwm_yellow.start(0)
         self.__pwm_red.start(0)
+        for pwm in self.__all_pwms:
+            self.__duty_cycles[pwm] = 0
 
     def flash(self, button_id, count):
         self.go_dark()
@@ -85,15 +106,15 @@ class LEDController(object):
         for counter in range(0, count*2):
             counter += 1
             if (button_id == BUTTON_WHITE):
-                self.__pwm_white.ChangeDutyCycle(duty_cycle)
+                self.__set_duty_cycle(self.__pwm_white, duty_cycle)
             if (button_id == BUTTON_BLUE):
-                self.__pwm_blue.ChangeDutyCycle(duty_cycle)
+                self.__set_duty_cycle(self.__pwm_blue, duty_cycle)
             if (button_id == BUTTON_GREEN):
-                self.__pwm_green.ChangeDutyCycle(duty_cycle)
+                self.__set_duty_cycle(self.__pwm_green, duty_cycle)
             if (button_id == BUTTON_YELLOW):
-                self.__pwm_yellow.ChangeDutyCycle(duty_cycle)
+                self.__set_duty_cycle(self.__pwm_yellow, duty_cycle)
             if (button_id == BUTTON_RED):
-                self.__pwm_red.ChangeDutyCycle(duty_cycle)
+                self.__set_duty_cycle(self.__pwm_red, duty_cycle)
             if duty_cycle == 0:
                 duty_cycle = 100
             else:
@@ -103,35 +124,38 @@ class LEDController(object):
 
     def light_up(self, button_id):
         if (button_id == BUTTON_WHITE):
-            self.__pwm_white.ChangeDutyCycle(100)
+            self.__set_duty_cycle(self.__pwm_white, 100)
         if (button_id == BUTTON_BLUE):
-            self.__pwm_blue.ChangeDutyCycle(100)
+            self.__set_duty_cycle(self.__pwm_blue, 100)
         if (button_id == BUTTON_GREEN):
-            self.__pwm_green.ChangeDutyCycle(100)
+            self.__set_duty_cycle(self.__pwm_green, 100)
         if (button_id == BUTTON_YELLOW):
-            self.__pwm_yellow.ChangeDutyCycle(100)
+            self.__set_duty_cycle(self.__pwm_yellow, 100)
         if (button_id == BUTTON_RED):
-            self.__pwm_red.ChangeDutyCycle(100)
+            self.__set_duty_cycle(self.__pwm_red, 100)
 
     def change_duty_cycle(self, time_on, pwm_obj):
         if pwm_obj is None:
             # Change all of them
-            self.__pwm_white.ChangeDutyCycle(time_on)
-            self.__pwm_blue.ChangeDutyCycle(time_on)
-            self.__pwm_green.ChangeDutyCycle(time_on)
-            self.__pwm_yellow.ChangeDutyCycle(time_on)
-            self.__pwm_red.ChangeDutyCycle(time_on)
+            for pwm in self.__all_pwms:
+                self.__set_duty_cycle(pwm, time_on)
         else:
             # Change the specific pwm that was passed
+            self.__set_duty_cycle(pwm_obj, time_on)
+
+    # Skip the write when the pwm already has this duty cycle
+    def __set_duty_cycle(self, pwm_obj, time_on):
+        if self.__duty_cycles.get(pwm_obj) != time_on:
+            self.__duty_cycles[pwm_obj] = time_on
             pwm_obj.ChangeDutyCycle(time_on)
 
     def go_dark(self):
         time_on = 0
-        self.__pwm_white.ChangeDutyCycle(time_on)
-        self.__pwm_blue.ChangeDutyCycle(time_on)
-        self.__pwm_green.ChangeDutyCycle(time_on)
-        self.__pwm_yellow.ChangeDutyCycle(time_on)
-        self.__pwm_red.ChangeDutyCycle(time_on)
+        self.__set_duty_cycle(self.__pwm_white, time_on)
+        self.__set_duty_cycle(self.__pwm_blue, time_on)
+        self.__set_duty_cycle(self.__pwm_green, time_on)
+        self.__set_duty_cycle(self.__pwm_yellow, time_on)
+        self.__set_duty_cycle(self.__pwm_red, time_on)
 
     def stop_cycling(self):
         self.__keep_running = False
@@ -146,46 +170,48 @@ class LEDController(object):
         self.__keep_running = False
 
 
+    # Each step of the fades and the countdown is timed against a deadline
+    # fixed from the start of the run, so the whole countdown takes its
+    # nominal time even if some steps run late.
     def run(self):
+        table = fade_table(self.FADE_STEPS)
+        step_time = self.FADE_TIME / self.FADE_STEPS
+        deadline = time.monotonic()
+
         for cycle_count in range(self.__num_dimming_cycles):
             if not self.__keep_running:
                 break
-            for on_time in range(100):
+            for step in range(self.FADE_STEPS):
                 if not self.__keep_running:
                     break
-                self.change_duty_cycle(on_time, ALL)
-                time.sleep(0.01)
+                self.change_duty_cycle(table[step], ALL)
+                deadline += step_time
+                sleep_until(deadline)
 
-            for on_time in range(100,0,-1):
+            for step in range(self.FADE_STEPS, 0, -1):
                 if not self.__keep_running:
                     break
-                self.change_duty_cycle(on_time, ALL)
-                time.sleep(0.01)
+                self.change_duty_cycle(table[step], ALL)
+                deadline += step_time
+                sleep_until(deadline)
         # Done with dimming cycles. Now countdown...
         # First bring up the lights again...
-        for on_time in range(100):
+        for step in range(self.FADE_STEPS + 1):
             if not self.__keep_running:
                 break
-            self.change_duty_cycle(on_time, ALL)
-            time.sleep(0.01)
+            self.change_duty_cycle(table[step], ALL)
+            deadline += step_time
+            sleep_until(deadline)
 
         # All are fully lit now...
         # Shut them off one by one, on one second intervals
-        if self.__keep_running:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_white)
-        if self.__keep_running:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_blue)
-        if self.__keep_running:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_green)
-        if self.__keep_running:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_yellow)
-        if self.__keep_running:
-            time.sleep(1.0)
-            self.change_duty_cycle(0, self.__pwm_red)
+        for pwm in self.__all_pwms:
+            if not self.__keep_running:
+                break
+            deadline += self.COUNTDOWN_TIME
+            sleep_until(deadline)
+            if self.__keep_running:
+                self.change_duty_cycle(0, pwm)
 
         if self.__keep_running:
             # Countdown is completed without correct button-press
@@ -194,11 +220,14 @@ class LEDController(object):
 
 class ButtonMonitor(object):
 
-    def __init__ (self, num_to_get, led_controller):
+    def __init__ (self, num_to_get, led_controller, prompt_player=None):
         self.__num_to_get = num_to_get
         self.__count = 0
         self.__button_presses = []
+        self.__pressed = Condition()
         self.__led_controller = led_controller
+        # a prompt asking for the presses is cut off by the first press
+        self.__prompt_player = prompt_player
         print('press ', num_to_get, ' buttons')
 
     # flash the led corresponding to the button color
@@ -211,6 +240,8 @@ class ButtonMonitor(object):
         if len(self.__button_presses) == 0:
             self.__led_controller.go_dark()
             self.__led_controller.stop_cycling()
+            if self.__prompt_player is not None:
+                self.__prompt_player.stop()
 
         print("button ", button_id, " pressed")
 
@@ -227,18 +258,25 @@ class ButtonMonitor(object):
             led_controller.light_up(BUTTON_RED)
 
 
-        self.__count = self.__count + 1
-        self.__button_presses.append(button_id)
+        with self.__pressed:
+            self.__count = self.__count + 1
+            self.__button_presses.append(button_id)
+            self.__pressed.notify()
 
-    def get_button_presses(self):
+    # Wait for the buttons to be pressed and return them in the order they
+    # were pressed. Given a timeout (seconds), stops waiting after that long
+    # and returns the presses there were by then.
+    def get_button_presses(self, timeout=None):
         for button in buttons:
             # Crappy buttons, so use longish time for min time between
             # edge detections
             GPIO.add_event_detect (button, GPIO.FALLING,
                                    self.button_event, 500)
 
-        while self.__count < self.__num_to_get:
-            continue
+        # sleep until the GPIO callback thread has seen enough presses
+        with self.__pressed:
+            self.__pressed.wait_for(lambda: self.__count >= self.__num_to_get,
+                                    timeout)
 
         time.sleep(1.0)
 
@@ -249,16 +287,8 @@ class ButtonMonitor(object):
         led_controller.go_dark()
 
 
-        return self.__button_presses
-
-
-def stop_playing(player_process):
-    try:
-        player_process.stdin.write(b'q')
-        player_process.stdin.flush()
-        player_process.terminate()
-    except BrokenPipeError:
-        print ('ignoring BrokenPipeError when stopping s sound play')
+        with self.__pressed:
+            return list(self.__button_presses)
 
 
 if __name__ == '__main__':
@@ -273,14 +303,15 @@ if __name__ == '__main__':
         # Initialize pins connected to LEDs as output pins
         GPIO.setup(leds, GPIO.OUT)
 
+        # All prompts are decoded up front so each one starts instantly
+        # and can be cut off the moment a button is pressed
+        prompt_player = PromptPlayer(DIR_PROMPTS)
+
         # enter-passcode-pattern.wav
         #
         # Soundbox configuration has begun
         # enter a passcode by pressing three buttons
-        player_process = subprocess.Popen(['omxplayer',
-                         '-o','alsa:'+ALSA_DEVICE_NAME,
-                         DIR_PROMPTS+'enter-passcode-pattern.wav'],
-                         stdin=subprocess.PIPE,stdout=None,stderr=None)
+        prompt_player.play('enter-passcode-pattern.wav')
 
         # Run the LEDs through their paces. They provide a countdown for
         # the user so s/he knows how long they have to enter a button pattern
@@ -293,10 +324,10 @@ if __name__ == '__main__':
         led_thread.start()
 
         # get three button presses
-        button_monitor = ButtonMonitor(3, led_controller)
+        button_monitor = ButtonMonitor(3, led_controller, prompt_player)
         button_pattern = button_monitor.get_button_presses()
 
-        stop_playing(player_process)
+        prompt_player.stop()
 
         accept_pattern = [BUTTON_RED, BUTTON_WHITE, BUTTON_BLUE]
 
@@ -307,19 +338,16 @@ if __name__ == '__main__':
             # Your passcode authorizes you to choose a collection
             # of sounds to play on Soundbox.
             # choose a collection by pressing one of the five colored buttons.
-            player_process = subprocess.Popen(['omxplayer',
-                             '-o','alsa:'+ALSA_DEVICE_NAME,
-                             DIR_PROMPTS+'choose-sound-group.wav'],
-                             stdin=subprocess.PIPE,stdout=None,stderr=None)
+            prompt_player.play('choose-sound-group.wav')
 
             # Leave the leds lit for one second, then shut them off
             time.sleep(1.0)
             led_controller.go_dark()
 
-            button_monitor = ButtonMonitor(1, led_controller)
+            button_monitor = ButtonMonitor(1, led_controller, prompt_player)
             buttons_pressed = button_monitor.get_button_presses()
 
-            stop_playing(player_process)
+            prompt_player.stop()
 
             if buttons_pressed[0]==BUTTON_WHITE:
                 selected_dir = 'white'
@@ -344,7 +372,7 @@ if __name__ == '__main__':
             #
             # your choice of sounds has been saved.
             # soundbox will use your choice of sounds when it is  restarted.
-            os.system('omxplayer -o alsa:'+ALSA_DEVICE_NAME+' --vol 300 '+DIR_PROMPTS+'soundbox-resume-your-choice.wav')
+            prompt_player.play_and_wait('soundbox-resume-your-choice.wav', PROMPT_GAIN)
 
         else:
             accept_pattern_superuser = [BUTTON_RED, BUTTON_GREEN, BUTTON_BLUE]
@@ -362,15 +390,12 @@ if __name__ == '__main__':
                 # standalone access point.
                 # or
                 # press any other button to leave connectivity unchanged.
-                player_process = subprocess.Popen(['omxplayer',
-                                 '-o','alsa:'+ALSA_DEVICE_NAME,
-                                 DIR_PROMPTS+'wifi-or-access-pt.wav'],
-                                 stdin=subprocess.PIPE,stdout=None,stderr=None)
+                prompt_player.play('wifi-or-access-pt.wav')
 
-                button_monitor = ButtonMonitor(1, led_controller)
+                button_monitor = ButtonMonitor(1, led_controller, prompt_player)
                 buttons_pressed = button_monitor.get_button_presses()
 
-                stop_playing(player_process)
+                prompt_player.stop()
 
                 if buttons_pressed[0]==BUTTON_GREEN:
                     # access-point-enabled.wav
@@ -381,7 +406,7 @@ if __name__ == '__main__':
                     print('soundbox start access point')
                     os.system('cd /home/pi/soundbox')
                     os.system('sudo ./start_ap.sh')
-                    os.system('omxplayer -o alsa:'+ALSA_DEVICE_NAME+' --vol 300 '+DIR_PROMPTS+'access-point-enabled.wav')
+                    prompt_player.play_and_wait('access-point-enabled.wav', PROMPT_GAIN)
                 else:
                     if buttons_pressed[0]==BUTTON_RED:
                         # wifi-enabled.wav
@@ -394,13 +419,13 @@ if __name__ == '__main__':
                         print('soundbox stop access point')
                         os.system('cd /home/pi/soundbox')
                         os.system('sudo ./stop_ap.sh')
-                        os.system('omxplayer -o alsa:'+ALSA_DEVICE_NAME+' --vol 300 '+DIR_PROMPTS+'wifi-enabled.wav')
+                        prompt_player.play_and_wait('wifi-enabled.wav', PROMPT_GAIN)
                     else:
                         # connection-mode-unchanged.wav
                         #
                         # You chose to leave Soundbox connectivity unchanged.
                         print('soundbox config is unchanged')
-                        os.system('omxplayer -o alsa:'+ALSA_DEVICE_NAME+' --vol 300 '+DIR_PROMPTS+'connection-mode-unchanged.wav')
+                        prompt_player.play_and_wait('connection-mode-unchanged.wav', PROMPT_GAIN)
 
 
             else:
@@ -409,7 +434,7 @@ if __name__ == '__main__':
                 # the buttons you pressed do not match a valid passcode.
                 # Soundbox configuration is ending.
                 print('soundbox config is ending')
-                os.system('omxplayer -o alsa:'+ALSA_DEVICE_NAME+' --vol 300 '+DIR_PROMPTS+'invalid-passcode.wav')
+                prompt_player.play_and_wait('invalid-passcode.wav', PROMPT_GAIN)
 
     # If keyboard Interrupt (CTRL-C) is pressed
     except KeyboardInterrupt:
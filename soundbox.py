@@ -4,124 +4,80 @@ import os
 from os import listdir
 import atexit
 import signal
+import threading
 
-import configparser
-
-import RPi.GPIO as GPIO
-from threading import Thread
-from threading import Event
+from bootprofile import *
+from gpiobackend import GPIO
+from gpiobackend import GPIO_BACKEND_DEFAULT, select_gpio_backend
 
 from globaldefs import *
 from platformdefs import *
-from commandswitch import *
-from ledflasher import *
-from ledscanner import *
-from buttonmonitor import *
-from ledcontroller import *
 from soundplayer import *
+from soundboxcontrol import *
+from asyncruntime import *
+from soundindex import *
+from soundingest import *
+from dropzonewatcher import *
+from soundboxconfig import *
 
 # main execution block starts here
 if __name__ == '__main__':
 
     # Define functions used by main execution block
 
-    # Convenience function to create and set an event
-    def create_event_and_set():
-        new_event = Event()
-        new_event.set()
-        return new_event
-
-    # List all files (presumably sound files) alphabetically that are
-    # in a specified directory
-    def get_sound_file_list(from_dir_name):
-        file_list = sorted(os.listdir(from_dir_name))
-
-        # we have 5 buttons, so we need 5 things in this list or problems
-        # ensue! it's ok to try to play a file with no name, but its not ok
-        # to access the 4th element of a list with only three elements.
-        while len(file_list)<5:
-            file_list.append(' ')
-        print(file_list)
-        return file_list
-
-
-    # Button press function to turn an LED on, signal the LEDScanner that
-    # it should stop scanning (and not turn this particular LED off),
-    # play the sound, turn off the LED after the sound plays, and signal
-    # the LEDScanner to resume. The sound plays in an asynchronously
-    # running subprocess, a handle to which is returned so we can interact
-    # with it.
-    def process_button_press(sound_player, led_id, led_scanner, event, sound_file):
-
-        # a sound file can either be a real sound file, e.g. mp3, or it
-        # can contain a url for an internet audio stream. the file extension
-        # tells us which it is...
-        if sound_file.endswith('.url'):
-            url_file = open(sound_file, 'r')
-            sound_file = url_file.read().rstrip()
-            url_file.close()
-            print('url from the sound file: ', sound_file)
-
-
-        led_scanner.set_resume_led(led_id)
-        GPIO.output(led_id, GPIO.HIGH)
-        event.clear()
-        p = sound_player.play_sound_file(sound_file, event, led_id)
-        # sleep in case the user is holding the button down. this
-        # prevents repeated button presses for the amount of time that we
-        # sleep here. there must be a better way, but for now this will do.
-        time.sleep(1.5)
-        return p
-
     # When the program terminates in an orderly manner, reset the hardware so
     # it works properly if another program tries to use the GPIO.
     def reset_gpio():
         GPIO.cleanup()
 
-    # When ending the program via ctrl-c (or other means) no threads should be
-    # blocked so they can terminate. Otherwise they hang around.
-    def release_all_threads():
-        white_e.set()
-        blue_e.set()
-        green_e.set()
-        yellow_e.set()
-        red_e.set()
-
     def handle_exit():
         print('handle_exit called to assure GPIO cleanup')
         reset_gpio()
 
-
-    # Create a map of the sections and options found in the ini file
-    def config_section_map(config_parser, section):
-        dict1 = {}
-        options = config_parser.options(section)
-        for option in options:
-            try:
-                dict1[option] = config_parser.get(section, option)
-                if dict1[option] == -1:
-                    DebugPrint("skip: %s" % option)
-            except:
-                print('exception on %s' % option)
-                dict1[option] = None
-        return dict1
+    # Print the state of the player and its caches. Send SIGUSR1 to the
+    # soundbox process to see it, e.g. 'pkill -USR1 -f soundbox.py'. It is
+    # installed once they are all set up.
+    def print_diagnostics(signum, frame):
+        print('pcm cache: ', pcm_cache.stats())
+        print('player pool: ', sound_player.describe_pool())
+        print('volume knob: ', sound_player.volume_control().stats())
+        print('sounds that will not play: ',
+              [info.describe() for info in sound_index.problems()])
+        if sound_ingest is not None:
+            print('sound ingest: ', sound_ingest.stats())
+        print('soundbox.ini: ', config_reloader.reloads, ' reloads, ',
+              config_reloader.failures, ' failed')
+        print('startup: ', startup_profile.report())
+        print('dsp: ', sound_player.dsp_stats())
+        print('voice mixer: ', sound_player.mixer_stats())
 
     #-----------------------------------------------------------
     # Entry point, where execution begins...main execution block
     #-----------------------------------------------------------
 
+    # Time each phase of the start, from when the process was started. Set
+    # SOUNDBOX_PROFILE_STARTUP=1 to see every phase as it ends; the time
+    # from start to ready is always printed.
+    startup_profile = StartupProfile()
+    startup_profile.mark('imports')
+
     # at the very beginning, set up what happens at the very end.
     # we want to be sure the GPIO stuff is reset in the event the
     # program stops after a system kill process occurrence.
     atexit.register(handle_exit)
     signal.signal(signal.SIGTERM, handle_exit)
     signal.signal(signal.SIGINT, handle_exit)
+    # the diagnostics need the player, its caches and the config reloader,
+    # set up further on. Until then SIGUSR1 is ignored rather than left to
+    # kill the process, as it would by default.
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
 
     # Obtain configuration options from the ini file.
-    # Note that the soundbox-config program obtains a selection of
-    # one out of five possible sound collections. This choice is written by
-    # that program to the ini file that is read here. The 'selected_sound_dir'
-    # in the ini file determines the sound collection used by the soundbox.
+    # Note that the configuration menu (see configmenu.py) obtains a
+    # selection of one out of five possible sound collections. The
+    # soundbox switches to it at once, and the choice is written to the
+    # ini file that is read here. The 'selected_sound_dir' in the ini file
+    # determines the sound collection used when the soundbox starts.
     #
     # Configurable roperties in the ini file are:
     #   sound_file_base_dir : the parent directory of the five sound
@@ -130,33 +86,123 @@ if __name__ == '__main__':
     #                        this is a dir named based on button colors, i.e.
     #                        the button pushed during soundbox-config
     #                        determines the directory used to get sounds
-    #   vol_setting: value passed to omxplayer for initial volume
+    #   vol_setting: initial volume in millibels, as omxplayer's --vol
     #                 note--too high a volume causes distortion
-    #   amp_setting: value passed to omxplayer that tries to deal with
-    #                playback distortion. this is magic I don't really
-    #                understand. type 'man omxplayer' and prepare to be
-    #                amazed.
+    #   amp_setting: amplification in millibels, as omxplayer's --amp.
+    #                the sound player applies vol + amp as one gain, so
+    #                the values tuned for omxplayer keep working.
+    #
+    # The optional [loudness] section brings every sound to one loudness,
+    # measured by the index when a sound is added, in place of amp_setting:
+    #   normalize: 'yes' (the default) plays each sound with the gain that
+    #              brings it to the target; amp_setting is then only used
+    #              for a sound whose loudness is not known yet
+    #   target_lufs: the loudness (LUFS) sounds are brought to
+    #   true_peak_limit: the gain is lowered if need be so no sound's true
+    #                    peak goes over this (dBTP), so none of them clip
+    #
+    # The optional [dsp] section runs the samples of every sound through a
+    # chain of filters on their way to the sound device:
+    #   stages: the stages, in order, separated by commas, from lowcut (a
+    #           high pass filter, e.g. to spare a small speaker bass it
+    #           cannot play), highcut, peak, lowshelf, highshelf and
+    #           limiter. None when empty or left out.
+    #   <stage>_hz, <stage>_q, <stage>_gain_db: the frequency, Q and, for
+    #           peak and the shelves, the gain (dB) of an EQ stage
+    #   limiter_threshold_db: the limiter keeps every sample under this
+    #   limiter_lookahead_ms: time the limiter looks ahead, and the time it
+    #                         holds the samples back
+    #   limiter_release_ms: time the limiter takes to come back up 20 dB
+    #
+    # The optional [pcm_cache] section sizes the cache of decoded sounds:
+    #   memory_budget_mb: most memory (MB) that decoded sounds may use
+    #   backing_dir: when set, sounds are decoded once into files in this
+    #                directory and memory-mapped from there
+    #
+    # The optional [player] section chooses where sounds are played:
+    #   engine: 'inprocess' (the default) plays sounds in this process,
+    #           'pool' plays them in pre-started player worker processes
+    #   pool_size: number of player worker processes
+    #   max_plays_per_worker: a worker is replaced by a fresh one after
+    #                         playing this many sounds
+    #   voices: sounds that can play at once, layered over each other, each
+    #           press adding its button's sound to those playing. 1 (the
+    #           default) stops the sound playing when another button is
+    #           pressed. More than 1 needs the 'inprocess' engine.
+    #   crossfade_ms: a sound started while another plays fades in over
+    #                 this time as the other fades out, with no gap
+    #                 between them. 0 (the default) cuts the other off.
+    #   fade_out_ms: a stopped sound fades out over this time. 0 (the
+    #                default) silences it at once. Both need the
+    #                'inprocess' engine.
+    #
+    # The optional [gestures] section times presses of the buttons and the
+    # command switch, in milliseconds:
+    #   debounce_ms: switch bounce shorter than this is ignored
+    #   double_click_ms: most time between two clicks of a double click
+    #   long_press_ms: a press held this long is a long press, e.g. to stop
+    #                  a paused sound
+    #   hold_repeat_ms: interval of the repeats of a long press held down
+    #   menu_hold_ms: holding the command switch this long while no sound
+    #                 plays opens the shutdown menu
+    #
+    # The optional [gpio] section chooses how the pins are driven:
+    #   backend: 'rpi' (the default) uses the RPi.GPIO module, 'gpiod' the
+    #            GPIO character device, 'simulated' no hardware at all.
+    #            The SOUNDBOX_GPIO_BACKEND environment variable overrides it.
+    #
+    # The optional [volume] section sets up the volume knob:
+    #   step: volume change (percent) of one detent of the knob
+    #   write_interval_ms: the mixer is written at most once in this time,
+    #                      detents turned in between are applied together
+    #   acceleration_ms: a detent turned this soon after the one before
+    #                    counts as more than one step, the sooner the more
+    #   acceleration_max: most steps one detent can count as, 1 for none
+    #   mixer: 'alsa' (the default) turns the volume on the sound device's
+    #          mixer, 'software' scales the samples in the playback path
+    #   ramp_ms: time the software volume takes to ramp to a new setting
+    #
+    # The optional [index] section places the index of the drop zone, which
+    # records what each sound file is and whether it plays:
+    #   file: the index file, by default .soundindex.sqlite3 in
+    #         sound_file_base_dir
+    #   watch: 'yes' (the default) watches the drop zone and takes in sounds
+    #          that are added, replaced or removed while the soundbox runs
+    #   watch_debounce_ms: the drop zone must be quiet this long before its
+    #                      changes are taken in
+    #
+    # The optional [ingest] section has sounds that are not in the sound
+    # card's format made into renditions that are, in the background:
+    #   renditions: 'yes' (the default) makes them and plays them rather
+    #               than the sounds
+    #   workers: number of processes making renditions
+    #   max_jobs_per_worker: a worker is replaced by a fresh one after
+    #                        making this many
+    #
+    # The optional [runtime] section chooses how the program runs:
+    #   mode: 'threads' (the default) gives the led compositor, gesture
+    #         timer, volume control and command switch a thread each,
+    #         'asyncio' runs all of them on one event loop
+    #   watch_config: 'yes' (the default) reloads this file when it changes
+    #   ready_cue: 'yes' (the default) lights all the leds once when the
+    #              soundbox is ready for presses
+    #
+    # The file is read into a SoundboxConfig, which checks every value. When
+    # the file changes while the soundbox runs it is read again, and the
+    # gain, the collection, the volume knob and the gesture timing change
+    # at once; the other settings take effect when the soundbox restarts.
     if os.path.isfile(SOUNDBOX_INI_FILE_PATH_NAME):
 
         try:
-            config = configparser.ConfigParser()
-            config.read(SOUNDBOX_INI_FILE_PATH_NAME)
-
-
-            # get configuration values related to file system usage
-            lookup_map = config_section_map(config,'file_locations')
-            sound_base_dir = lookup_map['sound_file_base_dir']
-            selected_dir = lookup_map['selected_sound_dir']
-
-            # get configuration values related to omxplayer usage
-            lookup_map = config_section_map(config,'omxplayer_configuration')
-            omx_ini_vol = lookup_map['vol_setting']
-            omx_ini_amp = lookup_map['amp_setting']
-
-        except Exception as ex:
+            soundbox_config = read_soundbox_config(SOUNDBOX_INI_FILE_PATH_NAME)
+        except ConfigError as ex:
             print('soundbox.ini file problem: ', ex)
             print('exiting now...')
             sys.exit(3)
+
+        sound_base_dir = soundbox_config.sound_base_dir
+        omx_ini_vol = soundbox_config.vol_setting
+        omx_ini_amp = soundbox_config.amp_setting
     else:
         # if the ini file is missing, just stop. it is necessary.
         print('The soundbox.ini file is missing. exiting now...')
@@ -165,9 +211,11 @@ if __name__ == '__main__':
 
     # Volume and Amp settings used by omxplayer can optionally be passed
     # on the command line. Cmd line overrides any ini file settings.
+    gain_override = None
     if len(sys.argv)==3:
         omx_vol_setting = sys.argv[1]
         omx_amp_setting = sys.argv[2]
+        gain_override = (omx_vol_setting, omx_amp_setting)
         print('sound player settings from cmd line')
     else:
         if omx_ini_vol is not None and omx_ini_amp is not None:
@@ -179,127 +227,181 @@ if __name__ == '__main__':
             omx_amp_setting = OMX_AMP_SETTING_DEFAULT
             print('sound player default settings')
     print("--vol ",omx_vol_setting,"--amp ",omx_amp_setting)
-
-    # Tell the GPIO subsystem we are using BCM numbering for the pins
-    GPIO.setmode(GPIO.BCM)
-
-    # Initialize button input pins as GPIO.HIGH when buttons are not pressed
-    # The buttons are tied to ground, so input pins go GPIO.LOW when buttons
-    # are pressed
-    GPIO.setup(buttons, GPIO.IN, pull_up_down=BUTTON_PUD)
-
-    # Initialize pins connected to LEDs as output pins
-    GPIO.setup(leds, GPIO.OUT)
-
-
-    # There are pull up resistors already in place on the rotary switch
-    # assembly, so the two pins for it are simply configured as GPIO.IN
-    GPIO.setup(ROTARY_PIN_A, GPIO.IN)
-    GPIO.setup(ROTARY_PIN_B, GPIO.IN)
-
-    # The push switch of the rotary switch assembly requires pull up
-    # configuration as it does not have a built-in pull-up resistor
-    GPIO.setup(ROTARY_SWITCH_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-    # Create a set of events that will be signaled when buttons are pressed.
-    # These are used to stop led scanning when a sound is played.
-    white_e = create_event_and_set()
-    blue_e = create_event_and_set()
-    green_e = create_event_and_set()
-    yellow_e = create_event_and_set()
-    red_e = create_event_and_set()
-
-    # Termination is triggered by the CommandSwitch. When terminating, the
-    # scan of buttons in the main thread has to be blocked lest the
-    # button press that ends things in command switch be acted on
-    # by the main thread also.
-    termination_event = create_event_and_set()
-
-    # Create the sound_player, which plays one sound at a time. So if
-    # a sound is being played and another sound is requested, playback
-    # of the first sound is stopped and playback of the second one is started.
-    sound_player = SoundPlayer(omx_vol_setting, omx_amp_setting)
-
-    # Create the led scanner and start it on its own thread.
-    # The button press events are passed to it so the main thread can
-    # stop the led scan when a button is pressed.
-    led_scanner = LEDScanner(white_e, blue_e, green_e, yellow_e, red_e)
-    scannerThread = Thread(target=led_scanner.run)
-    scannerThread.start()
-
-    # Monitor the command switch (push button function of volume control)
-    # on a separate thread.
-    command_switch = CommandSwitch(sound_base_dir+'prompts/',
-                                   termination_event,
-                                   sound_player,
-                                   led_scanner)
-    command_thread = Thread(target=command_switch.process_switch_events)
-    command_thread.start()
-
-    sounds = get_sound_file_list(sound_base_dir+selected_dir)
+    startup_profile.mark('config')
+
+    # Open the index of the drop zone, which knows the sounds as they were
+    # when the soundbox last ran. It is brought up to date once the
+    # soundbox is ready, see start_deferred_work() below.
+    sound_index = SoundIndex(soundbox_config.index_file)
+    startup_profile.mark('index')
+
+    # Choose how the pins are driven and set them up
+    select_gpio_backend(soundbox_config.gpio_backend)
+    setup_pins()
+    startup_profile.mark('gpio')
+
+    # On the asyncio event loop the leds are drawn by a coroutine rather
+    # than by the compositor's own thread
+    threaded = soundbox_config.runtime_mode == RUNTIME_THREADS
+    if not threaded:
+        set_led_compositor(LEDCompositor(threaded=False))
+
+    # Create the sound_player. With one voice ([player] voices) it plays one
+    # sound at a time: if a sound is being played and another sound is
+    # requested, playback of the first sound is stopped (or crossfaded) and
+    # playback of the second one is started. With more voices it mixes the
+    # sounds of several buttons at once, a new one taking the place of the
+    # oldest when every voice is playing.
+    # Decoded sounds are kept in memory so a press plays from RAM rather
+    # than decoding the file again.
+    pcm_cache = PCMCache(soundbox_config.cache_budget_mb * 1024 * 1024,
+                         soundbox_config.cache_backing_dir)
+
+    # With the 'pool' player engine, sounds play in worker processes that
+    # are started now, so they are warmed up before the first press
+    player_pool = None
+    if soundbox_config.player_engine == 'pool':
+        player_pool = PlayerPool(soundbox_config.pool_size,
+                                 soundbox_config.pool_max_plays,
+                                 soundbox_config.gain_ramp_ms,
+                                 soundbox_config.dsp_stages)
+    sound_player = SoundPlayer(omx_vol_setting, omx_amp_setting, pcm_cache,
+                               player_pool, volume_thread=threaded,
+                               volume_settings=soundbox_config.volume_settings(),
+                               software_volume=soundbox_config.volume_mixer == 'software',
+                               ramp_ms=soundbox_config.gain_ramp_ms,
+                               dsp_stages=soundbox_config.dsp_stages,
+                               voices=soundbox_config.voices,
+                               crossfade_ms=soundbox_config.crossfade_ms,
+                               fade_out_ms=soundbox_config.fade_out_ms)
+
+    # Each sound is played at the gain that brings it to the target
+    # loudness
+    sound_player.set_sound_index(sound_index)
+    sound_player.set_loudness_target(soundbox_config.normalization_target(),
+                                     soundbox_config.loudness_true_peak_limit)
+
+    # Sounds in another format than the sound card's are decoded once, in
+    # the background, into renditions in its format, which are played
+    # rather than the sounds once made
+    sound_ingest = None
+    if soundbox_config.ingest_renditions:
+        sound_ingest = SoundIngest(sound_index, soundbox_config.ingest_workers,
+                                   soundbox_config.ingest_max_jobs)
+        sound_player.set_sound_ingest(sound_ingest)
+    startup_profile.mark('player')
+
+    # The led scan, the buttons and the command switch
+    soundbox_control = SoundboxControl(sound_player,
+                                       soundbox_config.sound_dir(),
+                                       soundbox_config.prompts_dir(),
+                                       gesture_timing=soundbox_config.gesture_timing(),
+                                       threaded=threaded,
+                                       sound_index=sound_index)
+
+    # Decode the five sounds in the background, so even the first press
+    # of each button plays from memory
+    pcm_cache.preload(soundbox_control.sound_paths())
+    startup_profile.mark('collection')
+
+    # Sounds copied into the drop zone, replaced or deleted while the
+    # soundbox runs are taken in without a restart: the index probes what
+    # changed, the buttons get the new sounds and those are decoded in
+    # the background. A sound that is playing plays on.
+    def drop_zone_changed(paths):
+        print('drop zone changed: ', paths)
+        print('sound index: ', sound_index.scan(sound_base_dir))
+        pcm_cache.forget(paths)
+        soundbox_control.reload_sounds()
+        pcm_cache.preload(soundbox_control.sound_paths())
+        if sound_ingest is not None:
+            sound_ingest.request()
+
+    # Changes to soundbox.ini are applied without a restart. Editors save a
+    # file in several steps, so changes are taken in once it is quiet.
+    # vol and amp given on the command line keep overriding the file.
+    config_reloader = ConfigReloader(SOUNDBOX_INI_FILE_PATH_NAME,
+                                     soundbox_config, sound_player,
+                                     soundbox_control, gain_override)
+
+    # everything print_diagnostics() shows is set up now
+    signal.signal(signal.SIGUSR1, print_diagnostics)
+
+    # The watchers, started once the soundbox is ready
+    watchers = []
+
+    def start_watcher(name, watcher):
+        try:
+            watcher.start()
+            watchers.append(watcher)
+        except InotifyError as ex:
+            print('not watching ', name, ': ', ex)
+
+    # What is not needed to serve the first press is done after it can be
+    # served, on a thread of its own: the index is brought up to date
+    # (files that have not changed since the last start are not looked at
+    # again, new ones are probed) and the renditions that are missing are
+    # asked for, the watchers are started, the prompts of
+    # the menus are decoded and the mixer is opened.
+    def deferred_work():
+        startup_profile.start_deferred()
+        print('sound index: ', sound_index.scan(sound_base_dir))
+        soundbox_control.reload_sounds()
+        pcm_cache.preload(soundbox_control.sound_paths())
+        for info in sound_index.problems():
+            print('will not play: ', info.describe())
+        if sound_ingest is not None:
+            sound_ingest.request()
+        startup_profile.mark('index scan')
+
+        if soundbox_config.watch_drop_zone:
+            start_watcher('the drop zone',
+                          DropZoneWatcher(sound_base_dir, drop_zone_changed,
+                                          soundbox_config.watch_debounce_ms))
+        if soundbox_config.watch_config:
+            start_watcher('soundbox.ini', DropZoneWatcher(
+                os.path.dirname(os.path.abspath(SOUNDBOX_INI_FILE_PATH_NAME)),
+                config_reloader.files_changed, CONFIG_WATCH_DEBOUNCE_MS,
+                subdirs=False))
+        startup_profile.mark('watchers')
+
+        soundbox_control.prepare()
+        startup_profile.mark('prompts')
+        sound_player.volume_control().open_mixer()
+        startup_profile.mark('mixer')
+        print('deferred start work done: ', startup_profile.report()['deferred_ms'])
+
+    # Called as soon as the buttons are served. systemd, when it runs the
+    # soundbox as a Type=notify service, is told it has started.
+    def soundbox_ready():
+        startup_profile.ready()
+        systemd_notify('READY=1')
+        if soundbox_config.ready_cue:
+            soundbox_control.show_ready_cue()
+        deferred = threading.Thread(target=deferred_work, name='deferred-start')
+        deferred.daemon = True
+        deferred.start()
+
+    soundbox_control.set_ready_callback(soundbox_ready)
 
     try:
-        p = None
-        terminate = False
-        while not terminate:
-            # Loop, scanning the five buttons awaiting a button press. When
-            # a button is pressed, process it. The processing starts a
-            # subprocess in which the sound plays. As it is a subprocess,
-            # it runs asynchronously and we can immediately resume this
-            # button scanning as the sound plays.
-            if GPIO.input(BUTTON_WHITE) == BUTTON_ACTIVATED:
-                termination_event.wait()
-                print(sounds[0])
-                p = process_button_press(sound_player, LED_WHITE, led_scanner, white_e,
-                    sound_base_dir+selected_dir+'/'+sounds[0])
-            if GPIO.input(BUTTON_BLUE) == BUTTON_ACTIVATED:
-                termination_event.wait()
-                print(sounds[1])
-                p = process_button_press(sound_player, LED_BLUE, led_scanner, blue_e,
-                    sound_base_dir+selected_dir+'/'+sounds[1])
-            if GPIO.input(BUTTON_GREEN) == BUTTON_ACTIVATED:
-                termination_event.wait()
-                print(sounds[2])
-                p = process_button_press(sound_player, LED_GREEN, led_scanner,green_e,
-                    sound_base_dir+selected_dir+'/'+sounds[2])
-            if GPIO.input(BUTTON_YELLOW) == BUTTON_ACTIVATED:
-                termination_event.wait()
-                print(sounds[3])
-                p = process_button_press(sound_player, LED_YELLOW, led_scanner,yellow_e,
-                    sound_base_dir+selected_dir+'/'+sounds[3])
-            if GPIO.input(BUTTON_RED) == BUTTON_ACTIVATED:
-                termination_event.wait()
-                print(sounds[4])
-                p = process_button_press(sound_player, LED_RED, led_scanner,red_e,
-                    sound_base_dir+selected_dir+'/'+sounds[4])
-
-            # While a sound is playing after a button press, we call
-            # p.poll() each pass through the loop. This returns None as
-            # long as the player subprocess continues running. When it
-            # finally returns a value, the player subprocess is finished.
-            # At that time we resume flashing the leds in sequence, which
-            # the user will interpret to mean that a new sound can be
-            # selected.
-            if p is not None:
-                rc = p.poll()
-                if rc is not None:
-                    print("Sound player has finished with rc: ", rc)
-                    sound_player.close_player_process()
-                    p = None
-                    turnoff_all_leds()
-                    release_all_threads()
-
-            time.sleep(0.1)
+        if threaded:
+            soundbox_control.start()
+            soundbox_control.run()
+        else:
+            # ctrl-c and SIGTERM cancel the loop's main coroutine, which
+            # stops watching the pins before they are reset below
+            runtime = AsyncRuntime()
+            runtime.run(soundbox_control.run_async(runtime.loop()))
+
     except IOError:
         print("An IOError occurred")
     except KeyboardInterrupt:
         print("Program ending after ctrl-c")
-        terminate = True
-        led_scanner.stop_scanning()
-        VolumeControl.terminate = True
-        CommandSwitch.terminate = True
-#        release_all_threads()
+        soundbox_control.shutdown()
     finally:
+        for watcher in watchers:
+            watcher.stop()
         if sound_player is not None:
             print("Closing the sound player")
             sound_player.close()
@@ -307,5 +409,3 @@ if __name__ == '__main__':
         print("Resetting GPIO buttons and LEDs...")
 
         reset_gpio()
-
-
@@ -0,0 +1,415 @@
+import os
+import time
+import configparser
+
+from gpiobackend import GPIO_BACKEND_DEFAULT
+
+from globaldefs import *
+from soundplayer import *
+from gestures import *
+from asyncruntime import *
+from soundindex import *
+from dropzonewatcher import *
+from soundingest import *
+from loudness import *
+from dspchain import *
+
+# Choices of the options that name one
+PLAYER_ENGINES = ('inprocess', 'pool')
+VOLUME_MIXERS = ('alsa', 'software')
+GPIO_BACKENDS = ('rpi', 'gpiod', 'simulated')
+
+# Time (milliseconds) soundbox.ini must be left alone after a change
+# before it is read again
+CONFIG_WATCH_DEBOUNCE_MS = 300
+
+# Most gain (millibels) that vol_setting and amp_setting may each ask for.
+# Anything more is a typing error, not a speaker that needs it.
+MILLIBELS_LIMIT = 6000
+
+
+# Raised for a soundbox.ini that is missing something or has a value that
+# is not valid, with the section and option in its message
+class ConfigError(Exception):
+    pass
+
+
+# Class definition for the settings read from soundbox.ini, typed and
+# checked. A SoundboxConfig is never changed once read: a reload reads a
+# new one and the two are compared, so the settings in use always come
+# from one reading of the file.
+class SoundboxConfig(object):
+
+    # Settings that are applied to the running soundbox when they change.
+    # The others are only read when it starts.
+    LIVE_SETTINGS = ('selected_dir', 'vol_setting', 'amp_setting',
+                     'volume_step', 'volume_write_interval_ms',
+                     'volume_acceleration_ms', 'volume_acceleration_max',
+                     'gesture_debounce_ms', 'gesture_double_click_ms',
+                     'gesture_long_press_ms', 'gesture_hold_repeat_ms',
+                     'gesture_menu_hold_ms', 'loudness_normalize',
+                     'loudness_target', 'loudness_true_peak_limit')
+
+    def __init__(self, config):
+        reader = ConfigReader(config)
+
+        # [file_locations]
+        self.sound_base_dir = reader.string('file_locations', 'sound_file_base_dir')
+        self.selected_dir = reader.string('file_locations', 'selected_sound_dir')
+        if not os.path.isdir(os.path.join(self.sound_base_dir, self.selected_dir)):
+            raise ConfigError('[file_locations] selected_sound_dir: no directory ' +
+                              os.path.join(self.sound_base_dir, self.selected_dir))
+
+        # [omxplayer_configuration], None when not given
+        self.vol_setting = reader.integer('omxplayer_configuration', 'vol_setting',
+                                          None, -MILLIBELS_LIMIT, MILLIBELS_LIMIT)
+        self.amp_setting = reader.integer('omxplayer_configuration', 'amp_setting',
+                                          None, -MILLIBELS_LIMIT, MILLIBELS_LIMIT)
+
+        # [loudness]
+        self.loudness_normalize = reader.boolean('loudness', 'normalize', True)
+        self.loudness_target = reader.number('loudness', 'target_lufs',
+                                             LOUDNESS_TARGET_DEFAULT, -60, 0)
+        self.loudness_true_peak_limit = reader.number(
+            'loudness', 'true_peak_limit', TRUE_PEAK_LIMIT_DEFAULT, -30, 0)
+
+        # [pcm_cache]
+        self.cache_budget_mb = reader.integer('pcm_cache', 'memory_budget_mb',
+                                              PCM_CACHE_BUDGET_MB_DEFAULT, 1)
+        self.cache_backing_dir = reader.string('pcm_cache', 'backing_dir',
+                                               PCM_CACHE_BACKING_DIR_DEFAULT)
+
+        # [player]
+        self.player_engine = reader.choice('player', 'engine', 'inprocess',
+                                           PLAYER_ENGINES)
+        self.pool_size = reader.integer('player', 'pool_size',
+                                        PLAYER_POOL_SIZE_DEFAULT, 1)
+        self.pool_max_plays = reader.integer('player', 'max_plays_per_worker',
+                                             PLAYER_MAX_PLAYS_DEFAULT, 1)
+        self.voices = reader.integer('player', 'voices', MIXER_VOICES_DEFAULT,
+                                     1, MIXER_VOICES_LIMIT)
+        if self.voices > 1 and self.player_engine != 'inprocess':
+            raise ConfigError('[player] voices = ' + str(self.voices) +
+                              ': more than one voice needs engine = inprocess')
+        self.crossfade_ms = reader.integer('player', 'crossfade_ms',
+                                           TRANSITION_CROSSFADE_MS_DEFAULT, 0, 5000)
+        self.fade_out_ms = reader.integer('player', 'fade_out_ms',
+                                          TRANSITION_FADE_OUT_MS_DEFAULT, 0, 5000)
+        if (self.crossfade_ms or self.fade_out_ms) and \
+           self.player_engine != 'inprocess':
+            raise ConfigError('[player] crossfade_ms and fade_out_ms need '
+                              'engine = inprocess')
+
+        # [dsp], the stages in the order the samples go through them
+        stage_settings = []
+        for kind in reader.choices('dsp', 'stages', (), DSP_STAGE_KINDS):
+            if kind == DSP_LIMITER:
+                stage_settings.append((kind,
+                    reader.number('dsp', 'limiter_threshold_db',
+                                  LIMITER_THRESHOLD_DB_DEFAULT, -30, 0),
+                    reader.number('dsp', 'limiter_lookahead_ms',
+                                  LIMITER_LOOKAHEAD_MS_DEFAULT, 0.1, 20),
+                    reader.number('dsp', 'limiter_release_ms',
+                                  LIMITER_RELEASE_MS_DEFAULT, 1, 5000)))
+            else:
+                stage_settings.append((kind,
+                    reader.number('dsp', kind + '_hz', DSP_FREQUENCY_DEFAULTS[kind],
+                                  10, ALSA_PCM_RATE / 2 - 1),
+                    reader.number('dsp', kind + '_q', DSP_Q_DEFAULT, 0.1, 20),
+                    reader.number('dsp', kind + '_gain_db', DSP_GAIN_DB_DEFAULT,
+                                  -24, 24)))
+        self.dsp_stages = tuple(stage_settings)
+
+        # [gestures]
+        self.gesture_debounce_ms = reader.integer('gestures', 'debounce_ms',
+                                                  GESTURE_DEBOUNCE_MS, 0)
+        self.gesture_double_click_ms = reader.integer('gestures', 'double_click_ms',
+                                                      GESTURE_DOUBLE_CLICK_MS, 0)
+        self.gesture_long_press_ms = reader.integer('gestures', 'long_press_ms',
+                                                    GESTURE_LONG_PRESS_MS, 1)
+        self.gesture_hold_repeat_ms = reader.integer('gestures', 'hold_repeat_ms',
+                                                     GESTURE_HOLD_REPEAT_MS, 0)
+        self.gesture_menu_hold_ms = reader.integer('gestures', 'menu_hold_ms',
+                                                   GESTURE_MENU_HOLD_MS, 1)
+
+        # [gpio]
+        self.gpio_backend = reader.choice('gpio', 'backend', GPIO_BACKEND_DEFAULT,
+                                          GPIO_BACKENDS)
+
+        # [volume]
+        self.volume_step = reader.integer('volume', 'step', VOLUME_DELTA, 1, 100)
+        self.volume_write_interval_ms = reader.integer(
+            'volume', 'write_interval_ms', VOLUME_WRITE_INTERVAL_MS, 0)
+        self.volume_acceleration_ms = reader.integer(
+            'volume', 'acceleration_ms', VOLUME_ACCELERATION_MS, 0)
+        self.volume_acceleration_max = reader.integer(
+            'volume', 'acceleration_max', VOLUME_ACCELERATION_MAX, 1)
+        self.volume_mixer = reader.choice('volume', 'mixer', 'alsa', VOLUME_MIXERS)
+        self.gain_ramp_ms = reader.integer('volume', 'ramp_ms', GAIN_RAMP_MS, 0)
+
+        # [index]
+        self.index_file = reader.string('index', 'file', SOUND_INDEX_FILE_DEFAULT)
+        if not self.index_file:
+            self.index_file = default_index_path(self.sound_base_dir)
+        self.watch_drop_zone = reader.boolean('index', 'watch', True)
+        self.watch_debounce_ms = reader.integer('index', 'watch_debounce_ms',
+                                                DROP_ZONE_DEBOUNCE_MS, 0)
+
+        # [ingest]
+        self.ingest_renditions = reader.boolean('ingest', 'renditions', True)
+        self.ingest_workers = reader.integer('ingest', 'workers',
+                                             INGEST_WORKERS_DEFAULT, 1)
+        self.ingest_max_jobs = reader.integer('ingest', 'max_jobs_per_worker',
+                                              INGEST_MAX_JOBS_DEFAULT, 1)
+
+        # [runtime]
+        self.runtime_mode = reader.choice('runtime', 'mode', RUNTIME_DEFAULT,
+                                          RUNTIME_MODES)
+        self.watch_config = reader.boolean('runtime', 'watch_config', True)
+        self.ready_cue = reader.boolean('runtime', 'ready_cue', True)
+
+    def sound_dir(self):
+        return self.sound_base_dir + self.selected_dir
+
+    def prompts_dir(self):
+        return self.sound_base_dir + 'prompts/'
+
+    # The target loudness sounds are brought to, None for none
+    def normalization_target(self):
+        if not self.loudness_normalize:
+            return None
+        return self.loudness_target
+
+    def volume_settings(self):
+        return VolumeSettings(self.volume_step, self.volume_write_interval_ms,
+                              self.volume_acceleration_ms,
+                              self.volume_acceleration_max)
+
+    def gesture_timing(self):
+        return GestureTiming(self.gesture_debounce_ms,
+                             self.gesture_double_click_ms,
+                             self.gesture_long_press_ms,
+                             self.gesture_hold_repeat_ms,
+                             self.gesture_menu_hold_ms)
+
+    # Names of the settings that differ from those of another config
+    def changes(self, other):
+        return sorted(name for name in vars(self)
+                      if getattr(self, name) != getattr(other, name))
+
+
+# Typed reading of the options of a ConfigParser. A missing option takes
+# the default given; a missing option without a default, or a value that is
+# not of the type or in the range asked for, raises ConfigError.
+class ConfigReader(object):
+
+    REQUIRED = object()
+
+    def __init__(self, config):
+        self.__config = config
+
+    def __raw(self, section, option, default):
+        if self.__config.has_option(section, option):
+            return self.__config.get(section, option).strip()
+        if default is ConfigReader.REQUIRED:
+            raise ConfigError('[' + section + '] ' + option + ' is missing')
+        return None
+
+    def __error(self, section, option, value, expected):
+        return ConfigError('[' + section + '] ' + option + ' = ' + repr(value) +
+                           ': ' + expected)
+
+    def string(self, section, option, default=REQUIRED):
+        value = self.__raw(section, option, default)
+        return default if value is None else value
+
+    def integer(self, section, option, default=REQUIRED, low=None, high=None):
+        value = self.__raw(section, option, default)
+        if value is None:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            raise self.__error(section, option, value, 'not a whole number')
+        if (low is not None and number < low) or (high is not None and number > high):
+            raise self.__error(section, option, value,
+                               'not between ' + str(low) + ' and ' + str(high))
+        return number
+
+    def number(self, section, option, default=REQUIRED, low=None, high=None):
+        value = self.__raw(section, option, default)
+        if value is None:
+            return default
+        try:
+            number = float(value)
+        except ValueError:
+            raise self.__error(section, option, value, 'not a number')
+        if (low is not None and number < low) or (high is not None and number > high):
+            raise self.__error(section, option, value,
+                               'not between ' + str(low) + ' and ' + str(high))
+        return number
+
+    def boolean(self, section, option, default=REQUIRED):
+        value = self.__raw(section, option, default)
+        if value is None:
+            return default
+        if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise self.__error(section, option, value, 'not yes or no')
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+
+    def choice(self, section, option, default, choices):
+        value = self.__raw(section, option, default)
+        if value is None:
+            return default
+        if value not in choices:
+            raise self.__error(section, option, value,
+                               'not one of ' + ', '.join(choices))
+        return value
+
+    # A list of choices separated by commas, in the order given
+    def choices(self, section, option, default, choices):
+        value = self.__raw(section, option, default)
+        if value is None:
+            return default
+        names = tuple(name.strip() for name in value.split(',') if name.strip())
+        for name in names:
+            if name not in choices:
+                raise self.__error(section, option, value,
+                                   name + ' is not one of ' + ', '.join(choices))
+        return names
+
+
+# Read and check soundbox.ini. Raises ConfigError if it cannot be read or
+# is not valid.
+def read_soundbox_config(ini_path):
+    config = configparser.ConfigParser()
+    try:
+        if not config.read(ini_path):
+            raise ConfigError('cannot read ' + ini_path)
+    except configparser.Error as ex:
+        raise ConfigError(str(ex))
+    return SoundboxConfig(config)
+
+
+# Class definition for the hot reload of soundbox.ini. reload() reads the
+# file again and, if it is valid, applies the live settings that changed
+# to the running soundbox:
+#
+#   vol_setting, amp_setting: the gain of the sound playing now, ramped so
+#                             it does not click, and of every later sound
+#   [loudness] settings: the same, for normalized sounds
+#   selected_sound_dir: the active collection, as the configuration menu
+#                       selects it
+#   [volume] knob settings and [gestures] timing: from the next detent or
+#                                                 press
+#
+# Other settings that changed are reported as needing a restart. A file
+# that is not valid, e.g. half written or mistyped, is reported and the
+# soundbox carries on with the settings it has. A setting that cannot be
+# applied has those applied before it put back as they were, so the
+# soundbox always runs on the settings of one reading of the file. Every
+# reload is timed.
+#
+# vol and amp given on the command line (gain_override, a (vol, amp)
+# pair) win over those of the file, as when the soundbox starts.
+class ConfigReloader(object):
+
+    def __init__(self, ini_path, config, sound_player, soundbox_control,
+                 gain_override=None):
+        self.__ini_path = ini_path
+        self.__config = config
+        self.__sound_player = sound_player
+        self.__soundbox_control = soundbox_control
+        self.__gain_override = gain_override
+        self.reloads = 0
+        self.failures = 0
+
+    def config(self):
+        return self.__config
+
+    # Called by the watcher with the paths that changed in the directory
+    # of soundbox.ini
+    def files_changed(self, paths):
+        if os.path.abspath(self.__ini_path) in [os.path.abspath(path) for path in paths]:
+            self.reload()
+
+    # Read soundbox.ini and apply what changed. Returns the names of the
+    # settings that changed, or None if the file is not valid.
+    def reload(self):
+        started = time.monotonic()
+        try:
+            config = read_soundbox_config(self.__ini_path)
+        except ConfigError as ex:
+            self.failures += 1
+            print('soundbox.ini not reloaded, keeping the settings in use: ', ex)
+            return None
+
+        old = self.__config
+        changes = config.changes(old)
+        applied = []
+        try:
+            for changed, apply in self.__live_steps():
+                if [name for name in changes if changed(name)]:
+                    # put back too if it fails half way
+                    applied.append(apply)
+                    apply(config)
+        except Exception as ex:
+            self.failures += 1
+            print('soundbox.ini reload failed, keeping the settings in use: ', ex)
+            for apply in reversed(applied):
+                try:
+                    apply(old)
+                except Exception as error:
+                    print('soundbox.ini reload: cannot put a setting back: ', error)
+            return None
+        self.__config = config
+        self.reloads += 1
+
+        restart = [name for name in changes
+                   if name not in SoundboxConfig.LIVE_SETTINGS]
+        print('soundbox.ini reloaded in ',
+              round(1000.0 * (time.monotonic() - started), 1), ' ms, changed: ',
+              changes)
+        if restart:
+            print('these settings take effect when soundbox restarts: ', restart)
+        if self.__gain_override is not None and \
+           ('vol_setting' in changes or 'amp_setting' in changes):
+            print('vol and amp given on the command line are kept')
+        return changes
+
+    # The steps that apply the live settings, in order: a test of the
+    # names of the settings that changed, and a function that applies
+    # those of a config
+    def __live_steps(self):
+        steps = []
+        if self.__gain_override is None:
+            steps.append((lambda name: name in ('vol_setting', 'amp_setting'),
+                          self.__apply_gain))
+        steps.extend([
+            (lambda name: name.startswith('loudness_'), self.__apply_loudness),
+            (lambda name: name == 'selected_dir', self.__apply_collection),
+            (lambda name: name.startswith('volume_'), self.__apply_volume),
+            (lambda name: name.startswith('gesture_'), self.__apply_gestures)])
+        return steps
+
+    def __apply_gain(self, config):
+        vol = config.vol_setting
+        amp = config.amp_setting
+        self.__sound_player.set_gain_settings(
+            vol if vol is not None else OMX_VOL_SETTING_DEFAULT,
+            amp if amp is not None else OMX_AMP_SETTING_DEFAULT)
+
+    def __apply_loudness(self, config):
+        self.__sound_player.set_loudness_target(config.normalization_target(),
+                                                config.loudness_true_peak_limit)
+
+    def __apply_collection(self, config):
+        if not self.__soundbox_control.select_collection(config.selected_dir):
+            raise ConfigError('[file_locations] selected_sound_dir: cannot '
+                              'select ' + config.selected_dir)
+
+    def __apply_volume(self, config):
+        self.__sound_player.volume_control().set_settings(config.volume_settings())
+
+    def __apply_gestures(self, config):
+        self.__soundbox_control.set_gesture_timing(config.gesture_timing())
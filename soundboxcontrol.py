@@ -0,0 +1,399 @@
+from gpiobackend import GPIO
+import os
+import time
+from threading import Thread
+from threading import Event
+from threading import Lock
+
+from globaldefs import *
+from platformdefs import *
+from commandswitch import *
+from ledscanner import *
+from soundplayer import *
+from buttondispatcher import *
+from gestures import *
+from asyncruntime import *
+
+
+# Blinks of the led of a button whose sound will not play, and how long
+# (seconds) the led is on and off for each
+UNPLAYABLE_FLASH_COUNT = 3
+UNPLAYABLE_FLASH_TIME = 0.1
+
+# How long (seconds) all the leds light up once to show the soundbox is
+# ready for presses, when soundbox.ini asks for it
+READY_CUE_FLASH_TIME = 0.3
+
+
+# Convenience function to create and set an event
+def create_event_and_set():
+    new_event = Event()
+    new_event.set()
+    return new_event
+
+
+# List all files (presumably sound files) alphabetically that are
+# in a specified directory. Hidden files, such as the sound index, are not
+# sounds.
+def get_sound_file_list(from_dir_name):
+    file_list = sorted(name for name in os.listdir(from_dir_name)
+                       if not name.startswith('.'))
+
+    # we have 5 buttons, so we need 5 things in this list or problems
+    # ensue! it's ok to try to play a file with no name, but its not ok
+    # to access the 4th element of a list with only three elements.
+    while len(file_list)<5:
+        file_list.append(' ')
+    print(file_list)
+    return file_list
+
+
+# Set up the pins of the buttons, leds and rotary switch
+def setup_pins():
+    # Tell the GPIO subsystem we are using BCM numbering for the pins
+    GPIO.setmode(GPIO.BCM)
+
+    # Initialize button input pins as GPIO.HIGH when buttons are not pressed
+    # The buttons are tied to ground, so input pins go GPIO.LOW when buttons
+    # are pressed
+    GPIO.setup(buttons, GPIO.IN, pull_up_down=BUTTON_PUD)
+
+    # Initialize pins connected to LEDs as output pins
+    GPIO.setup(leds, GPIO.OUT)
+
+
+    # There are pull up resistors already in place on the rotary switch
+    # assembly, so the two pins for it are simply configured as GPIO.IN
+    GPIO.setup(ROTARY_PIN_A, GPIO.IN)
+    GPIO.setup(ROTARY_PIN_B, GPIO.IN)
+
+    # The push switch of the rotary switch assembly requires pull up
+    # configuration as it does not have a built-in pull-up resistor
+    GPIO.setup(ROTARY_SWITCH_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+
+# Button press function to turn an LED on, signal the LEDScanner that
+# it should stop scanning (and not turn this particular LED off),
+# play the sound, turn off the LED after the sound plays, and signal
+# the LEDScanner to resume. The sound plays asynchronously on the sound
+# player's playback thread, a handle to which is returned so we can
+# interact with it.
+def process_button_press(sound_player, led_id, led_scanner, event, sound_file):
+
+    # a sound file can either be a real sound file, e.g. mp3, or it
+    # can contain a url for an internet audio stream. the file extension
+    # tells us which it is...
+    if sound_file.endswith('.url'):
+        url_file = open(sound_file, 'r')
+        sound_file = url_file.read().rstrip()
+        url_file.close()
+        print('url from the sound file: ', sound_file)
+
+
+    led_scanner.set_resume_led(led_id)
+    event.clear()
+    p = sound_player.play_sound_file(sound_file, event, led_id)
+    # no need to sleep here in case the user is holding the button down.
+    # presses arrive as edges, so a held button is a single press, and
+    # the gesture recognizer's debounce filters out switch chatter.
+    return p
+
+
+# Class definition for the soundbox control flow: the led scan, the five
+# buttons that play the sounds of a collection and the command switch. The
+# soundbox program runs it on the real pins; soundbench runs the very same
+# flow on simulated ones.
+#
+# It runs either on threads, with start() and run(), or created with
+# threaded=False on an asyncio event loop with run_async(). The latter
+# needs a sound player without a volume thread and an led compositor
+# without a thread of its own (see set_led_compositor()).
+class SoundboxControl(object):
+
+    def __init__(self, sound_player, sound_dir, prompts_dir,
+                 output_factory=AlsaOutput, gesture_timing=None,
+                 threaded=True, sound_index=None):
+        self.__sound_player = sound_player
+        self.__sound_index = sound_index
+
+        # Create a set of events that will be signaled when buttons are
+        # pressed. These are used to stop led scanning when a sound is
+        # played.
+        self.__button_events = tuple(create_event_and_set() for button in buttons)
+
+        # Termination is triggered by the CommandSwitch. When terminating,
+        # the handling of buttons in the main thread has to be blocked lest
+        # the button press that ends things in command switch be acted on
+        # by the main thread also.
+        self.__termination_event = create_event_and_set()
+
+        # Create the led scanner. The scan is drawn by the led compositor's
+        # thread, which draws all led patterns. The button press events are
+        # passed to it so the main thread can stop the led scan when a
+        # button is pressed.
+        self.__led_scanner = LEDScanner(*self.__button_events)
+
+        # Presses of the buttons and the command switch are timed by one
+        # gesture recognizer
+        self.__gesture_recognizer = GestureRecognizer(gesture_timing, threaded)
+
+        # Watch the five buttons for presses. The gesture recognizer reports
+        # button presses to the dispatcher, which queues them for the main
+        # thread.
+        self.__button_dispatcher = ButtonDispatcher(self.__gesture_recognizer)
+
+        # Monitor the command switch (push button function of volume
+        # control) on a separate thread.
+        self.__command_switch = CommandSwitch(prompts_dir,
+                                              self.__termination_event,
+                                              sound_player,
+                                              self.__led_scanner,
+                                              self.__button_dispatcher,
+                                              output_factory,
+                                              self.__gesture_recognizer,
+                                              self.select_collection)
+
+        # The directory of the active collection, its sounds and the
+        # sounds the index knows will not play, by their position in the
+        # sounds list. Their buttons blink rather than play. All are
+        # replaced together, as one tuple, when the drop zone changes or
+        # another collection is selected. Replacing it takes the lock, so
+        # a reload and a change of collection on other threads cannot
+        # undo each other.
+        self.__collection_lock = Lock()
+        self.__collection = self.__load_sounds(sound_dir)
+
+        # For each button, the led that goes with it, the event that stops
+        # the led scanner and the position of its sound in the sounds list
+        self.__button_actions = dict(
+            (button, (led_id, event, index))
+            for index, (button, led_id, event)
+            in enumerate(zip(buttons, leds, self.__button_events)))
+
+        self.__player = None
+        self.__running = False
+        self.__on_ready = None
+
+    def __load_sounds(self, sound_dir):
+        sounds = get_sound_file_list(sound_dir)
+        unplayable = {}
+        if self.__sound_index is not None:
+            for index, sound in enumerate(sounds):
+                path = os.path.join(sound_dir, sound)
+                info = self.__sound_index.get(path)
+                if info is None:
+                    # a file not indexed yet is played, until the index
+                    # knows better
+                    if not os.path.isfile(path):
+                        unplayable[index] = 'no sound file'
+                elif not info.playable():
+                    unplayable[index] = info.error
+            for index, error in sorted(unplayable.items()):
+                print('sound for button ', index + 1, ' will not play: ',
+                      sounds[index], ': ', error)
+        return (sound_dir, sounds, unplayable)
+
+    # Read the sound directory again after the drop zone changed, and swap
+    # in the new sounds. Callable from any thread: a press is handled with
+    # either the old sounds or the new ones, never a mix, and the sound
+    # playing now plays on.
+    def reload_sounds(self):
+        with self.__collection_lock:
+            sound_dir, sounds, unplayable = self.__collection
+            self.__collection = self.__load_sounds(sound_dir)
+
+    # Make another collection of the drop zone, a sibling directory of the
+    # active one, the active collection. The decoded sounds of the old
+    # collection are dropped from the cache and the new ones decoded in
+    # the background, so this returns in a fraction of a second. Returns
+    # False, keeping the active collection, if there is no such collection.
+    def select_collection(self, collection):
+        with self.__collection_lock:
+            old_dir = self.__collection[0]
+            sound_dir = os.path.join(os.path.dirname(old_dir.rstrip(os.sep)),
+                                     collection)
+            try:
+                self.__collection = self.__load_sounds(sound_dir)
+            except OSError as ex:
+                print('cannot select collection ', collection, ': ', ex)
+                return False
+        pcm_cache = self.__sound_player.pcm_cache()
+        if pcm_cache is not None:
+            if os.path.normpath(sound_dir) != os.path.normpath(old_dir):
+                pcm_cache.forget([os.path.normpath(old_dir)])
+            pcm_cache.preload(self.sound_paths())
+        return True
+
+    # Time the presses of the buttons and the command switch by other
+    # settings
+    def set_gesture_timing(self, timing):
+        self.__gesture_recognizer.set_timing(timing)
+
+    # Paths of the five sounds, e.g. to decode them ahead of time
+    def sound_paths(self):
+        sound_dir, sounds, unplayable = self.__collection
+        return [os.path.join(sound_dir, sound) for sound in sounds]
+
+    # Have on_ready() called once, as soon as button presses are served,
+    # on the thread that runs the control flow
+    def set_ready_callback(self, on_ready):
+        self.__on_ready = on_ready
+
+    def __ready(self):
+        on_ready = self.__on_ready
+        self.__on_ready = None
+        if on_ready is not None:
+            on_ready()
+
+    # Light all the leds once, over the led scan, to show that presses are
+    # served from now on
+    def show_ready_cue(self):
+        get_led_compositor().add_layer(FlashLayer(
+            leds, seconds_to_frames(READY_CUE_FLASH_TIME),
+            PAUSE_FLASH_PRIORITY, 1))
+
+    # Get ready what is not needed before the first press, such as the
+    # prompts of the menus. Called once the soundbox is ready.
+    def prepare(self):
+        self.__command_switch.prepare()
+
+    # Start the led scan and the command switch thread
+    def start(self):
+        self.__led_scanner.start_scanning()
+        command_thread = Thread(target=self.__command_switch.process_switch_events,
+                                name='command-switch')
+        command_thread.daemon = True
+        command_thread.start()
+
+    # Handle buttons until stop() is called
+    def run(self):
+        self.__running = True
+        self.__button_dispatcher.start()
+        self.__ready()
+        while self.__running:
+            # Wait for something to happen. The main thread sleeps here
+            # until a button is pressed or the playing sound ends, so
+            # nothing runs while the box is idle and a press is acted on
+            # as soon as it is detected.
+            self.handle_event(self.__button_dispatcher.next_event())
+
+    # Act on an event of the button dispatcher
+    def handle_event(self, event):
+        kind, source, rc = event
+
+        if kind == BUTTON_PRESSED:
+            # A button was pressed, process it. The processing starts
+            # the sound playing on the sound player's playback thread.
+            # It runs asynchronously and we can immediately go back to
+            # waiting for the next press as the sound plays.
+            if not self.__termination_event.is_set():
+                # the command switch is ending the program
+                return
+            led_id, event, sound_index = self.__button_actions[source]
+            sound_dir, sounds, unplayable = self.__collection
+            print(sounds[sound_index])
+            if sound_index in unplayable:
+                # a sound that would fail, leave the leds as they are and
+                # blink the button's led to say so
+                print('not playing: ', unplayable[sound_index])
+                get_led_compositor().add_layer(FlashLayer(
+                    (led_id,), seconds_to_frames(UNPLAYABLE_FLASH_TIME),
+                    PAUSE_FLASH_PRIORITY, UNPLAYABLE_FLASH_COUNT))
+                return
+            self.__player = process_button_press(
+                self.__sound_player, led_id, self.__led_scanner, event,
+                os.path.join(sound_dir, sounds[sound_index]))
+            self.__button_dispatcher.watch_player(self.__player)
+
+        elif kind == PLAYER_FINISHED and self.__sound_player.is_polyphonic():
+            # One of the sounds layered over each other ended. The leds
+            # scan again once the last of them has.
+            if self.__sound_player.voice_finished(source):
+                print("Sound player has finished with rc: ", rc)
+                self.__player = None
+                self.release_all_threads()
+
+        elif kind == PLAYER_FINISHED and source is self.__player:
+            # The sound we started last is finished. At
+            # that time we resume flashing the leds in sequence, which
+            # the user will interpret to mean that a new sound can be
+            # selected. Players that were replaced by a newer press
+            # also report here, but those are ignored.
+            print("Sound player has finished with rc: ", rc)
+            self.__sound_player.close_player_process()
+            self.__player = None
+            self.release_all_threads()
+
+    # Run the led scan, the buttons, the command switch and the volume knob
+    # as callbacks and coroutines on the event loop, until stop() is called
+    # or the coroutine is cancelled. GPIO edges and the end of a sound
+    # arrive on the threads of the GPIO backend and the playback engine;
+    # they only hand the event over to the loop. The shutdown menu waits
+    # for buttons, so it is run off the loop in its default executor.
+    async def run_async(self, loop):
+        # see asyncruntime.py for why asyncio is imported here
+        import asyncio
+        volume_control = self.__sound_player.volume_control()
+        command_switch = self.__command_switch
+        stopped = asyncio.Event()
+
+        def dispatch(event):
+            self.handle_event(event)
+            if not self.__running:
+                stopped.set()
+
+        self.__running = True
+        drivers = [
+            loop.create_task(drive_steps(get_led_compositor(),
+                                         time.monotonic, loop)),
+            loop.create_task(drive_steps(self.__gesture_recognizer,
+                                         GPIO.monotonic, loop)),
+            loop.create_task(drive_steps(volume_control,
+                                         time.monotonic, loop))]
+        self.__button_dispatcher.set_event_handler(
+            lambda event: loop.call_soon_threadsafe(dispatch, event))
+        command_switch.set_menu_runner(
+            lambda menu: loop.run_in_executor(None, menu))
+        command_switch.watch_switch(
+            lambda gesture: loop.call_soon_threadsafe(
+                command_switch.handle_gesture, gesture))
+        volume_control.start_decoding()
+        self.__led_scanner.start_scanning()
+        self.__button_dispatcher.start()
+        self.__ready()
+        try:
+            await stopped.wait()
+        finally:
+            # stop the edges first, so nothing is handed to the loop
+            # once it is gone
+            self.__running = False
+            self.__button_dispatcher.stop()
+            command_switch.unwatch_switch()
+            volume_control.stop_decoding()
+            self.__button_dispatcher.set_event_handler(None)
+            self.__led_scanner.stop_scanning()
+            self.release_all_threads()
+            for driver in drivers:
+                driver.cancel()
+            await asyncio.gather(*drivers, return_exceptions=True)
+
+    # Make run() return, from any thread
+    def stop(self):
+        self.__running = False
+        self.__button_dispatcher.interrupt()
+
+    # Stop the scan, the buttons and the threads watching the rotary
+    # switch, when the program is ending
+    def shutdown(self):
+        self.stop()
+        self.__led_scanner.stop_scanning()
+        self.__button_dispatcher.stop()
+        VolumeControl.terminate = True
+        CommandSwitch.terminate = True
+
+    # When ending the program via ctrl-c (or other means) no threads should
+    # be blocked so they can terminate. Otherwise they hang around.
+    def release_all_threads(self):
+        for event in self.__button_events:
+            event.set()
+        self.__led_scanner.resume()
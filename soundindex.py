@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import hashlib
+import wave
+import sqlite3
+import threading
+import subprocess
+
+from globaldefs import *
+from pcmdecoder import *
+from loudness import *
+
+# Defaults used when soundbox.ini has no [index] section. An empty file
+# name keeps the index in the sound file base dir.
+SOUND_INDEX_FILE_DEFAULT = ''
+SOUND_INDEX_FILE_NAME = '.soundindex.sqlite3'
+
+# Bumped whenever the table or what a probe finds changes, so an index
+# written by an older soundbox is built again rather than misread
+SOUND_INDEX_VERSION = 3
+
+# Frames decoded at the start and near the end of a sound to prove that it
+# plays
+SOUND_PROBE_FRAMES = 1024
+
+# Bytes read at a time while a sound file is hashed
+SOUND_HASH_READ_SIZE = 64 * 1024
+
+# Kinds of sound file
+SOUND_KIND_FILE = 'file'
+SOUND_KIND_URL = 'url'
+
+
+# What is known about one sound file. error is None for a sound that
+# plays, else why it does not. loudness (LUFS) and true_peak (dBTP) are
+# None for a sound that was not measured, such as a stream.
+class SoundInfo(object):
+
+    def __init__(self, path, size, mtime_ns, kind=SOUND_KIND_FILE, codec=None,
+                 rate=None, channels=None, duration=None, error=None,
+                 content_hash=None, loudness=None, true_peak=None):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.kind = kind
+        self.codec = codec
+        self.rate = rate
+        self.channels = channels
+        self.duration = duration
+        self.error = error
+        self.content_hash = content_hash
+        self.loudness = loudness
+        self.true_peak = true_peak
+
+    def playable(self):
+        return self.error is None
+
+    def describe(self):
+        if self.error is not None:
+            return self.path + ': ' + self.error
+        if self.kind == SOUND_KIND_URL:
+            return self.path + ': stream'
+        return '%s: %s %s Hz %s ch %.1f s %s LUFS %s dBTP' % (
+            self.path, self.codec, self.rate, self.channels,
+            self.duration or 0.0, self.loudness, self.true_peak)
+
+
+# Read the format of a file from its header, without decoding it. Returns
+# (codec, rate, channels, duration) with None for what is not known.
+def read_sound_format(path):
+    if path.lower().endswith('.wav'):
+        try:
+            wave_file = wave.open(path, 'rb')
+            try:
+                return ('pcm_s%dle' % (8 * wave_file.getsampwidth()),
+                        wave_file.getframerate(), wave_file.getnchannels(),
+                        wave_file.getnframes() / float(wave_file.getframerate()))
+            finally:
+                wave_file.close()
+        except (wave.Error, EOFError):
+            # not a format the wave module knows, e.g. float samples
+            pass
+
+    if soundfile is not None:
+        try:
+            info = soundfile.info(path)
+            return (info.subtype.lower(), info.samplerate, info.channels,
+                    info.duration)
+        except RuntimeError:
+            pass
+
+    try:
+        output = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-of', 'json',
+             '-show_entries', 'format=duration:stream=codec_name,sample_rate,channels',
+             '-select_streams', 'a:0', path],
+            stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        probed = json.loads(output.decode('utf-8'))
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return (None, None, None, None)
+    streams = probed.get('streams') or [{}]
+    duration = probed.get('format', {}).get('duration')
+    rate = streams[0].get('sample_rate')
+    return (streams[0].get('codec_name'),
+            int(rate) if rate else None,
+            streams[0].get('channels'),
+            float(duration) if duration else None)
+
+
+# Hash of the content of a file, which names what is made from it, so a
+# sound that is renamed or copied is not made again
+def content_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as sound_file:
+        while True:
+            data = sound_file.read(SOUND_HASH_READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+# Find out what a sound file is and whether it plays, by reading its
+# header and decoding a little of its start and its end. A sound that
+# plays is then decoded in full to measure its loudness. Runs in the probe
+# worker processes.
+def probe_sound(path, size, mtime_ns):
+    info = SoundInfo(path, size, mtime_ns)
+    if path.endswith('.url'):
+        info.kind = SOUND_KIND_URL
+        try:
+            with open(path, 'r') as url_file:
+                url = url_file.read().strip()
+        except (IOError, UnicodeDecodeError) as ex:
+            info.error = 'cannot read url: ' + str(ex)
+            return info
+        if '://' not in url:
+            info.error = 'no url in file'
+        info.codec = url
+        return info
+
+    try:
+        info.content_hash = content_hash(path)
+    except IOError as ex:
+        info.error = 'cannot read file: ' + str(ex)
+        return info
+    info.codec, info.rate, info.channels, info.duration = read_sound_format(path)
+    try:
+        decoder = open_decoder(path)
+    except DecoderError as ex:
+        info.error = str(ex)
+        return info
+    try:
+        if len(decoder.read(SOUND_PROBE_FRAMES)) == 0:
+            info.error = 'no sound in file'
+        elif info.duration is not None and info.duration > 1.0:
+            # a file cut short still has the header of the whole sound
+            decoder.seek(info.duration - 0.5)
+            if len(decoder.read(SOUND_PROBE_FRAMES)) == 0:
+                info.error = 'file is cut short'
+    except Exception as ex:
+        info.error = 'cannot decode: ' + str(ex)
+    finally:
+        decoder.close()
+    if info.error is None:
+        try:
+            decoder = open_decoder(path)
+            try:
+                info.loudness, info.true_peak = measure_loudness(decoder)
+            finally:
+                decoder.close()
+        except Exception as ex:
+            # the sound plays, only without being normalized
+            print('cannot measure the loudness of ', path, ': ', ex)
+    return info
+
+
+def probe_sound_args(args):
+    return probe_sound(*args)
+
+
+# Class definition for the index of the sound files in the drop zone. It
+# is a SQLite database of what each file is, keyed by path, size and
+# modification time: a file whose size and time have not changed is taken
+# from the index, anything new or changed is probed again. An unchanged
+# drop zone therefore loads with one query, and a sound that will not play
+# is known about before its button is pressed.
+#
+# Files are probed in a pool of worker processes, so decoding them neither
+# holds up nor risks this process. The workers are spawned rather than
+# forked, as the soundbox may have threads running when it scans.
+#
+# The drop zone watcher scans on a thread of its own while the main thread
+# looks sounds up, so the database is opened for use from any thread and
+# the index is only read or changed under its lock. A scan does not hold
+# the lock while it probes.
+class SoundIndex(object):
+
+    def __init__(self, index_path):
+        self.__lock = threading.Lock()
+        try:
+            self.__db = sqlite3.connect(index_path, check_same_thread=False)
+            version = self.__db.execute('PRAGMA user_version').fetchone()[0]
+        except sqlite3.Error as ex:
+            # e.g. a drop zone that is not writable. work from memory.
+            print('SoundIndex: cannot open ', index_path, ': ', ex)
+            self.__db = sqlite3.connect(':memory:', check_same_thread=False)
+            version = 0
+        if version != SOUND_INDEX_VERSION:
+            self.__db.execute('DROP TABLE IF EXISTS sounds')
+            self.__db.execute('CREATE TABLE sounds ('
+                              'path TEXT PRIMARY KEY, size INTEGER, '
+                              'mtime_ns INTEGER, kind TEXT, codec TEXT, '
+                              'rate INTEGER, channels INTEGER, '
+                              'duration REAL, error TEXT, content_hash TEXT, '
+                              'loudness REAL, true_peak REAL)')
+            self.__db.execute('PRAGMA user_version = %d' % SOUND_INDEX_VERSION)
+            self.__db.commit()
+        self.__sounds = {}
+        for row in self.__db.execute('SELECT path, size, mtime_ns, kind, codec, '
+                                     'rate, channels, duration, error, '
+                                     'content_hash, loudness, true_peak '
+                                     'FROM sounds'):
+            self.__sounds[row[0]] = SoundInfo(*row)
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    # Bring the index up to date with the sound files in the directories
+    # below base_dir, probing new and changed files with up to max_workers
+    # processes. Returns counts of the files found, probed and forgotten.
+    def scan(self, base_dir, max_workers=None):
+        started = time.monotonic()
+        found = {}
+        for dir_path, dir_names, file_names in os.walk(base_dir):
+            dir_names[:] = sorted(name for name in dir_names
+                                  if not name.startswith('.'))
+            for file_name in file_names:
+                if file_name.startswith('.'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (stat.st_size, stat.st_mtime_ns)
+
+        to_probe = []
+        with self.__lock:
+            for path, (size, mtime_ns) in sorted(found.items()):
+                known = self.__sounds.get(path)
+                if known is None or known.size != size or known.mtime_ns != mtime_ns:
+                    to_probe.append((path, size, mtime_ns))
+
+        probed = self.__probe(to_probe, max_workers)
+        with self.__lock:
+            gone = [path for path in self.__sounds if path not in found]
+            for path in gone:
+                del self.__sounds[path]
+            for info in probed:
+                self.__sounds[info.path] = info
+            if probed or gone:
+                self.__db.executemany('DELETE FROM sounds WHERE path = ?',
+                                      [(path,) for path in gone])
+                self.__db.executemany('INSERT OR REPLACE INTO sounds VALUES '
+                                      '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      [(info.path, info.size, info.mtime_ns,
+                                        info.kind, info.codec, info.rate,
+                                        info.channels, info.duration, info.error,
+                                        info.content_hash, info.loudness,
+                                        info.true_peak)
+                                       for info in probed])
+                self.__db.commit()
+        return {'files': len(found), 'probed': len(probed),
+                'forgotten': len(gone),
+                'seconds': round(time.monotonic() - started, 3)}
+
+    def __probe(self, to_probe, max_workers):
+        if not to_probe:
+            return []
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        workers = max(1, min(max_workers, len(to_probe)))
+        # imported here, an unchanged drop zone needs no probing
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(workers)
+        try:
+            return pool.map(probe_sound_args, to_probe)
+        finally:
+            pool.close()
+            pool.join()
+
+    # What is known about a sound file, or None if it is not in the index
+    def get(self, path):
+        with self.__lock:
+            return self.__sounds.get(path)
+
+    # Everything in the index, in order of path
+    def sounds(self):
+        with self.__lock:
+            return [info for path, info in sorted(self.__sounds.items())]
+
+    # The sound files in the index that do not play
+    def problems(self):
+        with self.__lock:
+            return [info for path, info in sorted(self.__sounds.items())
+                    if not info.playable()]
+
+
+# Where the index of the drop zone is kept when soundbox.ini does not say
+def default_index_path(sound_base_dir):
+    return os.path.join(sound_base_dir, SOUND_INDEX_FILE_NAME)
@@ -0,0 +1,249 @@
+import os
+import time
+import wave
+import threading
+
+from globaldefs import *
+from pcmdecoder import *
+from soundindex import *
+
+# Defaults used when soundbox.ini has no [ingest] section. The soundbox
+# runs on a single core, so one worker makes the renditions by default.
+INGEST_WORKERS_DEFAULT = 1
+INGEST_MAX_JOBS_DEFAULT = 20
+
+# The renditions of the sounds of a collection are kept in this hidden
+# directory of the collection, which the index, the watcher and the
+# buttons all pass over
+RENDITION_DIR_NAME = '.rendered'
+RENDITION_SUFFIX = '.wav'
+RENDITION_PART_SUFFIX = '.part'
+
+# Frames decoded and written at a time, so making a rendition takes the
+# same memory however long the sound is
+INGEST_DECODE_FRAMES = 64 * 1024
+
+# Niceness of the workers, so the buttons and leds come first
+INGEST_WORKER_NICENESS = 10
+
+
+# Where the rendition of a sound file with the given content hash is kept
+def rendition_path(path, content_hash):
+    return os.path.join(os.path.dirname(path), RENDITION_DIR_NAME,
+                        content_hash + RENDITION_SUFFIX)
+
+
+# Whether a sound needs a rendition: a file that plays but is not a 16 bit
+# wav at the sound card's rate and channel count
+def needs_rendition(info):
+    return info.kind == SOUND_KIND_FILE and info.playable() and \
+           info.content_hash is not None and \
+           not (info.codec == 'pcm_s16le' and info.rate == ALSA_PCM_RATE and
+                info.channels == ALSA_PCM_CHANNELS)
+
+
+def ingest_worker_init():
+    try:
+        os.nice(INGEST_WORKER_NICENESS)
+    except OSError:
+        pass
+
+
+# Decode a sound file into a 16 bit wav at the sound card's rate and
+# channel count. Runs in the ingest worker processes. The wav is written
+# to a part file that is synced and then renamed, so a rendition that
+# exists is always whole, even after a power cut. Returns (path, error)
+# with error None when the rendition was made.
+def render_sound(path, target):
+    part_file = target + RENDITION_PART_SUFFIX
+    try:
+        decoder = open_decoder(path)
+    except DecoderError as ex:
+        return (path, str(ex))
+    try:
+        with open(part_file, 'wb') as out:
+            wave_file = wave.open(out, 'wb')
+            wave_file.setnchannels(ALSA_PCM_CHANNELS)
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(ALSA_PCM_RATE)
+            while True:
+                samples = decoder.read(INGEST_DECODE_FRAMES)
+                if len(samples) == 0:
+                    break
+                wave_file.writeframes(samples.tobytes())
+            wave_file.close()
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(part_file, target)
+        sync_dir(os.path.dirname(target))
+    except Exception as ex:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        return (path, 'cannot render: ' + str(ex))
+    finally:
+        decoder.close()
+    return (path, None)
+
+
+def render_sound_args(args):
+    return render_sound(*args)
+
+
+# Make a rename in a directory survive a power cut
+def sync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Class definition for the ingest of the drop zone. Each sound file the
+# index knows of that is not already in the sound card's format is
+# decoded, resampled if need be, into a wav rendition that is, so playing
+# it costs no more than reading it. The sound player plays the rendition
+# of a sound rather than the sound itself once it has been made.
+#
+# Renditions are named after the content hash the index keeps, in a hidden
+# directory of the collection, so they survive restarts and a sound that
+# is copied or renamed is not made again. Renditions no sound has any more
+# are removed. A rendition is only ever renamed into place whole, so a
+# power cut part way through leaves at most a part file, which the next
+# ingest removes before it makes that rendition again.
+#
+# Renditions are made by a pool of worker processes, spawned like the
+# index's probe workers and niced below the soundbox. Each decodes a chunk
+# at a time, so memory is bounded by the number of workers rather than the
+# length of the sounds, and a worker is replaced by a fresh one after
+# max_jobs renditions.
+#
+# ingest() makes the renditions that are missing. request() asks for one
+# on a thread of its own; requests made while one runs make it go round
+# once more when done.
+class SoundIngest(object):
+
+    def __init__(self, sound_index, workers=INGEST_WORKERS_DEFAULT,
+                 max_jobs=INGEST_MAX_JOBS_DEFAULT):
+        self.__sound_index = sound_index
+        self.__workers = workers
+        self.__max_jobs = max_jobs
+        self.__lock = threading.Lock()
+        self.__pending = False
+        self.__thread = None
+        self.__done = threading.Condition(self.__lock)
+        self.rendered = 0
+        self.failed = 0
+        self.removed = 0
+
+    # The file to play for a sound: its rendition once made, else the
+    # sound itself
+    def source_for(self, path):
+        info = self.__sound_index.get(path)
+        if info is None or not needs_rendition(info):
+            return path
+        rendition = rendition_path(path, info.content_hash)
+        if os.path.isfile(rendition):
+            return rendition
+        return path
+
+    # Ingest on a thread of its own
+    def request(self):
+        with self.__lock:
+            self.__pending = True
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='sound-ingest')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    # Wait until no ingest is running or asked for. Returns False on a
+    # timeout.
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__done:
+            while self.__thread is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__done.wait(remaining)
+            return True
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                if not self.__pending:
+                    self.__thread = None
+                    self.__done.notify_all()
+                    return
+                self.__pending = False
+            try:
+                print('sound ingest: ', self.ingest())
+            except Exception as ex:
+                print('sound ingest failed: ', ex)
+
+    # Make the renditions that are missing and remove those no sound has.
+    # Returns counts of what was done.
+    def ingest(self):
+        started = time.monotonic()
+        wanted = {}
+        jobs = []
+        for info in self.__sound_index.sounds():
+            if not needs_rendition(info):
+                continue
+            target = rendition_path(info.path, info.content_hash)
+            if target in wanted:
+                # a copy of a sound already being made
+                continue
+            wanted[target] = info.path
+            if not os.path.isfile(target):
+                jobs.append((info.path, target))
+
+        # part files left by a power cut, and renditions of sounds that
+        # are gone or changed
+        dirs = set(os.path.dirname(info.path)
+                   for info in self.__sound_index.sounds())
+        removed = 0
+        for dir_path in sorted(dirs):
+            rendition_dir = os.path.join(dir_path, RENDITION_DIR_NAME)
+            if not os.path.isdir(rendition_dir):
+                continue
+            for name in os.listdir(rendition_dir):
+                path = os.path.join(rendition_dir, name)
+                if path not in wanted:
+                    os.remove(path)
+                    removed += 1
+
+        failed = 0
+        for path, error in self.__render(jobs):
+            if error is not None:
+                failed += 1
+                print('no rendition of ', path, ': ', error)
+        self.rendered += len(jobs) - failed
+        self.failed += failed
+        self.removed += removed
+        return {'rendered': len(jobs) - failed, 'failed': failed,
+                'removed': removed,
+                'seconds': round(time.monotonic() - started, 3)}
+
+    def __render(self, jobs):
+        if not jobs:
+            return []
+        for path, target in jobs:
+            rendition_dir = os.path.dirname(target)
+            if not os.path.isdir(rendition_dir):
+                os.mkdir(rendition_dir)
+        # imported here, as for the index's probe
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(max(1, min(self.__workers, len(jobs))),
+                            ingest_worker_init, maxtasksperchild=self.__max_jobs)
+        try:
+            return list(pool.imap_unordered(render_sound_args, jobs))
+        finally:
+            pool.close()
+            pool.join()
+
+    def stats(self):
+        return {'rendered': self.rendered, 'failed': self.failed,
+                'removed': self.removed}
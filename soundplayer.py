@@ -3,11 +3,16 @@ from threading import Event
 
 
 # Following are used only by SoundPlayer
-import subprocess
-import alsaaudio
+from playbackengine import *
+from pcmdecoder import *
+from pcmcache import *
+from playerpool import *
+from voicemixer import *
+from loudness import *
 
 from volumecontrol import *
 from ledflasher import *
+from ledcompositor import *
 from globaldefs import *
 
 # Values used when command line overrides are not supplied and
@@ -17,21 +22,168 @@ OMX_AMP_SETTING_DEFAULT = '2500'
 
 
 # Class definition encapsulating the metadata for the sound being played.
-# This class  manages a sub-process to play sounds asynchronously while
-# the process that started the player continues to run on its own.
+# Sounds are decoded and played by a PlaybackEngine running inside this
+# process, or by a pool of pre-started player worker processes, so they
+# play asynchronously while the caller continues to run on its own. The
+# handle of the sound being played stands in for the omxplayer sub-process
+# that used to do this job.
+#
+# With more than one voice, sounds are played by a VoiceMixer in this
+# process, and a sound started while others play is layered over them
+# rather than stopping them. The led of every sound playing is lit, and
+# pausing or stopping acts on all of them.
+#
+# With a crossfade or fade out time, sounds also play through a VoiceMixer,
+# of one voice when there are not more, which makes the transitions: a
+# new sound fades in as the one before it fades out, and a stopped sound
+# fades out rather than being cut off.
 class SoundPlayer(object):
 
-    def __init__(self, omx_vol_setting, omx_amp_setting):
+    def __init__(self, omx_vol_setting, omx_amp_setting, pcm_cache=None,
+                 player_pool=None, output_factory=AlsaOutput,
+                 mixer_factory=open_alsa_mixer, volume_thread=True,
+                 volume_settings=None, software_volume=False,
+                 ramp_ms=GAIN_RAMP_MS, dsp_stages=None,
+                 voices=MIXER_VOICES_DEFAULT,
+                 crossfade_ms=TRANSITION_CROSSFADE_MS_DEFAULT,
+                 fade_out_ms=TRANSITION_FADE_OUT_MS_DEFAULT):
         self.__player_process = None
         self.__omx_vol_setting = omx_vol_setting
         self.__omx_amp_setting = omx_amp_setting
+        # omxplayer applied --vol and --amp (both in millibels) to every
+        # sound, the engine applies the same as a single gain factor
+        self.__gain = millibels_to_gain(int(omx_vol_setting) +
+                                        int(omx_amp_setting))
+        # the pool has the same control functions as the engine, so once
+        # a sound is started both are handled alike
+        self.__player_pool = player_pool
+        self.__polyphonic = voices > 1
+        self.__crossfade = crossfade_ms > 0
+        self.__mixing = player_pool is None and \
+                        (self.__polyphonic or crossfade_ms > 0 or fade_out_ms > 0)
+        if player_pool is not None:
+            self.__engine = player_pool
+        elif self.__mixing:
+            self.__engine = VoiceMixer(output_factory, voices, ramp_ms=ramp_ms,
+                                       dsp_stages=dsp_stages,
+                                       crossfade_ms=crossfade_ms,
+                                       fade_out_ms=fade_out_ms)
+        else:
+            self.__engine = PlaybackEngine(output_factory, ramp_ms=ramp_ms,
+                                           dsp_stages=dsp_stages)
+        # decoded sounds are taken from the cache when there is one
+        self.__pcm_cache = pcm_cache
+        self.__sound_ingest = None
+        # with loudness normalization the gain of each sound is worked
+        # out from its loudness in the index when it is played
+        self.__sound_index = None
+        self.__loudness_target = None
+        self.__true_peak_limit = TRUE_PEAK_LIMIT_DEFAULT
+        self.__playing_path = None
         self.__playing_event = None
         self.__playing_led_id = None
+        self.__playing_layer = None
+        # with more than one voice, the path, led and event of the sound
+        # of each handle playing
+        self.__voices = {}
         self.__paused = False
-        self.__volume_control = VolumeControl(self)
+        # with software volume the knob sets the gain of the samples
+        # rather than the sound device's mixer
+        if software_volume:
+            mixer_factory = lambda: SoftwareMixer(self.__engine)
+        self.__volume_control = VolumeControl(self, mixer_factory,
+                                              volume_settings)
         self.__flasher = None
-        vol_ctl_Thread = Thread(target=self.__volume_control.loop)
-        vol_ctl_Thread.start()
+        # the asyncio runtime turns the volume on its event loop instead
+        if volume_thread:
+            vol_ctl_Thread = Thread(target=self.__volume_control.loop,
+                                    name='volume-control')
+            vol_ctl_Thread.start()
+
+    def volume_control(self):
+        return self.__volume_control
+
+    # Time taken by each stage of the DSP chain of the engine in this
+    # process. None without one, or when sounds play in the player pool,
+    # whose workers report their own.
+    def dsp_stats(self):
+        if self.__player_pool is not None:
+            return None
+        return self.__engine.dsp_stats()
+
+    def is_polyphonic(self):
+        return self.__polyphonic
+
+    # State of the voice mixer, for diagnostics. None without one.
+    def mixer_stats(self):
+        if not self.__mixing:
+            return None
+        return self.__engine.stats()
+
+    # Change the omxplayer style --vol and --amp settings (millibels), e.g.
+    # when soundbox.ini is reloaded. The sound playing now ramps to the new
+    # gain and later sounds start at it.
+    def set_gain_settings(self, omx_vol_setting, omx_amp_setting):
+        self.__omx_vol_setting = omx_vol_setting
+        self.__omx_amp_setting = omx_amp_setting
+        self.__gain = millibels_to_gain(int(omx_vol_setting) +
+                                        int(omx_amp_setting))
+        self.__regain()
+
+    # The index whose loudness measurements normalization goes by
+    def set_sound_index(self, sound_index):
+        self.__sound_index = sound_index
+
+    # Bring every sound to the target loudness (LUFS), as measured by the
+    # index, without its true peak going over true_peak_limit (dBTP). The
+    # gain that does so takes the place of the --amp setting; --vol is
+    # still applied. A sound whose loudness is not known yet plays with
+    # --amp as before. A target of None turns normalization off. The sound
+    # playing now ramps to its new gain.
+    def set_loudness_target(self, target, true_peak_limit=TRUE_PEAK_LIMIT_DEFAULT):
+        self.__loudness_target = target
+        self.__true_peak_limit = true_peak_limit
+        if self.__playing_path is not None:
+            self.__regain()
+
+    # Ramp the sounds playing to the gains they are played with now
+    def __regain(self):
+        if not self.__polyphonic:
+            self.__engine.set_gain(self.__gain_for(self.__playing_path))
+            return
+        for handle, (path, led_id, event) in list(self.__voices.items()):
+            self.__engine.set_voice_gain(handle, self.__gain_for(path))
+
+    # The gain a sound file is played with
+    def __gain_for(self, sound_file_path_name):
+        if self.__loudness_target is None or self.__sound_index is None or \
+           sound_file_path_name is None:
+            return self.__gain
+        info = self.__sound_index.get(sound_file_path_name)
+        if info is None:
+            return self.__gain
+        millibels = normalizing_millibels(info.loudness, info.true_peak,
+                                          self.__loudness_target,
+                                          self.__true_peak_limit)
+        if millibels is None:
+            return self.__gain
+        return millibels_to_gain(int(self.__omx_vol_setting) + millibels)
+
+    # Play the renditions the ingest makes of sounds, in the sound card's
+    # format, rather than the sounds themselves once they are made
+    def set_sound_ingest(self, sound_ingest):
+        self.__sound_ingest = sound_ingest
+        if self.__pcm_cache is not None:
+            self.__pcm_cache.set_source_for(sound_ingest.source_for)
+
+    def __source_for(self, sound_file_path_name):
+        if self.__sound_ingest is None:
+            return sound_file_path_name
+        return self.__sound_ingest.source_for(sound_file_path_name)
+
+    # The cache of decoded sounds, or None if sounds are decoded as played
+    def pcm_cache(self):
+        return self.__pcm_cache
 
     def is_active(self):
         if self.__player_process is None:
@@ -42,80 +194,169 @@ class SoundPlayer(object):
     def is_paused(self):
         return self.__paused
 
+    # State of the player worker pool, for diagnostics. None when sounds
+    # are played in this process.
+    def describe_pool(self):
+        if self.__player_pool is None:
+            return None
+        return self.__player_pool.describe()
+
     def close(self):
-        pass
+        self.__engine.close()
 #        self.__volume_control.close()
 
     def toggle_playback(self):
         if self.__player_process is not None:
             if self.__paused == False:
-                self.__player_process.stdin.write(b'p')
-                self.__player_process.stdin.flush()
+                self.__engine.pause()
                 self.__paused = True
 
-                # Flash the playing led
-                self.__flasher = LEDFlasher(self.__playing_led_id)
-                flash_thread = Thread(target=self.__flasher.flash_til_stopped)
-                flash_thread.start()
+                # Flash the playing leds
+                self.__flasher = LEDFlasher(*self.__playing_leds())
+                self.__flasher.start_flashing()
             else:
-                self.__player_process.stdin.write(b' ')
-                self.__player_process.stdin.flush()
+                self.__engine.resume()
                 self.__paused = False
+                # With the flashing gone, the steady light of the
+                # playing led shows again.
                 self.__flasher.stop_flashing()
 
-                # get the led on now to minimize flickering
-                GPIO.output(self.__playing_led_id, GPIO.HIGH)
-                # Wait for the flashing to cease
-                while self.__flasher.is_flashing():
-                    continue
-                # make sure that when the flasher is done, the led is on
-                GPIO.output(self.__playing_led_id, GPIO.HIGH)
-
         return self.__player_process
 
     def close_player_process(self):
         self.__player_process = None
+        self.__playing_path = None
+        self.__hide_playing_led()
+
+    # Leds of the sounds playing
+    def __playing_leds(self):
+        if not self.__polyphonic:
+            return (self.__playing_led_id,)
+        return tuple(sorted(set(led_id for path, led_id, event
+                                in self.__voices.values())))
+
+    # Keep the leds of the playing sounds lit, drawn over the led scan
+    def __show_playing_led(self):
+        self.__hide_playing_led()
+        self.__playing_layer = SolidLayer(
+            dict((led_id, 100) for led_id in self.__playing_leds()),
+            PLAYING_PRIORITY)
+        get_led_compositor().add_layer(self.__playing_layer)
+
+    def __hide_playing_led(self):
+        if self.__playing_layer is not None:
+            get_led_compositor().remove_layer(self.__playing_layer)
+            self.__playing_layer = None
 
     def quit_playing(self):
         if self.__player_process is not None:
-            if self.__flasher is not None:
-                self.__flasher.stop_flashing()
-                while self.__flasher.is_flashing():
-                    continue
-                self.__flasher.set_run_flag()
-            print('writing q to omxplayer to make it stop')
-            self.__player_process.stdin.write(b'q')
-            self.__player_process.stdin.flush()
-            self.__player_process.terminate()
-            self.__player_process = None
-            self.__playing_event.set()
-            self.__paused = False
-            GPIO.output(self.__playing_led_id, GPIO.LOW)
+            print('stopping the sound being played')
+            self.__engine.stop()
+            self.__forget_playing()
+
+    # The sound playing is no longer the one shown and controlled
+    def __forget_playing(self):
+        if self.__flasher is not None:
+            self.__flasher.stop_flashing()
+        self.__player_process = None
+        self.__playing_path = None
+        self.__playing_event.set()
+        self.__paused = False
+        self.__hide_playing_led()
+
 
+    # A sound of the voice mixer ended. Returns True when no sound plays
+    # any more, so the led scan can resume.
+    def voice_finished(self, player):
+        if player not in self.__voices:
+            return False
+        del self.__voices[player]
+        if self.__voices:
+            if self.__player_process is not None:
+                self.__show_playing_led()
+            return False
+        if self.__flasher is not None:
+            self.__flasher.stop_flashing()
+        self.__paused = False
+        self.close_player_process()
+        return True
 
     def play_sound_file(self, sound_file_path_name, event, led_id):
+        if self.__polyphonic:
+            return self.__play_voice(sound_file_path_name, event, led_id)
+
         # When a sound is already playing and a new sound is requested,
-        # stop the current sound before starting the new one.
-        self.quit_playing()
+        # stop the current sound before starting the new one. With a
+        # crossfade the mixer fades it out as the new one starts instead.
+        if self.__crossfade and self.__player_process is not None and \
+           not self.__paused:
+            self.__forget_playing()
+        else:
+            self.quit_playing()
 
         # Remember how this sound was selected so the leds stop scanning
         # and the led for the selection is lit up.
         self.__playing_event = event
         self.__playing_led_id = led_id
-        GPIO.output(self.__playing_led_id, GPIO.HIGH)
+        self.__show_playing_led()
         self.__playing_event.clear()
 
-        # Play the sound in a sub-process. This allows the sound to play
-        # while we continue scanning the buttons in case our user presses
-        # a button while the sound plays.
+        # Play the sound on the engine's playback thread. This allows the
+        # sound to play while we continue waiting for buttons in case our
+        # user presses a button while the sound plays.
         print('playing: ', sound_file_path_name)
-        p = self.__player_process = subprocess.Popen(['omxplayer',
-                        '--vol', self.__omx_vol_setting,
-                        '--amp', self.__omx_amp_setting,
-                        '-o','alsa:'+ALSA_DEVICE_NAME,
-                        sound_file_path_name],
-                        stdin=subprocess.PIPE,
-                        stdout=None,stderr=None)
+        self.__playing_path = sound_file_path_name
+        gain = self.__gain_for(sound_file_path_name)
+        try:
+            if self.__player_pool is not None:
+                # the worker decodes the file itself
+                p = self.__engine.play(self.__source_for(sound_file_path_name),
+                                       gain)
+            elif self.__pcm_cache is not None:
+                decoder = self.__pcm_cache.open_decoder(sound_file_path_name)
+                p = self.__engine.play(decoder, gain)
+            else:
+                decoder = open_decoder(self.__source_for(sound_file_path_name))
+                p = self.__engine.play(decoder, gain)
+        except DecoderError as ex:
+            # like omxplayer given a bad file, report that playing ended
+            # right away
+            print('cannot play ', sound_file_path_name, ': ', ex)
+            p = PlaybackHandle(sound_file_path_name)
+            p.finish(PLAYBACK_FAILED)
+        self.__player_process = p
         return p
 
+    # Play a sound as a voice of the mixer, over those playing. Pressing a
+    # button again restarts its sound, and with every voice playing the
+    # oldest makes way.
+    def __play_voice(self, sound_file_path_name, event, led_id):
+        # a new sound plays at once, the paused ones stay paused (and their
+        # leds flashing) until the command switch resumes them
+        event.clear()
+        print('playing: ', sound_file_path_name)
+        gain = self.__gain_for(sound_file_path_name)
+        try:
+            if self.__pcm_cache is not None:
+                decoder = self.__pcm_cache.open_decoder(sound_file_path_name)
+            else:
+                decoder = open_decoder(self.__source_for(sound_file_path_name))
+            p = self.__engine.play(decoder, gain, led_id)
+        except DecoderError as ex:
+            print('cannot play ', sound_file_path_name, ': ', ex)
+            p = PlaybackHandle(sound_file_path_name)
+            p.finish(PLAYBACK_FAILED)
+        self.__voices[p] = (sound_file_path_name, led_id, event)
+        self.__playing_event = event
+        self.__playing_led_id = led_id
+        self.__playing_path = sound_file_path_name
+        self.__player_process = p
+        self.__show_playing_led()
+        return p
+
+    # Move the sound being played to a position given in seconds
+    def seek(self, seconds):
+        if self.__player_process is not None:
+            self.__engine.seek(seconds)
+
 
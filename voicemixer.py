@@ -0,0 +1,454 @@
+import time
+import threading
+
+import numpy
+
+from globaldefs import *
+from gainstage import *
+from dspchain import *
+from playbackengine import *
+
+# Defaults used when soundbox.ini does not say. With one voice sounds play
+# one at a time, as they always have, on a PlaybackEngine.
+MIXER_VOICES_DEFAULT = 1
+MIXER_VOICES_LIMIT = 16
+
+# Time (ms) a stolen voice takes to fade out, short enough to make room at
+# once and long enough not to click, unless a crossfade is asked for
+MIXER_STEAL_FADE_MS = 10
+
+# Defaults of the transitions between sounds: none, a new sound cuts the
+# one before it off and stop() silences the device at once
+TRANSITION_CROSSFADE_MS_DEFAULT = 0
+TRANSITION_FADE_OUT_MS_DEFAULT = 0
+
+# Level (a fraction of full scale) above which a sum of voices is soft
+# clipped. Under it the mix is left as it is.
+MIXER_SOFT_CLIP_KNEE = 0.8
+
+
+# Soft clip samples (float32, int16 scale) into out: unchanged up to the
+# knee, and above it bent over by a tanh curve that meets the line without
+# a kink and never goes over full scale. work is a buffer of the same
+# shape.
+def soft_clip(samples, out, work, knee=MIXER_SOFT_CLIP_KNEE):
+    linear = knee * 32767.0
+    headroom = 32767.0 - linear
+    numpy.abs(samples, out=work)
+    work -= linear
+    numpy.maximum(work, 0.0, out=work)
+    work *= 1.0 / headroom
+    numpy.tanh(work, out=work)
+    work *= headroom
+    numpy.copysign(work, samples, out=work)
+    numpy.clip(samples, -linear, linear, out=out)
+    out += work
+    return out
+
+
+# One sound playing in the mixer: its decoder, the handle reported to the
+# caller, the key it was started with (e.g. the led of its button), the
+# gain stage that scales it, whether it is fading out and whether it is
+# paused
+class Voice(object):
+
+    def __init__(self, decoder, handle, key, gain, ramp_ms):
+        self.decoder = decoder
+        self.handle = handle
+        self.key = key
+        self.gain_stage = GainStage(gain, ramp_ms)
+        self.fading = False
+        self.paused = False
+
+
+# Tell the handles of voices that were stopped that they were, once the
+# mixer's lock is released
+def finish_stopped(handles):
+    for handle in handles:
+        handle.finish(PLAYBACK_STOPPED)
+
+
+# Class definition for the polyphonic mixer. It plays up to voices sounds
+# at once, each at a gain of its own, summed into one stream to the sound
+# device, so the buttons' sounds layer over each other rather than cut
+# each other off. It has the control functions of a PlaybackEngine, so
+# the sound player and the software volume drive either alike; play()
+# also takes a key, and pause, resume and stop act on every voice.
+#
+# A sound started with the key of a voice that is playing takes that
+# voice's place, so pressing a button again restarts its sound. When all
+# the voices are playing, a new sound takes the place of the oldest. A
+# voice that loses its place reports that it was stopped at once, and fades
+# out over MIXER_STEAL_FADE_MS rather than cutting off with a click.
+#
+# Transitions between sounds are made at the sample level too. With
+# crossfade_ms, a voice that loses its place fades out over that time while
+# the sound taking it fades in, both playing meanwhile, so one sound runs
+# into the next without a gap; with a single voice that is a crossfade from
+# each sound to the next. With fade_out_ms, stop() fades the voices out
+# rather than silencing the device at once. Fades are linear, so the two
+# sides of a crossfade always add up to full gain. Sounds stopped while
+# paused are cut off, as they are not heard anyway.
+#
+# Each voice is paused on its own. pause() and resume() act on every
+# voice, but a sound started while they are paused plays at once and
+# leaves them paused until resume(). The device is paused only while
+# every voice is.
+#
+# A single playback thread does all decoder and device work, as in the
+# PlaybackEngine. Each period it reads a period of every voice, scales it
+# by the voice's gain stage and adds it into a float32 buffer; the sum is
+# scaled by the volume and goes through the DSP chain, if any, to the
+# device. Only a sum of voices is soft clipped, as only a sum can go over
+# full scale where the sounds in it do not; a single voice plays
+# unchanged, its peaks left to the limiter of the DSP chain. Every step is
+# a vectorized numpy operation on the whole period, so a period costs a
+# fixed amount plus one read, scale and add per voice. The time each
+# period takes is kept by number of voices.
+class VoiceMixer(object):
+
+    def __init__(self, output_factory=AlsaOutput, voices=MIXER_VOICES_DEFAULT,
+                 period_frames=ALSA_PERIOD_FRAMES, ramp_ms=GAIN_RAMP_MS,
+                 dsp_stages=None, crossfade_ms=TRANSITION_CROSSFADE_MS_DEFAULT,
+                 fade_out_ms=TRANSITION_FADE_OUT_MS_DEFAULT):
+        self.__output_factory = output_factory
+        self.__output = None
+        self.__output_paused = False
+        self.__native_pause = False
+        self.__size = max(1, voices)
+        self.__period_frames = period_frames
+        self.__ramp_ms = ramp_ms
+        self.__crossfade_ms = crossfade_ms
+        self.__fade_out_ms = fade_out_ms
+
+        self.__wakeup = threading.Condition()
+        # the voices playing, oldest first, and those fading out after
+        # they lost their place
+        self.__voices = []
+        self.__fading = []
+        self.__volume_stage = GainStage(ramp_ms=ramp_ms)
+        self.__seeks = []
+        self.__drop_pending = False
+        self.__retired = []
+        self.__open_pending = False
+        self.__closing = False
+
+        self.__mix = numpy.empty((period_frames, ALSA_PCM_CHANNELS), numpy.float32)
+        self.__clipped = numpy.empty((period_frames, ALSA_PCM_CHANNELS), numpy.float32)
+        self.__work = numpy.empty((period_frames, ALSA_PCM_CHANNELS), numpy.float32)
+        self.__out = numpy.empty((period_frames, ALSA_PCM_CHANNELS), numpy.int16)
+        self.__dsp_chain = None
+        if dsp_stages:
+            self.__dsp_chain = DSPChain(dsp_stages, period_frames)
+        # whether the playback thread mixed anything last period, so the
+        # chain starts afresh after silence and its tail is written out
+        self.__sounding = False
+
+        # periods mixed and the time they took, by number of voices
+        self.__periods = {}
+        self.__seconds = {}
+        self.stolen = 0
+
+        self.__thread = threading.Thread(target=self.__run, name='voice-mixer')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    # Open the sound device now rather than on the first play
+    def prepare(self):
+        with self.__wakeup:
+            self.__open_pending = True
+            self.__wakeup.notify()
+
+    # Start playing from a decoder as a voice of its own, taking the place
+    # of the voice with the same key, or of the oldest voice when all are
+    # playing. Returns the PlaybackHandle for the new sound.
+    def play(self, decoder, gain=1.0, key=None):
+        handle = PlaybackHandle(decoder)
+        stopped = []
+        with self.__wakeup:
+            replaced = [voice for voice in self.__voices
+                        if key is not None and voice.key == key]
+            if not replaced and len(self.__voices) >= self.__size:
+                replaced = self.__voices[:1]
+            crossfade = bool(replaced) and self.__crossfade_ms > 0 and \
+                        not replaced[0].paused
+            for voice in replaced:
+                self.stolen += 1
+                if voice.paused:
+                    stopped.append(self.__cut_locked(voice))
+                else:
+                    stopped.append(self.__fade_locked(
+                        voice, self.__crossfade_ms or MIXER_STEAL_FADE_MS))
+            voice = Voice(decoder, handle, key, 0.0 if crossfade else gain,
+                          self.__ramp_ms)
+            if crossfade:
+                voice.gain_stage.set_gain(gain, self.__crossfade_ms,
+                                          GAIN_RAMP_LINEAR)
+            self.__voices.append(voice)
+            self.__wakeup.notify()
+        finish_stopped(stopped)
+        return handle
+
+    # Fade a voice out over fade_ms, from wherever its gain is now. Returns
+    # its handle, to be told once the lock is released that the voice was
+    # stopped: done under the lock, the handle's done callbacks could not
+    # call the mixer.
+    def __fade_locked(self, voice, fade_ms):
+        if voice in self.__voices:
+            self.__voices.remove(voice)
+            self.__fading.append(voice)
+        voice.gain_stage.set_gain(0.0, fade_ms, GAIN_RAMP_LINEAR)
+        voice.fading = True
+        return voice.handle
+
+    # Stop a voice at once, throwing away what of it the device still has.
+    # Returns its handle, as __fade_locked() does.
+    def __cut_locked(self, voice):
+        if voice in self.__voices:
+            self.__voices.remove(voice)
+        elif voice in self.__fading:
+            self.__fading.remove(voice)
+        self.__retired.append(voice.decoder)
+        self.__seeks = [seek for seek in self.__seeks if seek[0] is not voice]
+        # what the device still has is of the voices that play on, if any
+        if not self.__playing_locked():
+            self.__drop_pending = True
+        return voice.handle
+
+    # The voices that are not paused, fading ones included
+    def __playing_locked(self):
+        return [voice for voice in self.__voices + self.__fading
+                if not voice.paused]
+
+    def pause(self):
+        with self.__wakeup:
+            for voice in self.__voices + self.__fading:
+                voice.paused = True
+            self.__wakeup.notify()
+
+    def resume(self):
+        with self.__wakeup:
+            for voice in self.__voices + self.__fading:
+                voice.paused = False
+            self.__wakeup.notify()
+
+    # Move the newest voice
+    def seek(self, seconds):
+        with self.__wakeup:
+            if self.__voices:
+                self.__seeks.append((self.__voices[-1], seconds))
+                self.__wakeup.notify()
+
+    # Change the gain of the newest voice, ramping to it
+    def set_gain(self, gain):
+        with self.__wakeup:
+            if self.__voices:
+                self.__voices[-1].gain_stage.set_gain(gain)
+
+    # Change the gain of the voice of a handle, ramping to it
+    def set_voice_gain(self, handle, gain):
+        with self.__wakeup:
+            for voice in self.__voices:
+                if voice.handle is handle:
+                    voice.gain_stage.set_gain(gain)
+
+    # Change the volume (a linear gain factor) of the mix, ramping to it
+    def set_volume(self, volume):
+        self.__volume_stage.set_gain(volume)
+
+    # Stop every voice, fading those that play out over fade_out_ms and
+    # cutting off those that are paused
+    def stop(self):
+        with self.__wakeup:
+            if self.__fade_out_ms > 0 and self.__playing_locked():
+                stopped = []
+                for voice in self.__voices + self.__fading:
+                    if voice.paused:
+                        stopped.append(self.__cut_locked(voice))
+                    elif not voice.fading:
+                        stopped.append(self.__fade_locked(voice, self.__fade_out_ms))
+            else:
+                stopped = self.__stop_locked()
+            self.__wakeup.notify()
+        finish_stopped(stopped)
+
+    def is_playing(self):
+        return len(self.__voices) > 0
+
+    def close(self):
+        with self.__wakeup:
+            stopped = self.__stop_locked()
+            self.__closing = True
+            self.__wakeup.notify()
+        finish_stopped(stopped)
+        self.__thread.join(1.0)
+
+    # Stop every voice at once. Returns their handles, as __fade_locked()
+    # does.
+    def __stop_locked(self):
+        voices = self.__voices + self.__fading
+        self.__voices = []
+        self.__fading = []
+        for voice in voices:
+            self.__retired.append(voice.decoder)
+        if voices:
+            self.__seeks = []
+            self.__drop_pending = True
+        return [voice.handle for voice in voices]
+
+    # Time taken by each stage of the DSP chain, None without one
+    def dsp_stats(self):
+        if self.__dsp_chain is None:
+            return None
+        return self.__dsp_chain.stats()
+
+    # Voices playing and stolen, and the mean time (microseconds) a period
+    # took to mix, by number of voices mixed
+    def stats(self):
+        mix_us = {}
+        for voices, periods in sorted(self.__periods.items()):
+            mix_us[voices] = round(1e6 * self.__seconds[voices] / periods, 1)
+        return {'voices': len(self.__voices), 'size': self.__size,
+                'stolen': self.stolen, 'mix_us': mix_us}
+
+    # True when the playback thread has nothing to do
+    def __idle(self):
+        if self.__closing or self.__retired or self.__drop_pending or \
+           self.__open_pending or self.__seeks:
+            return False
+        if not self.__voices and not self.__fading:
+            return not self.__sounding
+        return not self.__playing_locked() and self.__output_paused
+
+    # A voice reached its end, failed or faded out. Forget it unless it was
+    # already stopped.
+    def __finished(self, voice, returncode):
+        with self.__wakeup:
+            if voice in self.__voices:
+                self.__voices.remove(voice)
+            elif voice in self.__fading:
+                self.__fading.remove(voice)
+            else:
+                return
+        voice.decoder.close()
+        voice.handle.finish(returncode)
+
+    def __set_output_paused(self, paused):
+        if paused:
+            self.__native_pause = self.__output.pause(True)
+            if not self.__native_pause:
+                self.__output.drop()
+        elif self.__native_pause:
+            self.__output.pause(False)
+            self.__native_pause = False
+        self.__output_paused = paused
+
+    def __run(self):
+        while True:
+            with self.__wakeup:
+                while self.__idle():
+                    self.__wakeup.wait()
+                if self.__closing:
+                    break
+                retired, self.__retired = self.__retired, []
+                drop, self.__drop_pending = self.__drop_pending, False
+                seeks, self.__seeks = self.__seeks, []
+                open_output, self.__open_pending = self.__open_pending, False
+                voices = self.__voices + self.__fading
+                playing = self.__playing_locked()
+                paused = not playing
+
+            for decoder in retired:
+                decoder.close()
+
+            if open_output and self.__output is None:
+                try:
+                    self.__output = self.__output_factory()
+                except Exception as ex:
+                    print('VoiceMixer: cannot open sound device: ', ex)
+
+            if drop:
+                # whatever the chain held back goes with the rest
+                self.__sounding = False
+            if not voices:
+                try:
+                    if drop and self.__output is not None:
+                        self.__output.drop()
+                    elif self.__sounding:
+                        self.__write_tail()
+                except Exception as ex:
+                    print('VoiceMixer: playback failed: ', ex)
+                self.__sounding = False
+                self.__output_paused = False
+                continue
+
+            try:
+                if self.__output is None:
+                    self.__output = self.__output_factory()
+                if drop:
+                    self.__output.drop()
+                if paused != self.__output_paused:
+                    self.__set_output_paused(paused)
+                if paused:
+                    continue
+                for voice, seconds in seeks:
+                    voice.decoder.seek(seconds)
+                self.__mix_period(playing)
+            except Exception as ex:
+                print('VoiceMixer: playback failed: ', ex)
+                for voice in voices:
+                    self.__finished(voice, PLAYBACK_FAILED)
+
+    # Mix a period of the voices and write it to the device
+    def __mix_period(self, voices):
+        started = time.perf_counter()
+        mix = self.__mix
+        mix[...] = 0.0
+        frames = 0
+        summed = 0
+        ended = []
+        for voice in voices:
+            samples = voice.decoder.read(self.__period_frames)
+            count = len(samples)
+            if count == 0:
+                ended.append((voice, PLAYBACK_FINISHED))
+                continue
+            numpy.add(mix[:count], voice.gain_stage.scale(samples), out=mix[:count])
+            frames = max(frames, count)
+            summed += 1
+            if voice.fading and not voice.gain_stage.is_ramping():
+                # faded out
+                ended.append((voice, PLAYBACK_STOPPED))
+
+        if frames:
+            if not self.__sounding and self.__dsp_chain is not None:
+                self.__dsp_chain.reset()
+            self.__sounding = True
+            mixed = self.__volume_stage.scale(mix[:frames])
+            clipped = self.__clipped[:frames]
+            if summed > 1:
+                clipped = soft_clip(mixed, clipped, self.__work[:frames])
+            else:
+                # a voice on its own is as loud as its sound; the clip only
+                # keeps a gain over 1 from wrapping round in int16
+                clipped = numpy.clip(mixed, -32768.0, 32767.0, out=clipped)
+            if self.__dsp_chain is not None:
+                out = self.__dsp_chain.process(clipped)
+            else:
+                out = self.__out[:frames]
+                out[...] = clipped
+            seconds = time.perf_counter() - started
+            self.__periods[len(voices)] = self.__periods.get(len(voices), 0) + 1
+            self.__seconds[len(voices)] = self.__seconds.get(len(voices), 0.0) + seconds
+            self.__output.write(out)
+
+        for voice, returncode in ended:
+            self.__finished(voice, returncode)
+
+    # Write out what the DSP chain held back, once the last voice has ended
+    def __write_tail(self):
+        if self.__dsp_chain is None or self.__output is None:
+            return
+        tail = self.__dsp_chain.flush()
+        if tail is not None:
+            self.__output.write(tail)
@@ -1,67 +1,320 @@
-import alsaaudio
-import RPi.GPIO as GPIO
+from gpiobackend import GPIO
+import time
+from threading import Condition
+
+# see playbackengine.py, pyalsaaudio may be missing off the Pi
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
 
 from globaldefs import *
 from platformdefs import *
+from gainstage import *
 
 VOLUME_DELTA = 5
 
+# Default mixer write pacing and acceleration, in milliseconds. soundbox.ini
+# can change these in its [volume] section.
+VOLUME_WRITE_INTERVAL_MS = 40
+VOLUME_ACCELERATION_MS = 100
+VOLUME_ACCELERATION_MAX = 1
+
+# Quadrature decoding of the rotary encoder. The two encoder pins form a
+# 2-bit Gray code, state = (A << 1) | B. Each time either pin changes, the
+# previous and new states index this table to give the movement:
+# +1 / -1 for a valid step in either direction, 0 for no change (bounce
+# that settled back) and QUADRATURE_SKIP when both pins changed at once,
+# meaning an edge was missed because the knob turned faster than the
+# edges could be handled.
+QUADRATURE_SKIP = 2
+QUADRATURE_TRANSITIONS = (
+#   new: 00  01  10  11        previous
+         0, -1,  1,  QUADRATURE_SKIP,   # 00
+         1,  0,  QUADRATURE_SKIP, -1,   # 01
+        -1,  QUADRATURE_SKIP,  0,  1,   # 10
+         QUADRATURE_SKIP,  1, -1,  0)   # 11
+
+# Number of Gray code steps from one detent (click) of the knob to the next
+STEPS_PER_DETENT = 4
+
+
+# Open the ALSA mixer that sets the volume of the sound device
+def open_alsa_mixer():
+    # alsa /etc/asound.conf defines the mixer name
+    return alsaaudio.Mixer(ALSA_MIXER_NAME)
+
+
+# Class definition for the software mixer, a stand-in for the ALSA mixer
+# that sets the volume of the gain stage in the playback path instead. A
+# change of volume then ramps smoothly, makes no system calls and works
+# the same on any sound device. player is the PlaybackEngine or
+# PlayerPool the sounds are played by.
+class SoftwareMixer(object):
+
+    def __init__(self, player, volume=SOFTWARE_VOLUME_DEFAULT):
+        self.__player = player
+        self.setvolume(volume)
+
+    def getvolume(self):
+        return [self.__volume]
+
+    def setvolume(self, volume):
+        self.__volume = volume
+        self.__player.set_volume(percent_to_gain(volume))
+
+    def close(self):
+        return 0
+
+
+# Class definition for a quadrature state machine. It is fed the levels of
+# pins A and B each time one of them changes and keeps count of the detents
+# the knob has been turned through. Positive detents turn the volume up.
+# It does no GPIO itself, so it works the same for real or simulated pins.
+class QuadratureDecoder(object):
+
+    def __init__(self, steps_per_detent=STEPS_PER_DETENT):
+        self.__steps_per_detent = steps_per_detent
+        self.__state = None
+        self.__steps = 0
+        self.__direction = 0
+        self.position = 0
+
+    # Set the starting levels of the pins without counting any movement
+    def reset(self, a, b):
+        self.__state = (a << 1) | b
+        self.__steps = 0
+
+    # Process new pin levels, returns the number of whole detents moved
+    def update(self, a, b):
+        new_state = (a << 1) | b
+        if self.__state is None:
+            self.__state = new_state
+            return 0
 
+        movement = QUADRATURE_TRANSITIONS[(self.__state << 2) | new_state]
+        self.__state = new_state
+        if movement == QUADRATURE_SKIP:
+            # one edge was lost, but the knob can only have kept turning
+            # the way it was going, so count two steps that way
+            movement = 2 * self.__direction
+        elif movement != 0:
+            self.__direction = movement
+
+        self.__steps += movement
+        detents = 0
+        while self.__steps >= self.__steps_per_detent:
+            self.__steps -= self.__steps_per_detent
+            detents += 1
+        while self.__steps <= -self.__steps_per_detent:
+            self.__steps += self.__steps_per_detent
+            detents -= 1
+        self.position += detents
+        return detents
+
+    # Process an edge of one pin, pin B if on_b, the other pin keeping the
+    # level it had. Fed the level of each edge, rather than both pins read
+    # when the edge is handled, the decoder follows the knob however late
+    # the edges are handled.
+    def edge(self, on_b, level):
+        if self.__state is None:
+            return 0
+        a, b = self.__state >> 1, self.__state & 1
+        if on_b:
+            b = level
+        else:
+            a = level
+        return self.update(a, b)
+
+
+# Class definition for the settings of the volume knob
+#   step: volume change (percent) of one detent
+#   write_interval: the mixer is written at most once in this many seconds;
+#                   detents turned in between are applied together
+#   acceleration: a detent turned this soon (seconds) after the one before
+#                 counts as more than one step, the sooner the more
+#   acceleration_max: most steps a detent can count as (1 turns
+#                     acceleration off)
+class VolumeSettings(object):
+
+    def __init__(self, step=VOLUME_DELTA,
+                 write_interval_ms=VOLUME_WRITE_INTERVAL_MS,
+                 acceleration_ms=VOLUME_ACCELERATION_MS,
+                 acceleration_max=VOLUME_ACCELERATION_MAX):
+        self.step = step
+        self.write_interval = write_interval_ms / 1000.0
+        self.acceleration = acceleration_ms / 1000.0
+        self.acceleration_max = max(1, acceleration_max)
+
+
+# Class definition for the volume knob. The volume the knob asks for is
+# kept in memory: each detent changes it at once, on the GPIO callback
+# thread, stopping at 0 and 100 as the mixer would. The mixer is read once
+# when the knob starts and then only written, at most once per write
+# interval, with whatever the volume has become. A fast spin therefore
+# costs a handful of mixer writes rather than one read and one write per
+# detent, and the volume it ends at is the same as if every detent had
+# been written.
+#
+# The mixer is opened when it is first needed, by the first detent or by
+# open_mixer(), not when the knob is created, so opening it does not hold
+# up the start of the soundbox.
+#
+# loop() does the writing on a thread of its own. The asyncio runtime
+# calls step() instead, when the time it returned comes or when the waker
+# set with set_waker() is called.
 class VolumeControl(object):
 
     terminate = False
 
-    def __init__(self, sound_player):
-        self.__sound_player = sound_player
-        self.globalCounter = 0
-        self.flag = 0
-        self.Last_RoB_Status = 0
-        self.Current_RoB_Status = 0
+    # How often (seconds) the waiting loop checks for termination
+    TERMINATE_CHECK_INTERVAL = 1.0
 
-        # alsa /etc/asound.conf defines the mixer name
-        self.__mixer = alsaaudio.Mixer(ALSA_MIXER_NAME)
+    def __init__(self, sound_player, mixer_factory=open_alsa_mixer,
+                 settings=None):
+        self.__sound_player = sound_player
+        self.__settings = settings if settings is not None else VolumeSettings()
+        self.__decoder = QuadratureDecoder()
+        self.__moved = Condition()
+        self.__waker = None
+        self.__mixer_factory = mixer_factory
+        self.__mixer = None
+        self.__target = None
+        self.__written = None
+        self.__written_at = None
+        self.__last_detent_at = None
+        # counters, see stats()
+        self.__detents = 0
+        self.__steps = 0
+        self.__mixer_writes = 0
 
     def close(self):
         if self.__mixer is not None:
             rc = self.__mixer.close()
             print ('ALSA Master mixer closed with rc =', rc)
 
-    def rotate(self):
-        self.Last_RoB_Status = GPIO.input(ROTARY_PIN_B)
+    # Called by the GPIO subsystem whenever pin A or pin B changes level.
+    # The GPIO subsystem calls back on a single thread, so the decoder is
+    # only ever updated from one place. The level is that of the edge, not
+    # of the pin now: a callback running a few edges behind a fast spin
+    # would otherwise see a later state and count the wrong way.
+    def encoder_edge(self, channel):
+        detents = self.__decoder.edge(channel == ROTARY_PIN_B,
+                                      GPIO.edge_level(channel))
+        if detents == 0:
+            return
+        when = GPIO.edge_time(channel)
+        if when is None:
+            when = GPIO.monotonic()
+        with self.__moved:
+            steps = detents * self.__acceleration(when)
+            self.__last_detent_at = when
+            self.__detents += abs(detents)
+            self.__steps += abs(steps)
+            if self.__target is None:
+                self.__target = self.__read_mixer()
+            self.__target = min(100, max(0, self.__target +
+                                         steps * self.__settings.step))
+            self.__moved.notify()
+        if self.__waker is not None:
+            self.__waker()
+
+    # Number of steps one detent counts as, turned at time when
+    def __acceleration(self, when):
+        settings = self.__settings
+        if settings.acceleration_max <= 1 or self.__last_detent_at is None:
+            return 1
+        gap = when - self.__last_detent_at
+        if gap >= settings.acceleration:
+            return 1
+        if gap <= 0:
+            return settings.acceleration_max
+        return min(settings.acceleration_max, int(settings.acceleration / gap))
+
+    # Open the mixer and read the volume it is at, if not done already
+    def open_mixer(self):
+        with self.__moved:
+            if self.__target is None:
+                self.__target = self.__read_mixer()
+
+    def __read_mixer(self):
+        if self.__mixer is None:
+            self.__mixer = self.__mixer_factory()
+        volume = self.__mixer.getvolume()[0]
+        self.__written = volume
+        print('current volume = ', volume)
+        return volume
+
+    # Use other settings from the next detent on, e.g. when soundbox.ini is
+    # reloaded
+    def set_settings(self, settings):
+        with self.__moved:
+            self.__settings = settings
+
+    # Have waker() called on the GPIO callback thread each time the knob
+    # turns through a detent
+    def set_waker(self, waker):
+        self.__waker = waker
+
+    def start_decoding(self):
+        self.__decoder.reset(*GPIO.input_many((ROTARY_PIN_A, ROTARY_PIN_B)))
+        GPIO.add_event_detect(ROTARY_PIN_A, GPIO.BOTH, callback=self.encoder_edge)
+        GPIO.add_event_detect(ROTARY_PIN_B, GPIO.BOTH, callback=self.encoder_edge)
+
+    def stop_decoding(self):
+        GPIO.remove_event_detect(ROTARY_PIN_A)
+        GPIO.remove_event_detect(ROTARY_PIN_B)
+
+    # Volume the knob has asked for, which the mixer is set to within a
+    # write interval
+    def volume(self):
+        with self.__moved:
+            return self.__target
 
-        while(not GPIO.input(ROTARY_PIN_A)):
-            self.Current_RoB_Status = GPIO.input(ROTARY_PIN_B)
-            self.flag = 1
+    # Counters of the knob: detents turned, the steps they counted as
+    # after acceleration, and mixer writes made for them
+    def stats(self):
+        with self.__moved:
+            return {'detents': self.__detents,
+                    'steps': self.__steps,
+                    'mixer_writes': self.__mixer_writes,
+                    'volume': self.__target}
 
-        if self.flag == 1:
-            self.flag = 0
-            if (self.Last_RoB_Status == 0) and (self.Current_RoB_Status == 1):
-                self.globalCounter = self.globalCounter + 1
-            if (self.Last_RoB_Status == 1) and (self.Current_RoB_Status == 0):
-                self.globalCounter = self.globalCounter - 1
+    # Write the volume to the mixer if it changed and the write interval
+    # has passed. Returns the time (monotonic clock) a held back write is
+    # due, or None if nothing is waiting to be written.
+    def step(self):
+        with self.__moved:
+            target = self.__target
+            if target is None or target == self.__written:
+                return None
+            now = time.monotonic()
+            if self.__written_at is not None:
+                due = self.__written_at + self.__settings.write_interval
+                if now < due:
+                    return due
+            self.__written = target
+            self.__written_at = now
+            self.__mixer_writes += 1
+        # written outside the lock so detents are not held up by it
+        self.__mixer.setvolume(target)
+        print('change to ', target)
+        return None
 
     def loop(self):
-        tmp = 0
         try:
+            self.start_decoding()
             while not VolumeControl.terminate:
-                self.rotate()
-                if tmp != self.globalCounter:
-                    current_volume = self.__mixer.getvolume()[0]
-                    print('current volume = ', current_volume)
-                    if tmp > self.globalCounter:
-                        # increase volume up to 100 max
-                        new_volume = current_volume + VOLUME_DELTA
-                        if new_volume > 100:
-                            new_volume = 100
-                        print('increase to ', new_volume)
-                        self.__mixer.setvolume(new_volume)
-                    else:
-                        # decrease volume down to 0 min
-                        new_volume = current_volume - VOLUME_DELTA
-                        if new_volume < 0:
-                            new_volume = 0
-                        print('decrease to ', new_volume)
-                        self.__mixer.setvolume(new_volume)
-                    tmp = self.globalCounter
+                due = self.step()
+                # sleep until the knob has been turned, or until a write
+                # that was held back is due. the pins are watched by edge
+                # detection, nothing runs while the knob is still.
+                with self.__moved:
+                    if self.__target == self.__written:
+                        self.__moved.wait(self.TERMINATE_CHECK_INTERVAL)
+                    elif due is not None:
+                        remaining = due - time.monotonic()
+                        if remaining > 0:
+                            self.__moved.wait(remaining)
         except RuntimeError:
             print('Ignoring RuntimeError at shutdown (VolumeControl)')